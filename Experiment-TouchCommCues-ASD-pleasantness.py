@@ -1,6 +1,5 @@
-from psychopy import visual, core, event, data, gui
 import numpy as np
-import random, os, pygame, copy
+import random, os, sys, copy, math, time
 from touchcomm import *
 
 
@@ -10,28 +9,108 @@ exptInfo = {'Experiment name':'TC-ASD-pleas',
             'Participant Code':'test',
             'Number of trials per cue':1,
             'Press to continue':True,
+            'Go/stop sound':'./sounds/go-stop.wav',
+            'Touch duration (sec)':'', # blank for the go/stop sound's own, otherwise synthesised from it
             'Participant screen':1,
             'Experimenter screen':0,
             'Participant screen resolution':'800,600', #'1920, 1200',
             'Experimenter screen resolution':'400,300', #'1280,720',
-            'Folder for saving data':'data'}
-
-
-dlg = gui.DlgFromDict(exptInfo, title='Experiment details', 
-                    order = ['Experiment name',
-                    'Participant Code',
-                    'Number of trials per cue',
-                    'Press to continue',
-                    'Participant screen',
-                    'Experimenter screen',
-                    'Participant screen resolution',
-                    'Experimenter screen resolution',
-                    'Folder for saving data'])
-
-if dlg.OK:
-    pass ## continue
+            'Folder for saving data':'data',
+            'Data storage':'csv', # csv, columnar or both
+            'Record frame timing':False,
+            'Record response trajectories':False,
+            'Flip screens concurrently':False,
+            'Sync pulses':False,
+            'Marker stream':'', # e.g. udp://192.168.1.10:5005
+            'Sensor':'', # continuous sensor data during trials, e.g. synthetic
+            'Dashboard port':'', # blank for none, e.g. 8080, then open http://localhost:8080, or 0 for any free port
+            'Audio backend':'pygame',
+            'Audio buffer (samples)':512,
+            'Audio sample rate (Hz)':44100}
+
+
+## --headless runs the whole session offscreen with scripted responses, e.g. for CI
+## --simulate does the same on a virtual clock, as fast as possible
+options = get_session_options()
+if options.participant is not None:
+    exptInfo['Participant Code'] = options.participant
+if options.folder is not None:
+    exptInfo['Folder for saving data'] = options.folder
+if options.go_stop is not None:
+    exptInfo['Go/stop sound'] = options.go_stop
+if options.touch_duration is not None:
+    exptInfo['Touch duration (sec)'] = options.touch_duration
+if options.storage is not None:
+    exptInfo['Data storage'] = options.storage
+if options.frame_timing:
+    exptInfo['Record frame timing'] = True
+if options.trajectories:
+    exptInfo['Record response trajectories'] = True
+if options.concurrent_flips:
+    exptInfo['Flip screens concurrently'] = True
+if options.sync_pulses:
+    exptInfo['Sync pulses'] = True
+if options.markers is not None:
+    exptInfo['Marker stream'] = options.markers
+if options.dashboard is not None:
+    exptInfo['Dashboard port'] = options.dashboard
+if options.sensor is not None:
+    exptInfo['Sensor'] = options.sensor
+if options.audio is not None:
+    exptInfo['Audio backend'] = options.audio
+if options.audio_buffer is not None:
+    exptInfo['Audio buffer (samples)'] = options.audio_buffer
+if options.sample_rate is not None:
+    exptInfo['Audio sample rate (Hz)'] = options.sample_rate
+if options.seed is not None:
+    exptInfo['Random seed'] = options.seed
+    random.seed(options.seed)
+    np.random.seed(options.seed)
+
+## --resume carries on an interrupted session from its journal, with the settings it started with
+resumeState = None
+if options.resume is not None:
+    resumeState = read_journal(options.resume)
+    if resumeState['finished']:
+        sys.exit('{} is already finished' .format(options.resume))
+    exptInfo = resumeState['exptInfo']
+
+if options.headless:
+    os.environ['SDL_AUDIODRIVER'] = 'dummy'
+    backend = HeadlessBackend(ScriptedInput(clicks = ['english'] if resumeState is None else [],
+                                            rate = lambda: round(random.uniform(-10,10),1)),
+                            virtualTime = options.simulate)
 else:
-    core.quit() ## the user hit cancel so exit
+    backend = defaultBackend
+if not options.headless and resumeState is None:
+    from psychopy import gui ## only imported here, so that headless sessions run without psychopy
+    dlg = gui.DlgFromDict(exptInfo, title='Experiment details', 
+                        order = ['Experiment name',
+                        'Participant Code',
+                        'Number of trials per cue',
+                        'Press to continue',
+                        'Go/stop sound',
+                        'Touch duration (sec)',
+                        'Participant screen',
+                        'Experimenter screen',
+                        'Participant screen resolution',
+                        'Experimenter screen resolution',
+                        'Folder for saving data',
+                        'Data storage',
+                        'Record frame timing',
+                        'Record response trajectories',
+                        'Flip screens concurrently',
+                        'Sync pulses',
+                        'Marker stream',
+                        'Sensor',
+                        'Dashboard port',
+                        'Audio backend',
+                        'Audio buffer (samples)',
+                        'Audio sample rate (Hz)'])
+    if dlg.OK:
+        pass ## continue
+    else:
+        backend.quit() ## the user hit cancel so exit
 
 # ----
 
@@ -42,23 +121,30 @@ languagePrompt = ButtonInterface(fullscr = True,
                                 size = [int(i) for i in exptInfo['Participant screen resolution'].split(',')],
                                 message = '',
                                 nCol = len(languageLabels), nRow = 1, 
-                                buttonLabels = languageLabels)
-
-languagePrompt.showButtons(languageLabels)
-(responseN, t) = languagePrompt.getButtonClick(core.Clock())
-languagePrompt.hideButtons()
-if responseN < 0:
-    core.quit() ## the user hit cancel so exit
-else:
-    exptInfo['language'] = ['sv','en'][responseN]
+                                buttonLabels = languageLabels,
+                                backend = backend)
+
+if resumeState is None:
+    languagePrompt.showButtons(languageLabels)
+    (responseN, t) = languagePrompt.getButtonClick(backend.Clock())
+    languagePrompt.hideButtons()
+    if responseN < 0:
+        backend.quit() ## the user hit cancel so exit
+    else:
+        exptInfo['language'] = ['sv','en'][responseN]
 
 # ----
 
 # -- SET UP THE EXPERIMENT --
 
-exptInfo['Date and time']= data.getDateStr(format='%Y-%m-%d_%H-%M-%S') ##add the current time
+if resumeState is None:
+    exptInfo['Date and time']= time.strftime('%Y-%m-%d_%H-%M-%S') ##add the current time
+    ## the trial order and button orders are generated from this, see TrialSequence
+    exptInfo['Sequence seed'] = options.seed if options.seed is not None else random.SystemRandom().randrange(2**31)
 
 exptInfo['Inter-stimulus interval (sec)'] = 6
+exptInfo['Sync pulse interval (sec)'] = 30
+exptInfo['Max repeats of a cue in a row'] = 1
 
 # text displayed to experimenter and participant
 displayText = dict((line.strip().split('\t') for line in open('./text/display-text-' + exptInfo['language'] + '.txt')))
@@ -71,7 +157,7 @@ languagePrompt.updateMessage(displayText['waitMessage'])
 stimLabels = ['attention','gratitude','love','sadness','happiness','calming']
 receiverCueText = dict((line.strip().split('\t') for line in open('./text/receiver-cues-' + exptInfo['language'] + '.txt')))
 toucherCueText = dict((line.strip().split('\t') for line in open('./text/toucher-cues.txt')))
-soundDurations = dict((line.strip().split('\t') for line in open('./sounds/durations.txt')))
+soundIndex = SoundIndex() ## durations and timing measured from the audio files
 
 stimList = []
 for stim in stimLabels: 
@@ -79,17 +165,43 @@ for stim in stimLabels:
                     'toucherCueText':toucherCueText[stim],
                     'receiverCueText':receiverCueText[stim],
                     'cueSound':'./sounds/{} - short.wav' .format(stim),
-                    'cueSoundDuration':float(soundDurations[stim])})
-trials = data.TrialHandler(stimList, exptInfo['Number of trials per cue'])
+                    'cueSoundDuration':soundIndex.get('./sounds/{} - short.wav' .format(stim))['duration']})
+## the whole trial order is fixed up front and journaled, so a resumed session carries on with it
+if resumeState is None:
+    sequence = TrialSequence(stimLabels, exptInfo['Number of trials per cue'], exptInfo['Sequence seed'],
+                            maxRun = exptInfo['Max repeats of a cue in a row'])
+    nDone = 0
+else:
+    sequence = TrialSequence(**resumeState['sequence'])
+    nDone = len(resumeState['rows'])
+stimInfo = dict((stim['stim'], stim) for stim in stimList)
 
 # ----
 
 # -- MAKE FOLDER/FILES TO SAVE DATA --
 
+dataHeaders = ['trial','cued','response']
 saveFiles = DataFileCollection(foldername = exptInfo['Folder for saving data'],
                 filename = exptInfo['Experiment name'] + '_' + exptInfo['Date and time'] +'_P' + exptInfo['Participant Code'],
-                headers = ['trial','cued','response'],
-                dlgInput = exptInfo)
+                headers = dataHeaders,
+                dlgInput = exptInfo,
+                buffered = True,
+                resumeRows = None if resumeState is None else resumeState['rows'],
+                storage = exptInfo['Data storage'])
+
+## every completed trial is journaled, to carry on with --resume after a crash
+journal = SessionJournal(saveFiles.fileprefix+'_journal.jsonl')
+if resumeState is None:
+    journal.startSession(exptInfo, dataHeaders, sequence.record())
+
+## every logged event, parsed and indexed for queries during the session, e.g. eventIndex.accuracy('love')
+eventIndex = EventIndex()
+saveFiles.addListener(eventIndex)
+
+## every logged event also goes straight out to the acquisition system
+if exptInfo['Marker stream']:
+    markers = MarkerStream(exptInfo['Marker stream'])
+    saveFiles.addListener(markers)
 
 # ----
 
@@ -98,7 +210,10 @@ saveFiles = DataFileCollection(foldername = exptInfo['Folder for saving data'],
 toucher = DisplayInterface(False,
                         exptInfo['Experimenter screen'],
                         [int(i) for i in exptInfo['Experimenter screen resolution'].split(',')], ## convert text input to numbers
-                        displayText['startMessage'])
+                        displayText['startMessage'],
+                        backend = backend,
+                        deferred = True,
+                        cacheText = True)
 
 receiver = VASInterface(fullscr = True, 
                         screen = exptInfo['Participant screen'], 
@@ -108,15 +223,74 @@ receiver = VASInterface(fullscr = True,
                         minLabel = displayText['VASminLabel'],
                         maxLabel = displayText['VASmaxLabel'],
                         acceptPreText = displayText['VASacceptPre'],
-                        acceptText = displayText['VASaccept'])
+                        acceptText = displayText['VASaccept'],
+                        backend = backend,
+                        deferred = True,
+                        cacheText = True)
+
+## flip each screen on its own thread, in case the monitors don't share a vsync phase (Linux only)
+if exptInfo['Flip screens concurrently']:
+    if not (toucher.startFlipThread() and receiver.startFlipThread()):
+        print('screens can only be flipped concurrently on Linux, flipping them in turn')
+
+## per-flip timing of both screens, summarised per trial
+if exptInfo['Record frame timing']:
+    telemetry = FrameTelemetry(saveFiles.fileprefix+'_frames.csv', resuming = resumeState is not None)
+    telemetry.attach(toucher,'toucher')
+    telemetry.attach(receiver,'receiver')
+
+## mouse position, hovered button and rating during each response, saved per trial
+if exptInfo['Record response trajectories']:
+    trajectories = ResponseTrajectories(saveFiles.fileprefix)
+    trajectories.attach(receiver,'receiver')
+
+## live view of progress, per-cue results and timing alerts for the experimenter, in a web browser
+dashboard = None
+if exptInfo['Dashboard port'] != '':
+    dashboard = Dashboard(eventIndex, int(exptInfo['Dashboard port']), nTrials = sequence.nTrials)
+    saveFiles.addTimingListener(dashboard.onTiming)
+    if exptInfo['Record frame timing']:
+        dashboard.watchFrames(telemetry)
+    print('dashboard at {}' .format(dashboard.address))
 
 # -----
 
 # -- SETUP AUDIO --
 
-pygame.mixer.pre_init() 
-pygame.mixer.init()
-goStopSound = pygame.mixer.Sound('./sounds/go-stop.wav')
+## buffer size and sample rate set the cue onset latency and jitter, see python benchmark.py audio
+backend.audio = audioBackends[exptInfo['Audio backend']](frequency = int(exptInfo['Audio sample rate (Hz)']),
+                                                        bufferSize = int(exptInfo['Audio buffer (samples)']))
+backend.audio.init()
+## go/stop signal recorded, with its timing measured from the audio, or for another touch duration
+## synthesised from the recording's timing at the mixer's sample rate, cached in ./sounds/rendered
+goStopFilename = exptInfo['Go/stop sound']
+goStopInfo = soundIndex.get(goStopFilename)
+goStopTiming = go_stop_timing(goStopInfo)
+if exptInfo['Touch duration (sec)'] != '':
+    synthesis = dict(go_stop_parameters(goStopInfo),
+                    frameRate = int(exptInfo['Audio sample rate (Hz)']),
+                    stimulusDuration = float(exptInfo['Touch duration (sec)']))
+    (goStopFilename,goStopTiming) = render_go_stop(**synthesis)
+## decode all audio cues once, before the first trial
+cueBank = AudioCueBank([stim['cueSound'] for stim in stimList],
+                        pinned = [goStopFilename],
+                        backend = backend)
+goStopSound = cueBank.get(goStopFilename)
+soundIndex.save()
+
+# ----
+
+# -- PRE-RENDER DISPLAY TEXT --
+
+## every message and countdown value shown during trials, rendered once up front
+toucher.preloadMessages([displayText[i] for i in ['startMessage','waitMessage','finishedMessage']] +
+                        [stim['toucherCueText'] for stim in stimList] +
+                        [stim['toucherCueText'] + '\n' + displayText['continueMessage'] for stim in stimList] +
+                        [stim['toucherCueText'] + '.\n' + displayText['touchMessage'] for stim in stimList])
+maxTimer = max(exptInfo['Inter-stimulus interval (sec)'],
+                max(stim['cueSoundDuration'] for stim in stimList) + goStopTiming['silentLead'] + goStopTiming['countDownDuration'])
+toucher.preloadTimer(range(0, int(math.ceil(maxTimer)) + 1))
+receiver.preloadMessages([displayText[i] for i in ['waitMessage','fixationMessage','finishedMessage']] + [''])
 
 # ----
 
@@ -125,28 +299,61 @@ goStopSound = pygame.mixer.Sound('./sounds/go-stop.wav')
 
 # display starting screens
 languagePrompt.win.close()
-exptClock=core.Clock()
+exptClock = backend.Clock()
 exptClock.reset()
-isiCountdown = core.CountdownTimer(0)
+isiCountdown = backend.CountdownTimer(0)
+## sync pulses for lining up physiology and video recordings with the log afterwards
+if exptInfo['Sync pulses']:
+    syncPulses = SyncPulses(backend, saveFiles, exptClock, interval = exptInfo['Sync pulse interval (sec)'])
+## continuous sensor data, saved per trial
+if exptInfo['Sensor']:
+    sensorCapture = SensorCapture(sensorSources[exptInfo['Sensor']](exptClock), saveFiles.fileprefix, exptClock,
+                                virtualTime = getattr(backend, 'virtualTime', False))
 receiver.startScreen(displayText['waitMessage'])
 toucher.startScreen(displayText['startMessage'])
 
 # wait for start trigger
-for (key,keyTime) in event.waitKeys(keyList=['space','escape'], timeStamped=exptClock):
+for (key,keyTime) in toucher.waitKeys(['space','escape'], exptClock):
     if key in ['escape']:
         saveFiles.logAbort(keyTime)
-        core.quit()
+        backend.quit()
     if key in ['space']:
-        exptClock.add(keyTime)
-        saveFiles.logEvent(0,'experiment started')
-
+        ## a resumed session carries on the clock it started with
+        startTime = 0 if resumeState is None else resume_time(resumeState)
+        exptClock.add(keyTime - startTime)
+        journal.logClock(exptClock)
+        if exptInfo['Marker stream']:
+            markers.syncClock(exptClock)
+        if resumeState is None:
+            saveFiles.logEvent(0,'experiment started')
+        else:
+            saveFiles.logEvent(startTime,'experiment resumed at trial {}' .format(nDone+1))
+        if exptInfo['Sensor']:
+            sensorCapture.start()
+        if exptInfo['Sync pulses']:
+            syncPulses.start()
+            syncPulses.pulse('session start')
+
+## carry on the random sequences (scripted responses) where the session left off
+if resumeState is not None:
+    set_rng_state(resumeState['rng'])
 
 # pleasantness ratings loop
-for thisTrial in trials:
+for trialN in range(nDone+1, sequence.nTrials+1):
     
-    event.clearEvents()
+    thisTrial = stimInfo[sequence.order[trialN-1]]
+    toucher.clearEvents()
+    if exptInfo['Record frame timing']:
+        telemetry.startTrial(trialN)
+    if exptInfo['Record response trajectories']:
+        trajectories.startTrial(trialN)
+    if exptInfo['Sensor']:
+        sensorCapture.startTrial(trialN)
+    if exptInfo['Sync pulses']:
+        syncPulses.update()
+        syncPulses.pulse('trial {}' .format(trialN))
     
-    if trials.thisN == 0: 
+    if trialN == nDone+1: 
         isiCountdown.reset(exptInfo['Inter-stimulus interval (sec)'])
     
     present_stimulus(thisTrial,
@@ -154,27 +361,55 @@ for thisTrial in trials:
                     receiver,toucher,
                     saveFiles,
                     exptClock,isiCountdown,
-                    goStopSound)
+                    goStopSound,cueBank,goStopTiming)
     
     response = get_vas_response(toucher,receiver,
                                 displayText,exptClock,saveFiles)
       
-    saveFiles.writeTrialData([trials.thisN+1,
-                            thisTrial['stim'],
-                            response])
+    trialData = [trialN,
+                thisTrial['stim'],
+                response]
+    saveFiles.writeTrialData(trialData)
+    journal.logTrial(trialData, exptClock.getTime())
+    if exptInfo['Record frame timing']:
+        telemetry.endTrial()
+    if exptInfo['Record response trajectories']:
+        trajectories.endTrial()
+    if exptInfo['Sensor']:
+        sensorCapture.endTrial()
     
     saveFiles.logEvent(exptClock.getTime(),
-        '{} of {} complete' .format(trials.thisN+1, trials.nTotal))
+        '{} of {} complete' .format(trialN, sequence.nTrials))
 
 # -----
 
 # prompt at the end of the experiment
-event.clearEvents()
+toucher.clearEvents()
 receiver.updateMessage(displayText['finishedMessage'])
 toucher.updateMessage(displayText['finishedMessage'])
-
+present_frame(receiver, toucher)
+
+if exptInfo['Sync pulses']:
+    syncPulses.pulse('session end')
+    syncPulses.close()
+if exptInfo['Sensor']:
+    sensorCapture.close()
+    if sensorCapture.lost:
+        saveFiles.logEvent(exptClock.getTime(),'{} sensor samples lost' .format(sensorCapture.lost))
+if exptInfo['Record response trajectories'] and trajectories.overflow:
+    saveFiles.logEvent(exptClock.getTime(),'{} trajectory samples not recorded' .format(trajectories.overflow))
 saveFiles.logEvent(exptClock.getTime(),'experiment finished')
-core.wait(2)
+journal.finish()
+journal.close()
+cueBank.saveLatency(saveFiles.fileprefix+'_audio.csv')
+if exptInfo['Marker stream']:
+    markers.close()
+    markers.saveLatency(saveFiles.fileprefix+'_markers.csv')
+if dashboard is not None:
+    dashboard.close()
+saveFiles.close()
+backend.wait(2)
 receiver.win.close()
 toucher.win.close()
-core.quit()
+backend.audio.close()
+backend.quit()
@@ -0,0 +1,373 @@
+from sessionfiles import read_wav, ColumnarStore, export_csv
+import numpy as np
+import argparse, collections, csv, glob, multiprocessing, os, pickle
+
+## offline analysis of saved sessions
+
+
+## -- ALIGNING EXTERNAL RECORDINGS --
+## sync pulses logged in _timing.csv are found in the audio track of a physiology or video recording,
+## giving recording time = offset + (1 + drift) * log time
+
+def read_events(prefix,table):
+    ## (time, event) text of every row of a session's _log.csv or _timing.csv (table 'log' or 'timing'),
+    ## from its columnar store if it was saved without the CSV
+    filename = '{}_{}.csv' .format(prefix, table)
+    if not os.path.exists(filename) and os.path.exists(prefix+'_columns'):
+        store = ColumnarStore(prefix+'_columns', mode='r')
+        return list(zip(store.text(table, 'time'), store.text(table, 'event')))
+    return [(row['time'], row['event']) for row in csv.DictReader(open(filename))]
+
+def sync_pulse_times(prefix):
+    ## times the sync pulses were heard, on the experiment clock
+    return np.array([float(eventTime) for (eventTime,event) in read_events(prefix, 'timing') if event.startswith('sync pulse')])
+
+def mono(samples):
+    return samples.mean(axis=1)
+
+def resample(signal,fromRate,toRate):
+    if fromRate == toRate:
+        return signal
+    nSamples = int(round(len(signal) * toRate / float(fromRate)))
+    return np.interp(np.arange(nSamples) * fromRate / float(toRate), np.arange(len(signal)), signal)
+
+def envelope(signal,blockSize):
+    ## peak absolute value in consecutive blocks
+    nBlocks = len(signal) // blockSize
+    return np.abs(signal[0:nBlocks*blockSize]).reshape(nBlocks, blockSize).max(axis=1)
+
+def find_pulses(recording,rate,template,expectedTimes,halfWindow):
+    ## time of the template in the recording within halfWindow samples of each expected time, to a
+    ## fraction of a sample (parabola through the correlation peak); all pulses cross-correlated at once by FFT
+    starts = np.round(np.asarray(expectedTimes) * rate).astype(int) - halfWindow
+    width = 2*halfWindow + len(template)
+    valid = (starts >= 0) & (starts + width <= len(recording))
+    times = np.full(len(starts), np.nan)
+    if not valid.any():
+        return times
+    segments = recording[starts[valid,np.newaxis] + np.arange(width)]
+    nFFT = 1 << int(np.ceil(np.log2(width + len(template))))
+    spectrum = np.fft.rfft(segments, nFFT, axis=1) * np.conj(np.fft.rfft(template, nFFT))
+    correlation = np.fft.irfft(spectrum, nFFT, axis=1)[:,0:2*halfWindow+1]
+    rows = np.arange(len(correlation))
+    peak = np.clip(np.argmax(correlation, axis=1), 1, 2*halfWindow-1)
+    (a,b,c) = (correlation[rows,peak-1], correlation[rows,peak], correlation[rows,peak+1])
+    curvature = a - 2*b + c
+    fraction = np.where(curvature != 0, 0.5 * (a - c) / np.where(curvature != 0, curvature, 1), 0)
+    times[valid] = (starts[valid] + peak + fraction) / float(rate)
+    return times
+
+def dominant_period(signal,rate):
+    spectrum = np.abs(np.fft.rfft(signal))
+    spectrum[0] = 0
+    return len(signal) / float(rate) / max(1, int(np.argmax(spectrum)))
+
+def coarse_offset(recording,rate,template,templateRate,pulseTimes,resolution=0.001):
+    ## offset of the whole pulse train in the recording, to the nearest resolution seconds:
+    ## cross-correlate the recording's envelope with the envelope the pulses should make
+    blockSize = max(1, int(round(resolution * rate)))
+    blockRate = rate / float(blockSize)
+    recordingEnvelope = envelope(recording, blockSize)
+    pulseEnvelope = envelope(resample(template, templateRate, rate), blockSize)
+    train = np.zeros(int(np.ceil((pulseTimes[-1] - pulseTimes[0]) * blockRate)) + len(pulseEnvelope))
+    starts = np.round((pulseTimes - pulseTimes[0]) * blockRate).astype(int)
+    ## add every pulse into the train at once
+    index = starts[:,np.newaxis] + np.arange(len(pulseEnvelope))
+    np.add.at(train, index.ravel(), np.tile(pulseEnvelope, len(starts)))
+    ## remove the means so that loud stretches of recording don't dominate, and allow negative lags
+    ## (recording started after the first pulse) by wrapping the circular correlation round
+    signal = recordingEnvelope - recordingEnvelope.mean()
+    nFFT = 1 << int(np.ceil(np.log2(len(signal) + len(train))))
+    correlation = np.fft.irfft(np.fft.rfft(signal, nFFT) * np.conj(np.fft.rfft(train - train.mean(), nFFT)), nFFT)
+    lag = int(np.argmax(correlation))
+    if lag >= len(signal):
+        lag -= nFFT
+    return lag / blockRate - pulseTimes[0]
+
+def align_recording(recordingFilename,pulseTimes,syncFilename='./sounds/sync.wav',searchWindow=0.05):
+    ## finds each sync pulse in the recording to within a sample, and fits offset and drift
+    (samples,rate) = read_wav(recordingFilename)
+    recording = mono(samples)
+    (templateSamples,templateRate) = read_wav(syncFilename)
+    template = resample(mono(templateSamples), templateRate, rate)
+    pulseTimes = np.sort(pulseTimes)
+    offset = coarse_offset(recording, rate, mono(templateSamples), templateRate, pulseTimes)
+
+    ## find the pulses one by one, predicting each from a fit to the ones before
+    recordingTimes = np.full(len(pulseTimes), np.nan)
+    fit = (1.0, offset) # slope, intercept
+    for (n,pulseTime) in enumerate(pulseTimes):
+        recordingTimes[n] = find_pulses(recording, rate, template, [fit[0] * pulseTime + fit[1]],
+                                        int(round(searchWindow * rate)))[0]
+        found = ~np.isnan(recordingTimes)
+        if found.sum() >= 2:
+            fit = tuple(np.polyfit(pulseTimes[found], recordingTimes[found], 1))
+        elif found[n]:
+            fit = (1.0, recordingTimes[n] - pulseTime)
+    
+    ## a tonal pulse correlates almost as well a cycle early or late, so fit without pulses that are
+    ## more than half a cycle out, then look again within half a cycle of the fit
+    period = dominant_period(template, rate)
+    found = ~np.isnan(recordingTimes)
+    if found.sum() < 2:
+        raise ValueError('found fewer than two sync pulses in {}' .format(recordingFilename))
+    inliers = found
+    for iteration in range(3):
+        (slope,intercept) = np.polyfit(pulseTimes[inliers], recordingTimes[inliers], 1)
+        residuals = recordingTimes - (slope * pulseTimes + intercept)
+        inliers = found & (np.abs(np.nan_to_num(residuals, nan=np.inf)) < period/2)
+    recordingTimes = find_pulses(recording, rate, template, slope * pulseTimes + intercept,
+                                max(1, int(period/2 * rate)))
+    found = ~np.isnan(recordingTimes)
+    (slope,intercept) = np.polyfit(pulseTimes[found], recordingTimes[found], 1)
+    residuals = recordingTimes[found] - (slope * pulseTimes[found] + intercept)
+    return {'offset':intercept, # recording time at log time 0
+            'drift':slope - 1, # extra seconds of recording per second of log
+            'pulses found':int(found.sum()),
+            'pulses logged':len(pulseTimes),
+            'max residual':float(np.abs(residuals).max()),
+            'rms residual':float(np.sqrt(np.mean(residuals**2))),
+            'recording times':recordingTimes}
+
+def to_recording_time(logTime,alignment):
+    return alignment['offset'] + (1 + alignment['drift']) * np.asarray(logTime)
+
+def write_aligned_log(prefix,alignment,outputFilename):
+    ## copy of the log with each event's time in the recording added
+    rows = read_events(prefix, 'log')
+    outFile = open(outputFilename, 'w')
+    outFile.write('time,recording time,event\n')
+    for (eventTime,event) in rows:
+        outFile.write('{},{},"{}"\n' .format(eventTime, to_recording_time(float(eventTime), alignment), event))
+    outFile.close()
+
+
+
+## -- SESSION SUMMARIES --
+## every session in a data folder, its data joined with its log: per trial the cue, the response or rating,
+## the response time and the touch duration; sessions are parsed in parallel and cached by the modification
+## times of their files, so only new or changed sessions are parsed again
+
+sessionSuffixes = ['_info.csv', '_data.csv', '_log.csv']
+
+def find_sessions(folder):
+    ## file prefixes of the sessions in folder with all their files, as CSV or in a columnar store
+    prefixes = set(name[:-len('_data.csv')] for name in glob.glob(os.path.join(folder, '*_data.csv'))
+                    if all(os.path.exists(name[:-len('_data.csv')]+suffix) for suffix in sessionSuffixes))
+    prefixes.update(name[:-len('_columns')] for name in glob.glob(os.path.join(folder, '*_columns'))
+                    if os.path.exists(name[:-len('_columns')]+'_info.csv'))
+    return sorted(prefixes)
+
+def read_info(prefix):
+    return dict(row for row in csv.reader(open(prefix+'_info.csv')) if len(row) == 2)
+
+def to_float(text):
+    try:
+        return float(text)
+    except ValueError:
+        return np.nan
+
+def parse_session(prefix):
+    info = read_info(prefix)
+    if os.path.exists(prefix+'_columns'):
+        ## the log times straight from the file, with no text to parse
+        store = ColumnarStore(prefix+'_columns', mode='r')
+        dataColumns = dict((name, store.text('data', name)) for name in store.schema['data']['columns'])
+        times = np.array(store.column('log', 'time'))
+        events = store.text('log', 'event')
+    else:
+        dataRows = list(csv.DictReader(open(prefix+'_data.csv')))
+        dataColumns = dict((name, np.array([row[name] for row in dataRows], dtype=str)) for name in ['trial','cued','response'])
+        logRows = list(csv.DictReader(open(prefix+'_log.csv')))
+        times = np.array([to_float(row['time']) for row in logRows])
+        events = np.array([row['event'] for row in logRows], dtype=str)
+
+    ## each event belongs to the trial whose "N of M complete" comes next, and a trial run again after
+    ## --resume overwrites what was logged of it before the crash
+    isComplete = np.char.endswith(events, ' complete') & (np.char.find(events, ' of ') > 0)
+    completeRows = np.flatnonzero(isComplete)
+    completeTrials = np.array([int(event.split(' of ')[0]) for event in events[completeRows]], dtype=int)
+    next = np.searchsorted(completeRows, np.arange(len(events)))
+    inTrial = next < len(completeRows)
+    eventTrial = np.where(inTrial, completeTrials[np.minimum(next, len(completeRows)-1)] if len(completeRows) else -1, -1)
+
+    trial = dataColumns['trial'].astype(float).astype(int)
+    nSlots = max([trial.max() if len(trial) else 0] + list(completeTrials)) + 1
+    def last_event_times(start):
+        ## time of the last event in each trial that starts with start
+        matches = np.char.startswith(events, start) & inTrial
+        slots = np.full(nSlots, np.nan)
+        slots[eventTrial[matches]] = times[matches]
+        return slots[trial]
+    startTouch = last_event_times('start touching')
+    stopTouch = last_event_times('stop touching')
+    buttons = last_event_times('buttons presented')
+    responded = last_event_times('receiver responded')
+    rated = last_event_times('Pleasantness rating')
+
+    responses = dataColumns['response']
+    isRating = ~np.isnan(rated)
+    return {'prefix':prefix,
+            'participant':info.get('Participant Code', ''),
+            'experiment':info.get('Experiment name', ''),
+            'date':info.get('Date and time', ''),
+            'trial':trial,
+            'cued':dataColumns['cued'],
+            'response':responses,
+            'rating':np.where(isRating, [to_float(response) for response in responses], np.nan),
+            ## from the buttons being shown, or from the end of the touch to the VAS rating
+            'rt':np.where(isRating, rated - stopTouch, responded - buttons),
+            'touch duration':stopTouch - startTouch}
+
+def session_mtimes(prefix):
+    if os.path.exists(prefix+'_columns'):
+        return tuple(sorted(os.path.getmtime(name) for name in glob.glob(os.path.join(prefix+'_columns', '*')) + [prefix+'_info.csv']))
+    return tuple(os.path.getmtime(prefix+suffix) for suffix in sessionSuffixes)
+
+def load_sessions(folder,processes=None,cacheFilename=None):
+    ## parsed sessions, and how many had to be parsed rather than read from the cache
+    cacheFilename = cacheFilename or os.path.join(folder, 'analysis-cache.pickle')
+    cache = {}
+    if os.path.exists(cacheFilename):
+        try:
+            cache = pickle.load(open(cacheFilename, 'rb'))
+        except Exception: ## unreadable, e.g. written by another version: start again
+            cache = {}
+    prefixes = find_sessions(folder)
+    mtimes = dict((prefix, session_mtimes(prefix)) for prefix in prefixes)
+    stale = [prefix for prefix in prefixes if prefix not in cache or cache[prefix][0] != mtimes[prefix]]
+    if len(stale) > 1 and processes != 1:
+        pool = multiprocessing.Pool(processes)
+        parsed = pool.map(parse_session, stale)
+        pool.close()
+    else:
+        parsed = [parse_session(prefix) for prefix in stale]
+    for (prefix,session) in zip(stale, parsed):
+        cache[prefix] = (mtimes[prefix], session)
+    cache = dict((prefix, cache[prefix]) for prefix in prefixes)
+    if stale or not os.path.exists(cacheFilename):
+        pickle.dump(cache, open(cacheFilename, 'wb'))
+    return ([cache[prefix][1] for prefix in prefixes], len(stale))
+
+def summarise(sessions):
+    ## one participant's sessions of one task: confusion matrix of cue by response, accuracy,
+    ## and response time and VAS rating statistics, overall and per cue
+    cued = np.concatenate([session['cued'] for session in sessions])
+    response = np.concatenate([session['response'] for session in sessions])
+    rating = np.concatenate([session['rating'] for session in sessions])
+    rt = np.concatenate([session['rt'] for session in sessions])
+    cues = np.unique(cued)
+    isRating = ~np.isnan(rating)
+    ## responses in the same order as the cues, then others such as 'other' and 'timeout'
+    labels = np.concatenate([cues, np.setdiff1d(np.unique(response[~isRating]), cues)])
+    cueN = np.searchsorted(cues, cued)
+    responseN = np.array([np.flatnonzero(labels == r)[0] if r in labels else -1 for r in response], dtype=int)
+    chosen = responseN >= 0
+    confusion = np.bincount(cueN[chosen] * len(labels) + responseN[chosen],
+                            minlength=len(cues)*len(labels)).reshape(len(cues), len(labels))
+    nPerCue = np.bincount(cueN, minlength=len(cues))
+    correct = np.diag(confusion[:,0:len(cues)])
+    ## rating mean and standard deviation per cue from sums, NaN where no ratings
+    nRated = np.bincount(cueN[isRating], minlength=len(cues))
+    ratingSum = np.bincount(cueN[isRating], weights=rating[isRating], minlength=len(cues))
+    ratingSumSq = np.bincount(cueN[isRating], weights=rating[isRating]**2, minlength=len(cues))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ratingMean = ratingSum / nRated
+        ratingSD = np.sqrt(np.maximum(ratingSumSq / nRated - ratingMean**2, 0) * nRated / (nRated - 1))
+    percentiles = [10, 50, 90]
+    rtPerCue = np.array([nan_percentiles(rt[cueN == n], percentiles) for n in range(len(cues))])
+    return {'participant':sessions[0]['participant'],
+            'experiment':sessions[0]['experiment'],
+            'sessions':len(sessions),
+            'trials':len(cued),
+            'cues':list(cues),
+            'trials per cue':nPerCue,
+            'labels':list(labels),
+            'confusion':confusion,
+            'accuracy':correct.sum() / float(max(1, (~isRating).sum())) if (~isRating).any() else np.nan,
+            'accuracy per cue':np.where(isRating.all(), np.nan, correct / np.maximum(nPerCue, 1)),
+            'rt percentiles':percentiles,
+            'rt':nan_percentiles(rt, percentiles),
+            'rt per cue':rtPerCue,
+            'rating mean':np.nanmean(rating) if isRating.any() else np.nan,
+            'rating mean per cue':ratingMean,
+            'rating sd per cue':ratingSD}
+
+def nan_percentiles(values,percentiles):
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+        return np.full(len(percentiles), np.nan)
+    return np.percentile(values, percentiles)
+
+def summarise_participants(sessions):
+    ## summaries per participant and task, in participant order
+    groups = collections.OrderedDict()
+    for session in sorted(sessions, key=lambda session: (session['participant'], session['experiment'], session['date'])):
+        groups.setdefault((session['participant'], session['experiment']), []).append(session)
+    return [summarise(group) for group in groups.values()]
+
+def write_summaries(summaries,outputFilename):
+    ## one row per participant, task and cue
+    outFile = open(outputFilename, 'w')
+    outFile.write('participant,experiment,cue,trials,accuracy,rt p10,rt median,rt p90,rating mean,rating sd\n')
+    for summary in summaries:
+        for (n,cue) in enumerate(summary['cues']):
+            outFile.write('{},{},{},{},{:.4f},{:.4f},{:.4f},{:.4f},{:.4f},{:.4f}\n' .format(
+                summary['participant'], summary['experiment'], cue,
+                summary['trials per cue'][n],
+                summary['accuracy per cue'][n], *(list(summary['rt per cue'][n]) +
+                [summary['rating mean per cue'][n], summary['rating sd per cue'][n]])))
+    outFile.close()
+
+def print_summary(summary):
+    print('{} {}: {} sessions, {} trials, RT median {:.2f} s (10-90% {:.2f}-{:.2f} s)' .format(
+        summary['participant'], summary['experiment'], summary['sessions'], summary['trials'],
+        summary['rt'][1], summary['rt'][0], summary['rt'][2]))
+    if not np.isnan(summary['accuracy']):
+        print('  accuracy {:.0%}; rows cued, columns responded' .format(summary['accuracy']))
+        width = max(len(label) for label in summary['labels'])
+        print('  {:>{w}} ' .format('', w=width) + ' '.join('{:>4}' .format(label[0:4]) for label in summary['labels']) + '  correct')
+        for (n,cue) in enumerate(summary['cues']):
+            print('  {:>{w}} ' .format(cue, w=width) + ' '.join('{:4d}' .format(count) for count in summary['confusion'][n])
+                + '  {:6.0%}' .format(summary['accuracy per cue'][n]))
+    if not np.isnan(summary['rating mean']):
+        print('  rating mean {:.2f}' .format(summary['rating mean']))
+        for (n,cue) in enumerate(summary['cues']):
+            print('  {:>12} {:6.2f} (sd {:.2f})' .format(cue, summary['rating mean per cue'][n], summary['rating sd per cue'][n]))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+    alignParser = subparsers.add_parser('align', help='line a recording with sync pulses up with a session log')
+    alignParser.add_argument('fileprefix', help='session files, e.g. data/TC-ASD-comm_2024-01-01_10-00-00_P01')
+    alignParser.add_argument('recording', help='WAV file of the recording\'s audio track')
+    alignParser.add_argument('--sync', default='./sounds/sync.wav', help='sync pulse sound')
+    alignParser.add_argument('--output', help='write the log with recording times to this file')
+    exportParser = subparsers.add_parser('export', help='write the CSV files of a session saved with --storage columnar')
+    exportParser.add_argument('fileprefix', help='session files, e.g. data/TC-ASD-comm_2024-01-01_10-00-00_P01')
+    exportParser.add_argument('--output', help='prefix for the CSV files, if not the session\'s own')
+    summaryParser = subparsers.add_parser('summary', help='accuracy, confusion matrices, RT and VAS summaries per participant')
+    summaryParser.add_argument('folder', nargs='?', default='data', help='folder of session files')
+    summaryParser.add_argument('--processes', type=int, help='parse sessions in this many processes (default: one per CPU)')
+    summaryParser.add_argument('--output', help='write per-cue summaries to this CSV file')
+    args = parser.parse_args()
+
+    if args.command == 'align':
+        pulseTimes = sync_pulse_times(args.fileprefix)
+        alignment = align_recording(args.recording, pulseTimes, args.sync)
+        print('found {} of {} sync pulses' .format(alignment['pulses found'], alignment['pulses logged']))
+        print('recording time = {:.6f} s + log time x (1 {:+.2f} ppm)' .format(alignment['offset'], alignment['drift']*1e6))
+        print('residuals: max {:.3f} ms, rms {:.3f} ms' .format(alignment['max residual']*1e3, alignment['rms residual']*1e3))
+        write_aligned_log(args.fileprefix, alignment, args.output or args.fileprefix+'_log-aligned.csv')
+    elif args.command == 'export':
+        export_csv(args.fileprefix, args.output)
+    elif args.command == 'summary':
+        (sessions,nParsed) = load_sessions(args.folder, args.processes)
+        print('{} sessions, {} parsed, {} from the cache' .format(len(sessions), nParsed, len(sessions) - nParsed))
+        summaries = summarise_participants(sessions)
+        for summary in summaries:
+            print_summary(summary)
+        if args.output:
+            write_summaries(summaries, args.output)
+    else:
+        parser.print_help()
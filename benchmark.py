@@ -0,0 +1,543 @@
+from touchcomm import (DataFileCollection, MarkerStream, EventIndex, TrialSequence, SoundIndex,
+                        HeadlessBackend, ScriptedInput, DisplayInterface, ButtonInterface, VASInterface,
+                        AudioCueBank, FrameTelemetry, PygameAudio, SoundDeviceAudio,
+                        go_stop_timing, present_stimulus, present_frame, get_button_response, get_vas_response)
+from sessionfiles import ColumnarStore
+import numpy as np
+import os, random, collections, wave, hashlib
+import time, shutil, tempfile, contextlib, argparse, json, platform, tracemalloc, threading, socket
+try:
+    import sounddevice
+except (ImportError, OSError): ## the sounddevice configurations are skipped without it
+    sounddevice = None
+
+
+def benchmark_logging(nEvents=2000,**writerOptions):
+    # time each logEvent call as seen by the caller (i.e. the render loop)
+    folder = tempfile.mkdtemp(dir='.')
+    eventTimes = np.zeros(nEvents)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        saveFiles = DataFileCollection(foldername = os.path.basename(folder),
+                                        filename = 'benchmark',
+                                        headers = ['trial','cued','response'],
+                                        dlgInput = {},
+                                        **writerOptions)
+        for n in range(nEvents):
+            t0 = time.perf_counter()
+            saveFiles.logEvent(n*0.01,'benchmark event {}' .format(n))
+            eventTimes[n] = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        saveFiles.close()
+        closeTime = time.perf_counter() - t0
+    if saveFiles.writeCSV:
+        nLines = sum(1 for line in open(saveFiles.fileprefix+'_log.csv')) - 1
+    else:
+        nLines = ColumnarStore(saveFiles.fileprefix+'_columns', mode='r').nRows['log']
+    shutil.rmtree(folder)
+    if nLines != nEvents:
+        raise RuntimeError('expected {} log lines, found {}' .format(nEvents, nLines))
+    return eventTimes, closeTime
+
+def report(name,eventTimes,closeTime):
+    us = eventTimes*1e6
+    print('{:<24} mean {:8.1f} us  median {:8.1f} us  p99 {:8.1f} us  max {:8.1f} us  close {:6.1f} ms'
+        .format(name, us.mean(), np.median(us), np.percentile(us,99), us.max(), closeTime*1e3))
+
+
+class PhaseTimer():
+    ## collects call durations of instrumented methods, grouped by phase
+    def __init__(self):
+        self.samples = collections.OrderedDict()
+
+    def wrap(self,obj,name,phase):
+        method = getattr(obj, name)
+        samples = self.samples.setdefault(phase, [])
+        def timed(*args, **kwargs):
+            t0 = time.perf_counter()
+            result = method(*args, **kwargs)
+            samples.append(time.perf_counter() - t0)
+            return result
+        setattr(obj, name, timed)
+
+    def time(self,phase,function,*args):
+        t0 = time.perf_counter()
+        result = function(*args)
+        self.samples.setdefault(phase, []).append(time.perf_counter() - t0)
+        return result
+
+    def summary(self):
+        summary = collections.OrderedDict()
+        for (phase,samples) in self.samples.items():
+            if not samples:
+                continue
+            us = np.array(samples)*1e6
+            summary[phase] = {'n':len(us),
+                            'mean':us.mean(),
+                            'p50':np.percentile(us,50),
+                            'p90':np.percentile(us,90),
+                            'p99':np.percentile(us,99),
+                            'max':us.max()}
+        return summary
+
+def benchmark_trials(task='communication',nTrials=60,traceAllocations=False):
+    ## run a representative trial sequence on the headless backend in virtual time,
+    ## so that everything measured is framework overhead rather than waiting
+    stimLabels = ['attention','gratitude','love','sadness','happiness','calming']
+    displayText = dict((line.strip().split('\t') for line in open('./text/display-text-en.txt')))
+    receiverCueText = dict((line.strip().split('\t') for line in open('./text/receiver-cues-en.txt')))
+    toucherCueText = dict((line.strip().split('\t') for line in open('./text/toucher-cues.txt')))
+    soundIndex = SoundIndex()
+    stimList = [{'stim':stim,
+                'toucherCueText':toucherCueText[stim],
+                'receiverCueText':receiverCueText[stim],
+                'cueSound':'./sounds/{} - short.wav' .format(stim),
+                'cueSoundDuration':soundIndex.get('./sounds/{} - short.wav' .format(stim))['duration']}
+                for stim in stimLabels]
+    exptInfo = {'Press to continue':False, 'Inter-stimulus interval (sec)':6}
+
+    random.seed(0)
+    backend = HeadlessBackend(ScriptedInput(chooseButton = random.choice,
+                                            rate = lambda: round(random.uniform(-10,10),1)),
+                            virtualTime = True)
+    folder = tempfile.mkdtemp(dir='.')
+    devnull = open(os.devnull, 'w')
+    timer = PhaseTimer()
+    cpuTimes = []
+    allocations = []
+    try:
+        with contextlib.redirect_stdout(devnull):
+            saveFiles = DataFileCollection(foldername = os.path.basename(folder),
+                                            filename = 'benchmark',
+                                            headers = ['trial','cued','response'],
+                                            dlgInput = exptInfo,
+                                            buffered = True)
+            toucher = DisplayInterface(False, 0, [400,300], displayText['startMessage'], backend = backend, deferred = True, cacheText = True)
+            if task == 'communication':
+                receiver = ButtonInterface(True, 1, [800,600], displayText['waitMessage'],
+                                            nCol = 2, nRow = 4,
+                                            buttonLabels = [receiverCueText[i] for i in stimLabels + ['other']],
+                                            backend = backend, deferred = True, cacheText = True)
+            else:
+                receiver = VASInterface(True, 1, [800,600], displayText['waitMessage'],
+                                        question = 'How pleasant was the touch?',
+                                        minLabel = 'unpleasant', maxLabel = 'pleasant',
+                                        acceptPreText = 'click line', acceptText = 'accept',
+                                        backend = backend, deferred = True, cacheText = True)
+            cueBank = AudioCueBank([stim['cueSound'] for stim in stimList],
+                                    pinned = ['./sounds/go-stop.wav'],
+                                    backend = backend)
+            goStopSound = cueBank.get('./sounds/go-stop.wav')
+            goStopTiming = go_stop_timing(soundIndex.get('./sounds/go-stop.wav'))
+
+            ## per-phase timing, left out when counting allocations so the samples aren't counted
+            if not traceAllocations:
+                for interface in (toucher, receiver):
+                    timer.wrap(interface.win, 'flip', 'flip')
+                    for name in ('updateMessage', 'updateTimerDisplay', 'hideTimerDisplay'):
+                        timer.wrap(interface, name, 'text update')
+                if task == 'communication':
+                    timer.wrap(receiver, 'showButtons', 'button layout')
+                    timer.wrap(receiver, 'hideButtons', 'button layout')
+                timer.wrap(saveFiles, 'logEvent', 'logging')
+                timer.wrap(cueBank, 'get', 'sound setup')
+                timer.wrap(cueBank, 'play', 'sound setup')
+
+            exptClock = backend.Clock()
+            isiCountdown = backend.CountdownTimer(exptInfo['Inter-stimulus interval (sec)'])
+            if traceAllocations:
+                tracemalloc.start()
+            for trialN in range(nTrials):
+                thisTrial = stimList[trialN % len(stimList)]
+                if traceAllocations:
+                    tracemalloc.reset_peak()
+                    startMemory = tracemalloc.get_traced_memory()[0]
+                cpuStart = time.process_time()
+                timer.time('present_stimulus', present_stimulus, thisTrial, exptInfo, displayText,
+                            receiver, toucher, saveFiles, exptClock, isiCountdown,
+                            goStopSound, cueBank, goStopTiming)
+                if task == 'communication':
+                    response = timer.time('get_button_response', get_button_response, stimLabels, receiverCueText,
+                                        thisTrial, displayText, receiver, toucher, saveFiles, exptClock)
+                else:
+                    response = timer.time('get_vas_response', get_vas_response,
+                                        toucher, receiver, displayText, exptClock, saveFiles)
+                timer.time('writeTrialData', saveFiles.writeTrialData, [trialN+1, thisTrial['stim'], response])
+                cpuTimes += [time.process_time() - cpuStart]
+                if traceAllocations:
+                    (endMemory,peakMemory) = tracemalloc.get_traced_memory()
+                    allocations += [(peakMemory - startMemory, endMemory - startMemory)]
+            if traceAllocations:
+                tracemalloc.stop()
+            saveFiles.close()
+    finally:
+        devnull.close()
+        shutil.rmtree(folder)
+
+    cpuMs = np.array(cpuTimes)*1e3
+    results = {'phases':timer.summary(),
+                'cpu per trial (ms)':{'mean':cpuMs.mean(), 'p50':np.percentile(cpuMs,50),
+                                    'p99':np.percentile(cpuMs,99), 'max':cpuMs.max()},
+                'flips per trial':(toucher.win.nFlips + receiver.win.nFlips) / float(nTrials)}
+    if traceAllocations:
+        allocations = np.array(allocations) / 1024.0
+        results['allocations per trial (KiB)'] = {'peak mean':allocations[:,0].mean(),
+                                                'peak max':allocations[:,0].max(),
+                                                'retained mean':allocations[:,1].mean()}
+    return results
+
+def benchmark_flips(concurrent,nFrames=120,phase=0.012,work=0.006):
+    ## both screens change every frame, with vsyncs offset by phase seconds and work seconds of CPU per frame
+    backend = HeadlessBackend(screenPhases = {0:0.0, 1:phase})
+    toucher = DisplayInterface(False, 0, [400,300], '', backend = backend, deferred = True)
+    receiver = DisplayInterface(True, 1, [800,600], '', backend = backend, deferred = True)
+    telemetry = FrameTelemetry(os.devnull)
+    telemetry.attach(toucher, 'toucher')
+    telemetry.attach(receiver, 'receiver')
+    if concurrent:
+        toucher.startFlipThread()
+        receiver.startFlipThread()
+    frameTimes = np.zeros(nFrames)
+    for n in range(nFrames):
+        t0 = time.perf_counter()
+        time.sleep(work)
+        toucher.updateTimerDisplay(n)
+        receiver.updateMessage(str(n))
+        present_frame(toucher, receiver)
+        frameTimes[n] = time.perf_counter() - t0
+    return (frameTimes, dict((name, telemetry.summarise(record)) for (name,record) in telemetry.records.items()))
+
+def benchmark_input(mode,nKeys=40,meanInterval=0.05):
+    ## wait for key presses posted by another thread at random times: spinning on getKeys (as getSelection did),
+    ## polling every 1 ms (as the trial loops did), or blocking in waitEvents for up to a frame
+    backend = HeadlessBackend()
+    clock = backend.Clock()
+    rng = np.random.RandomState(0)
+    pressTimes = []
+    def press_keys():
+        for interval in rng.exponential(meanInterval, nKeys):
+            time.sleep(interval)
+            pressTimes.append(clock.getTime())
+            backend.postKey('space')
+    presser = threading.Thread(target=press_keys)
+    keyTimes = []
+    readTimes = []
+    cpu0 = time.process_time()
+    wall0 = time.perf_counter()
+    presser.start()
+    while len(keyTimes) < nKeys:
+        keys = backend.getKeys(['space'], clock)
+        readTime = clock.getTime()
+        for (key,t) in keys:
+            keyTimes += [t]
+            readTimes += [readTime]
+        if keys:
+            continue
+        if mode == 'poll 1 ms':
+            time.sleep(0.001)
+        elif mode == 'event-driven':
+            backend.waitEvents(backend.frameDuration)
+    presser.join()
+    cpu = time.process_time() - cpu0
+    wall = time.perf_counter() - wall0
+    pressTimes = np.array(pressTimes)
+    return {'cpu (%)':100*cpu/wall,
+            'read delay p50 (ms)':np.median(np.array(readTimes) - pressTimes)*1e3,
+            'read delay max (ms)':np.max(np.array(readTimes) - pressTimes)*1e3,
+            'timestamp error max (ms)':np.max(np.abs(np.array(keyTimes) - pressTimes))*1e3}
+
+def benchmark_audio(audio,nRepeats=20,toneDuration=0.1):
+    ## self-timed onset latency: play a tone of known length and time, by polling get_busy every 0.1 ms
+    ## (spinning would starve the mixer thread), how much longer than its length the mixer reports it playing for. With SDL's dummy driver
+    ## this measures the mixer's buffering, with a real device the driver's buffering isn't seen
+    audio.init()
+    folder = tempfile.mkdtemp(dir='.')
+    toneFilename = os.path.join(folder, 'tone.wav')
+    t = np.arange(int(toneDuration * audio.frequency)) / float(audio.frequency)
+    tone = (0.5 * np.sin(2*np.pi*1000*t) * 32767).astype('<i2')
+    toneFile = wave.open(toneFilename, 'wb')
+    toneFile.setnchannels(1)
+    toneFile.setsampwidth(2)
+    toneFile.setframerate(audio.frequency)
+    toneFile.writeframes(tone.tobytes())
+    toneFile.close()
+    sound = audio.loadSound(toneFilename)
+    rng = np.random.RandomState(0)
+    callTimes = np.zeros(nRepeats)
+    lags = np.zeros(nRepeats)
+    for n in range(nRepeats):
+        ## start at a random point in the mixer's buffer cycle
+        time.sleep(rng.uniform(0, 0.05))
+        t0 = time.perf_counter()
+        channel = sound.play()
+        t1 = time.perf_counter()
+        while channel.get_busy():
+            time.sleep(0.0001)
+        callTimes[n] = t1 - t0
+        lags[n] = time.perf_counter() - t0 - sound.get_length()
+    (latency,uncertainty) = audio.latency()
+    audio.close()
+    shutil.rmtree(folder)
+    return {'estimated latency (ms)':latency*1e3,
+            'estimated uncertainty (ms)':uncertainty*1e3,
+            'play() call p50 (us)':np.median(callTimes)*1e6,
+            'measured lag mean (ms)':lags.mean()*1e3,
+            'measured jitter sd (ms)':lags.std()*1e3,
+            'measured lag range (ms)':(lags.max() - lags.min())*1e3}
+
+class MarkerReceiver():
+    ## stand-in acquisition system on this machine, keeps (time received, marker) for every marker
+    def __init__(self,protocol):
+        self.protocol = protocol
+        self.received = []
+        if protocol == 'udp':
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        else:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.bind(('127.0.0.1', 0))
+        if protocol == 'tcp':
+            self.socket.listen(1)
+        self.address = '{}://127.0.0.1:{}' .format(protocol, self.socket.getsockname()[1])
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def _run(self):
+        if self.protocol == 'udp':
+            while True:
+                data = self.socket.recv(65536)
+                if not data:
+                    break
+                self.received.append((time.perf_counter(), json.loads(data.decode('utf-8'))))
+        else:
+            (connection,address) = self.socket.accept()
+            buffered = b''
+            while True:
+                data = connection.recv(65536)
+                if not data:
+                    break
+                receivedAt = time.perf_counter()
+                buffered += data
+                lines = buffered.split(b'\n')
+                buffered = lines.pop()
+                self.received += [(receivedAt, json.loads(line.decode('utf-8'))) for line in lines]
+            connection.close()
+    
+    def close(self):
+        if self.protocol == 'udp':
+            ## an empty datagram stops the receiving thread
+            self.socket.sendto(b'', self.socket.getsockname())
+        self.thread.join(1.0)
+        self.socket.close()
+
+def benchmark_markers(protocol,nEvents=500,interval=0.001):
+    ## log events about once a frame-ish with a marker stream listening, and check what arrives
+    receiver = MarkerReceiver(protocol)
+    folder = tempfile.mkdtemp(dir='.')
+    loggedAt = np.zeros(nEvents)
+    callTimes = np.zeros(nEvents)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        saveFiles = DataFileCollection(foldername = os.path.basename(folder),
+                                        filename = 'benchmark',
+                                        headers = ['trial','cued','response'],
+                                        dlgInput = {},
+                                        buffered = True)
+        markers = MarkerStream(receiver.address)
+        saveFiles.addListener(markers)
+        clock = HeadlessBackend().Clock()
+        markers.syncClock(clock)
+        for n in range(nEvents):
+            loggedAt[n] = time.perf_counter()
+            saveFiles.logEvent(clock.getTime(), 'marker {}' .format(n))
+            callTimes[n] = time.perf_counter() - loggedAt[n]
+            time.sleep(interval)
+        markers.close()
+        saveFiles.close()
+    time.sleep(0.1)
+    receiver.close()
+    shutil.rmtree(folder)
+    seqs = np.array([marker['seq'] for (receivedAt,marker) in receiver.received], dtype=int)
+    latency = np.array([receivedAt - loggedAt[marker['seq']-1] for (receivedAt,marker) in receiver.received])
+    sendLatency = np.array([latency for (seq,latency) in markers.sendLatency])
+    return {'logEvent p50 (us)':np.median(callTimes)*1e6,
+            'logEvent p99 (us)':np.percentile(callTimes,99)*1e6,
+            'send latency p50 (us)':np.median(sendLatency)*1e6,
+            'received latency p50 (us)':np.median(latency)*1e6,
+            'received latency p99 (us)':np.percentile(latency,99)*1e6,
+            'received latency max (us)':latency.max()*1e6,
+            'lost':nEvents - len(set(seqs)),
+            'out of order':int(np.sum(np.diff(seqs) < 0)),
+            'send failures':markers.nFailed}
+
+def benchmark_events(nTrials=2000):
+    ## cost of indexing each logged event with EventIndex, and of the queries a trial loop might make every frame
+    cues = ['attention','gratitude','love','sadness','happiness','calming']
+    rng = np.random.RandomState(0)
+    events = []
+    for trial in range(nTrials):
+        cue = cues[trial % len(cues)]
+        response = cues[rng.randint(len(cues))]
+        events += ['toucher cue {}' .format(cue), 'countdown to touch', 'start touching', 'stop touching', 'buttons presented',
+                    'receiver responded {} - {}' .format(response, ['incorrect','correct'][int(cue == response)]),
+                    '{} of {} complete' .format(trial+1, nTrials)]
+    index = EventIndex()
+    eventTimes = np.zeros(len(events))
+    for (n,event) in enumerate(events):
+        t0 = time.perf_counter()
+        index(n*0.5, event)
+        eventTimes[n] = time.perf_counter() - t0
+    queryTimes = np.zeros(1000)
+    for n in range(len(queryTimes)):
+        t0 = time.perf_counter()
+        index.accuracy('love')
+        index.meanRT()
+        index.lastTouchDuration()
+        index.last('stop touching')
+        queryTimes[n] = time.perf_counter() - t0
+    return {'events':len(events),
+            'index p50 (us)':np.median(eventTimes)*1e6,
+            'index p99 (us)':np.percentile(eventTimes,99)*1e6,
+            'index last 1000 p50 (us)':np.median(eventTimes[-1000:])*1e6,
+            '4 queries p50 (us)':np.median(queryTimes)*1e6}
+
+def benchmark_sequences(nCandidates,nSessions=20):
+    ## generate a communication session's trial and button orders from nCandidates candidates each
+    items = ['attention','gratitude','love','sadness','happiness','calming']
+    times = np.zeros(nSessions)
+    spread = np.zeros(nSessions)
+    for seed in range(nSessions):
+        startTime = time.perf_counter()
+        sequence = TrialSequence(items, 10, seed, maxRun = 1, buttonItems = items, nCandidates = nCandidates)
+        times[seed] = time.perf_counter() - startTime
+        ## how unevenly each cued item's button is spread over the positions
+        counts = np.zeros((len(items), len(items)))
+        for (item,buttons) in zip(sequence.order, sequence.buttonOrders):
+            counts[items.index(item), buttons.index(item)] += 1
+        spread[seed] = (counts.max(axis=1) - counts.min(axis=1)).max()
+    return {'generate p50 (ms)':np.median(times)*1e3,
+            'generate max (ms)':times.max()*1e3,
+            'cued position spread mean':spread.mean()}
+
+def print_trial_results(task,results,previous=None):
+    print('{} trials: {:.1f} flips per trial, CPU {:.2f} ms per trial (p99 {:.2f} ms)'
+        .format(task, results['flips per trial'], results['cpu per trial (ms)']['mean'], results['cpu per trial (ms)']['p99']))
+    if 'allocations per trial (KiB)' in results:
+        alloc = results['allocations per trial (KiB)']
+        print('  allocations per trial: peak {:.1f} KiB (max {:.1f}), retained {:.2f} KiB'
+            .format(alloc['peak mean'], alloc['peak max'], alloc['retained mean']))
+    for (phase,stats) in results['phases'].items():
+        line = '  {:<20} n {:6d}  p50 {:9.1f} us  p90 {:9.1f} us  p99 {:9.1f} us  max {:9.1f} us' .format(
+            phase, stats['n'], stats['p50'], stats['p90'], stats['p99'], stats['max'])
+        if previous is not None and phase in previous.get('phases', {}):
+            change = stats['p50'] / previous['phases'][phase]['p50'] - 1
+            line += '  p50 {:+.0%}{}' .format(change, '  REGRESSION' if change > 0.2 else '')
+        print(line)
+
+def to_json(value):
+    if isinstance(value, dict):
+        return dict((k, to_json(v)) for (k,v) in value.items())
+    if isinstance(value, (np.floating, np.integer)):
+        return value.item()
+    return value
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('suite', nargs='?', default='all', choices=['all','logging','trials','flips','input','audio','markers','sequences','events'])
+    parser.add_argument('--events', type=int, default=2000, help='log events for the logging benchmark')
+    parser.add_argument('--trials', type=int, default=60, help='trials per task for the trial benchmark')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--compare', help='compare with results from an earlier JSON file')
+    parser.add_argument('--audio-driver', help='SDL audio driver for the audio benchmark, e.g. dummy when there is no sound card')
+    args = parser.parse_args()
+
+    results = {'touchcomm sha1':hashlib.sha1(open('touchcomm.py','rb').read()).hexdigest(),
+                'python':platform.python_version(),
+                'platform':platform.platform(),
+                'date':time.strftime('%Y-%m-%d %H:%M:%S')}
+    previous = json.load(open(args.compare)) if args.compare else {}
+
+    if args.suite in ('all','logging'):
+        print('per-event cost of DataFileCollection.logEvent, {} events' .format(args.events))
+        results['logging'] = {}
+        for (name,options) in [('direct',{}), ('buffered',{'buffered':True}), ('buffered, no fsync',{'buffered':True,'fsync':False}),
+                                ('columnar',{'storage':'columnar'})]:
+            (eventTimes,closeTime) = benchmark_logging(args.events, **options)
+            report(name, eventTimes, closeTime)
+            results['logging'][name] = {'p50':np.percentile(eventTimes*1e6,50),
+                                        'p99':np.percentile(eventTimes*1e6,99),
+                                        'close (ms)':closeTime*1e3}
+
+    if args.suite in ('all','trials'):
+        for task in ('communication','pleasantness'):
+            ## time without tracemalloc, which slows everything down, then count allocations separately
+            taskResults = benchmark_trials(task, args.trials)
+            taskResults['allocations per trial (KiB)'] = benchmark_trials(task, args.trials,
+                                                        traceAllocations=True)['allocations per trial (KiB)']
+            print_trial_results(task, taskResults, previous.get('trials', {}).get(task))
+            results.setdefault('trials', {})[task] = taskResults
+
+    if args.suite in ('all','flips'):
+        print('two screens with vsyncs 12 ms apart, both changing every frame, 6 ms of work per frame')
+        for (name,concurrent) in [('serial',False), ('concurrent',True)]:
+            (frameTimes,windows) = benchmark_flips(concurrent)
+            print('{:<12} frame loop p50 {:.1f} ms' .format(name, np.median(frameTimes)*1e3))
+            for (window,summary) in windows.items():
+                print('  {:<10} flip interval mean {:.1f} ms, max {:.1f} ms, {} dropped frames'
+                    .format(window, summary['mean'], summary['max'], summary['dropped']))
+            results.setdefault('flips', {})[name] = {'frame loop p50 (ms)':np.median(frameTimes)*1e3,
+                                                    'dropped':dict((w, windows[w]['dropped']) for w in windows)}
+
+    if args.suite in ('all','input'):
+        print('waiting for 40 key presses from another thread, 50 ms apart on average')
+        for mode in ('spin', 'poll 1 ms', 'event-driven'):
+            inputResults = benchmark_input(mode)
+            print('{:<12} CPU {:5.1f}%, key read after p50 {:.2f} ms (max {:.2f} ms), timestamp error max {:.3f} ms'
+                .format(mode, inputResults['cpu (%)'], inputResults['read delay p50 (ms)'],
+                        inputResults['read delay max (ms)'], inputResults['timestamp error max (ms)']))
+            results.setdefault('input', {})[mode] = inputResults
+
+    if args.suite in ('all','audio'):
+        if args.audio_driver is not None:
+            os.environ['SDL_AUDIODRIVER'] = args.audio_driver
+        print('onset lag of a 100 ms tone, timed from play() to the mixer finishing with it')
+        configurations = [('pygame {} Hz, {} samples' .format(frequency, bufferSize), PygameAudio(frequency, bufferSize))
+                        for frequency in (44100, 48000) for bufferSize in (256, 512, 1024, 2048)]
+        if sounddevice is not None:
+            configurations += [('sounddevice 48000 Hz, {} samples' .format(bufferSize), SoundDeviceAudio(48000, bufferSize))
+                            for bufferSize in (64, 128, 256)]
+        for (name,audio) in configurations:
+            audioResults = benchmark_audio(audio)
+            print('{:<34} estimate {:5.1f} +/- {:4.1f} ms, measured {:5.1f} ms, jitter sd {:4.2f} ms (range {:4.1f} ms), play() {:5.1f} us'
+                .format(name, audioResults['estimated latency (ms)'], audioResults['estimated uncertainty (ms)'],
+                        audioResults['measured lag mean (ms)'], audioResults['measured jitter sd (ms)'],
+                        audioResults['measured lag range (ms)'], audioResults['play() call p50 (us)']))
+            results.setdefault('audio', {})[name] = audioResults
+
+    if args.suite in ('all','markers'):
+        print('500 logged events 1 ms apart streamed to a stand-in receiver on this machine')
+        for protocol in ('udp','tcp'):
+            markerResults = benchmark_markers(protocol)
+            print('{}  logEvent p50 {:.1f} us (p99 {:.1f} us), logged to received p50 {:.0f} us (p99 {:.0f} us, max {:.0f} us), {} lost, {} out of order'
+                .format(protocol, markerResults['logEvent p50 (us)'], markerResults['logEvent p99 (us)'],
+                        markerResults['received latency p50 (us)'], markerResults['received latency p99 (us)'],
+                        markerResults['received latency max (us)'], markerResults['lost'], markerResults['out of order']))
+            results.setdefault('markers', {})[protocol] = markerResults
+
+    if args.suite in ('all','sequences'):
+        print('trial and button orders for 6 cues x 10, no cue twice in a row')
+        for nCandidates in (100, 1000, 10000):
+            sequenceResults = benchmark_sequences(nCandidates)
+            print('{:5d} candidates  generate p50 {:.1f} ms (max {:.1f} ms), cued button position spread {:.2f} trials'
+                .format(nCandidates, sequenceResults['generate p50 (ms)'], sequenceResults['generate max (ms)'],
+                        sequenceResults['cued position spread mean']))
+            results.setdefault('sequences', {})[nCandidates] = sequenceResults
+
+    if args.suite in ('all','events'):
+        eventResults = benchmark_events()
+        print('EventIndex: {} events indexed at p50 {:.1f} us (p99 {:.1f} us, p50 of the last 1000 {:.1f} us), 4 queries p50 {:.1f} us'
+            .format(eventResults['events'], eventResults['index p50 (us)'], eventResults['index p99 (us)'],
+                    eventResults['index last 1000 p50 (us)'], eventResults['4 queries p50 (us)']))
+        results['events'] = eventResults
+
+    if args.output:
+        json.dump(to_json(results), open(args.output, 'w'), indent=1)
@@ -0,0 +1,218 @@
+import numpy as np
+import os, json, threading, struct, wave
+
+## session files that analysis needs as well as the experiment, without psychopy or pygame:
+## the columnar data store and WAV reading and writing
+
+class ColumnarStore():
+    ## tables of typed columns in a folder, each column a raw little-endian array file that grows as rows are
+    ## appended and can be opened with np.memmap at any time, even during the session. number columns are
+    ## float64, with a uint8 column marking which values were ints; str columns are int32 ids into a table
+    ## of unique strings, strings.jsonl. export_csv writes back exactly the text DataFileCollection's CSV
+    ## files would have had. Opening in mode 'a' drops any rows cut short by a crash
+    kinds = {'number':[('', '<f8'), ('.int', 'u1')], 'str':[('', '<i4')]}
+    
+    def __init__(self,folder,mode='a'):
+        self.folder = folder
+        self.mode = mode
+        self.lock = threading.Lock() # logEvent can be called from other threads
+        self.schemaFilename = os.path.join(folder, 'schema.json')
+        if mode == 'a':
+            os.makedirs(folder, exist_ok=True)
+        self.schema = json.load(open(self.schemaFilename)) if os.path.exists(self.schemaFilename) else {}
+        self.strings = []
+        self.stringsFilename = os.path.join(folder, 'strings.jsonl')
+        if os.path.exists(self.stringsFilename):
+            for line in open(self.stringsFilename):
+                if not line.endswith('\n'):
+                    break
+                self.strings.append(json.loads(line))
+        self.stringIds = dict((string, n) for (n,string) in enumerate(self.strings))
+        self.files = {}
+        self.nRows = {}
+        for table in self.schema:
+            self.nRows[table] = self._countRows(table)
+        if mode == 'a':
+            ## start the strings file after the last whole string
+            with open(self.stringsFilename, 'ab') as stringsFile:
+                stringsFile.truncate(len(''.join(json.dumps(string) + '\n' for string in self.strings).encode()))
+            for table in self.schema:
+                self.truncate(table, self.nRows[table])
+    
+    def _filenames(self,table,n):
+        ## (filename, dtype) of each file of column n
+        kind = self.schema[table]['kinds'][n]
+        if kind is None:
+            return []
+        return [(os.path.join(self.folder, '{}-{}{}.bin' .format(table, n, suffix)), dtype) for (suffix,dtype) in self.kinds[kind]]
+    
+    def _countRows(self,table):
+        ## whole rows in every column, and only those whose strings are all in the string table
+        nRows = None
+        for n in range(len(self.schema[table]['columns'])):
+            for (filename,dtype) in self._filenames(table, n):
+                size = os.path.getsize(filename) if os.path.exists(filename) else 0
+                rows = size // np.dtype(dtype).itemsize
+                nRows = rows if nRows is None else min(nRows, rows)
+        nRows = nRows or 0
+        for n in range(len(self.schema[table]['columns'])):
+            if self.schema[table]['kinds'][n] == 'str' and nRows:
+                ids = np.fromfile(self._filenames(table, n)[0][0], dtype='<i4', count=nRows)
+                missing = np.flatnonzero(ids >= len(self.strings))
+                if len(missing):
+                    nRows = int(missing[0])
+        return nRows
+    
+    def _saveSchema(self):
+        temporary = self.schemaFilename + '.tmp'
+        json.dump(self.schema, open(temporary, 'w'))
+        os.replace(temporary, self.schemaFilename)
+    
+    def createTable(self,table,columns):
+        ## column kinds are set by the first row appended; an existing table is carried on
+        if table not in self.schema:
+            self.schema[table] = {'columns':list(columns), 'kinds':[None]*len(columns)}
+            self.nRows[table] = 0
+            self._saveSchema()
+    
+    def _file(self,filename):
+        if filename not in self.files:
+            self.files[filename] = open(filename, 'ab')
+        return self.files[filename]
+    
+    def _intern(self,value):
+        string = '{}' .format(value)
+        if string not in self.stringIds:
+            self.stringIds[string] = len(self.strings)
+            self.strings.append(string)
+            self._file(self.stringsFilename).write((json.dumps(string) + '\n').encode())
+        return self.stringIds[string]
+    
+    def _promote(self,table,n):
+        ## a number column given a string becomes a str column of the numbers' text
+        text = self._format(table, n, self.nRows[table])
+        for (filename,dtype) in self._filenames(table, n):
+            if filename in self.files:
+                self.files.pop(filename).close()
+            os.remove(filename)
+        self.schema[table]['kinds'][n] = 'str'
+        self._saveSchema()
+        ids = np.array([self._intern(string) for string in text], dtype='<i4')
+        self._file(self._filenames(table, n)[0][0]).write(ids.tobytes())
+    
+    def append(self,table,row):
+        with self.lock:
+            kinds = self.schema[table]['kinds']
+            for (n,value) in enumerate(row):
+                isNumber = isinstance(value, (int, float, np.integer, np.floating)) and not isinstance(value, (bool, np.bool_))
+                if kinds[n] is None:
+                    kinds[n] = 'number' if isNumber else 'str'
+                    self._saveSchema()
+                elif kinds[n] == 'number' and not isNumber:
+                    self.flush()
+                    self._promote(table, n)
+                files = self._filenames(table, n)
+                if kinds[n] == 'number':
+                    self._file(files[0][0]).write(struct.pack('<d', value))
+                    self._file(files[1][0]).write(struct.pack('B', isinstance(value, (int, np.integer))))
+                else:
+                    self._file(files[0][0]).write(struct.pack('<i', self._intern(value)))
+            self.nRows[table] += 1
+    
+    def truncate(self,table,nRows):
+        with self.lock:
+            for n in range(len(self.schema[table]['columns'])):
+                for (filename,dtype) in self._filenames(table, n):
+                    if filename in self.files:
+                        self.files.pop(filename).close()
+                    with open(filename, 'ab') as columnFile:
+                        columnFile.truncate(nRows * np.dtype(dtype).itemsize)
+            self.nRows[table] = nRows
+    
+    def column(self,table,name):
+        ## number columns as float64 memmaps, without copying; str columns as an array of ids and the strings
+        n = self.schema[table]['columns'].index(name)
+        files = self._filenames(table, n)
+        if not files or self.nRows[table] == 0:
+            return np.zeros(0) if not files or self.schema[table]['kinds'][n] == 'number' else (np.zeros(0, dtype='<i4'), self.strings)
+        values = np.memmap(files[0][0], dtype=files[0][1], mode='r', shape=(self.nRows[table],))
+        if self.schema[table]['kinds'][n] == 'number':
+            return values
+        return (values, self.strings)
+    
+    def text(self,table,name):
+        ## a column as an array of strings
+        return np.array(self._format(table, self.schema[table]['columns'].index(name), self.nRows[table]), dtype=str)
+    
+    def _format(self,table,n,nRows):
+        ## the text of each value, as '{}' .format(value) gave when it was appended
+        files = self._filenames(table, n)
+        if not files or nRows == 0:
+            return []
+        if self.schema[table]['kinds'][n] == 'number':
+            values = np.fromfile(files[0][0], dtype='<f8', count=nRows)
+            isInt = np.fromfile(files[1][0], dtype='u1', count=nRows)
+            return ['{}' .format(int(value)) if integer else '{}' .format(value) for (value,integer) in zip(values.tolist(), isInt)]
+        ids = np.fromfile(files[0][0], dtype='<i4', count=nRows)
+        return [self.strings[i] for i in ids]
+    
+    def rows(self,table):
+        ## every row as a list of strings
+        columns = [self._format(table, n, self.nRows[table]) for n in range(len(self.schema[table]['columns']))]
+        return [list(row) for row in zip(*columns)]
+    
+    def flush(self):
+        ## strings before the columns that refer to them
+        if self.stringsFilename in self.files:
+            self.files[self.stringsFilename].flush()
+        for columnFile in self.files.values():
+            columnFile.flush()
+    
+    def close(self):
+        with self.lock:
+            self.flush()
+            for columnFile in self.files.values():
+                columnFile.close()
+            self.files = {}
+
+def export_csv(fileprefix,outputPrefix=None):
+    ## _data.csv, _log.csv and _timing.csv from a session's fileprefix_columns store, in DataFileCollection's layout
+    store = ColumnarStore(fileprefix+'_columns', mode='r')
+    outputPrefix = outputPrefix or fileprefix
+    with open(outputPrefix+'_data.csv', 'w') as dataFile:
+        for row in [store.schema['data']['columns']] + store.rows('data'):
+            dataFile.write(','.join(row) + '\n')
+    with open(outputPrefix+'_log.csv', 'w') as logFile:
+        logFile.write('time,event\n')
+        for (eventTime,eventText) in store.rows('log'):
+            logFile.write('{},"{}"\n' .format(eventTime, eventText))
+    with open(outputPrefix+'_timing.csv', 'w') as timingFile:
+        timingFile.write('time,event,scheduled,error bound\n')
+        for (eventTime,eventText,scheduled,errorBound) in store.rows('timing'):
+            timingFile.write('{},"{}",{},{}\n' .format(eventTime, eventText, scheduled, errorBound))
+
+
+def read_wav(filename):
+    ## samples as floats in -1..1, one column per channel, and the sample rate
+    wavFile = wave.open(filename, 'rb')
+    (nChannels,sampleWidth,frameRate,nFrames) = wavFile.getparams()[0:4]
+    frames = wavFile.readframes(nFrames)
+    wavFile.close()
+    if sampleWidth == 1:
+        samples = (np.frombuffer(frames, dtype=np.uint8).astype(np.float32) - 128) / 128
+    elif sampleWidth in (2,4):
+        dtype = {2:'<i2', 4:'<i4'}[sampleWidth]
+        samples = np.frombuffer(frames, dtype=dtype).astype(np.float32) / 2**(8*sampleWidth-1)
+    else:
+        raise ValueError('unsupported sample width {} in {}' .format(sampleWidth, filename))
+    return (samples.reshape(-1, nChannels), frameRate)
+
+def write_wav(filename,samples,frameRate):
+    ## samples as floats in -1..1, one column per channel, saved as 16-bit PCM
+    frames = np.round(np.clip(samples, -1, 1) * 32767).astype('<i2')
+    wavFile = wave.open(filename, 'wb')
+    wavFile.setnchannels(frames.shape[1])
+    wavFile.setsampwidth(2)
+    wavFile.setframerate(frameRate)
+    wavFile.writeframes(frames.tobytes())
+    wavFile.close()
@@ -0,0 +1,89 @@
+from touchcomm import longest_run
+import numpy as np
+import argparse, contextlib, glob, multiprocessing, os, runpy, sys, time
+
+## batch-run simulated participants through an experiment script (--simulate mode)
+## and check the trial randomisation and logging throughput
+
+scripts = {'communication':'Experiment-TouchCommCues-ASD-communication.py',
+            'pleasantness':'Experiment-TouchCommCues-ASD-pleasantness.py'}
+
+def run_session(sessionArgs):
+    (script,seed,folder) = sessionArgs
+    sys.argv = [script, '--simulate',
+                '--seed', str(seed),
+                '--participant', 'sim{:05d}' .format(seed),
+                '--folder', folder]
+    startTime = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        try:
+            runpy.run_path(script, run_name='__main__')
+        except SystemExit:
+            pass
+    return (seed, time.perf_counter() - startTime)
+
+def read_session(prefix):
+    dataLines = open(prefix+'_data.csv').read().splitlines()[1:]
+    cued = [line.split(',')[1] for line in dataLines]
+    nLogLines = sum(1 for line in open(prefix+'_log.csv')) - 1
+    return (cued, nLogLines)
+
+def check_randomisation(sessions):
+    ## every cue equally often in each session, and no cue favoured at any trial position
+    cues = sorted(set(sessions[0]))
+    nTrials = len(sessions[0])
+    counts = np.zeros((nTrials, len(cues)))
+    unbalanced = 0
+    longest = 0
+    for cued in sessions:
+        if len(cued) != nTrials:
+            unbalanced += 1
+            continue
+        cueN = np.array([cues.index(c) for c in cued])
+        longest = max(longest, int(longest_run(cueN)[0]))
+        perCue = np.bincount(cueN, minlength=len(cues))
+        unbalanced += int(perCue.min() != perCue.max())
+        counts[np.arange(nTrials), cueN] += 1
+    expected = counts.sum(axis=1, keepdims=True) / len(cues)
+    chiSquare = ((counts - expected)**2 / expected).sum()
+    dof = nTrials * (len(cues) - 1)
+    return (unbalanced, chiSquare, dof, longest)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('experiment', choices=sorted(scripts))
+    parser.add_argument('-n', '--participants', type=int, default=100)
+    parser.add_argument('--first-seed', type=int, default=0)
+    parser.add_argument('--folder', default='data-simulated')
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count())
+    args = parser.parse_args()
+
+    seeds = range(args.first_seed, args.first_seed + args.participants)
+    startTime = time.perf_counter()
+    pool = multiprocessing.Pool(args.processes)
+    sessionTimes = []
+    for (seed,sessionTime) in pool.imap_unordered(run_session, [(scripts[args.experiment], seed, args.folder) for seed in seeds]):
+        sessionTimes += [sessionTime]
+    pool.close()
+    wallTime = time.perf_counter() - startTime
+
+    sessions = []
+    nLogLines = 0
+    for seed in seeds:
+        prefixes = glob.glob('./{}/*_Psim{:05d}_data.csv' .format(args.folder, seed))
+        if not prefixes:
+            print('session {} wrote no data' .format(seed))
+            continue
+        (cued, nLog) = read_session(sorted(prefixes)[-1][:-len('_data.csv')])
+        sessions += [cued]
+        nLogLines += nLog
+
+    print('{} sessions in {:.1f} s ({:.2f} s per session per process)'
+        .format(len(sessions), wallTime, np.mean(sessionTimes)))
+    print('{} log events, {:.0f} events/s' .format(nLogLines, nLogLines / wallTime))
+    if sessions:
+        (unbalanced, chiSquare, dof, longest) = check_randomisation(sessions)
+        print('{} sessions with unbalanced cues' .format(unbalanced))
+        print('longest run of one cue: {} trials' .format(longest))
+        print('cue by trial position: chi-square {:.1f} on {} df' .format(chiSquare, dof))
@@ -0,0 +1,34 @@
+import glob, os, subprocess, sys
+import numpy as np
+from analysis import sync_pulse_times, write_aligned_log
+
+## aligning a session saved as CSV and the same session saved only in a columnar store
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def run_session(folder,storage):
+    subprocess.run([sys.executable, 'Experiment-TouchCommCues-ASD-pleasantness.py', '--headless', '--simulate',
+                    '--seed', '3', '--participant', 'ci', '--folder', os.path.relpath(folder, repo),
+                    '--sync-pulses', '--storage', storage],
+                    cwd = repo, check = True, timeout = 600,
+                    stdout = subprocess.DEVNULL,
+                    env = dict(os.environ, SDL_AUDIODRIVER = 'dummy'))
+    (infoFilename,) = glob.glob(os.path.join(folder, '*_Pci_info.csv'))
+    return infoFilename[:-len('_info.csv')]
+
+def test_align_columnar_session(tmp_path):
+    csvPrefix = run_session(str(tmp_path / 'csv'), 'csv')
+    columnarPrefix = run_session(str(tmp_path / 'columnar'), 'columnar')
+    assert not os.path.exists(columnarPrefix+'_timing.csv')
+
+    pulseTimes = sync_pulse_times(csvPrefix)
+    ## a pulse at the start, at every trial and at the end
+    assert len(pulseTimes) == 8
+    assert np.array_equal(sync_pulse_times(columnarPrefix), pulseTimes)
+
+    alignment = {'offset':2.5, 'drift':1e-5}
+    write_aligned_log(csvPrefix, alignment, str(tmp_path / 'csv-aligned.csv'))
+    write_aligned_log(columnarPrefix, alignment, str(tmp_path / 'columnar-aligned.csv'))
+    aligned = open(str(tmp_path / 'csv-aligned.csv')).read()
+    assert aligned.count('\n') == len(open(csvPrefix+'_log.csv').read().splitlines())
+    assert open(str(tmp_path / 'columnar-aligned.csv')).read() == aligned
@@ -0,0 +1,55 @@
+import csv, threading
+import pytest
+from touchcomm import DataFileCollection
+from sessionfiles import ColumnarStore
+
+## events logged from several threads at once, as the sync pulses do during a trial
+
+@pytest.mark.parametrize('storage', ['csv', 'both'])
+@pytest.mark.parametrize('buffered', [False, True])
+def test_events_from_several_threads_in_one_order(storage,buffered,tmp_path,monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    files = DataFileCollection('data', 'test', ['trial'], {}, buffered=buffered, storage=storage)
+    seen = []
+    files.addListener(lambda time,event: seen.append(event))
+    def log(threadN):
+        for n in range(500):
+            files.logEvent(n, 'thread {} event {}' .format(threadN, n))
+    threads = [threading.Thread(target=log, args=(threadN,)) for threadN in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    files.close()
+    ## written straight through once closed
+    files.logEvent(500, 'after close')
+    
+    logged = [row[1] for row in csv.reader(open(files.fileprefix+'_log.csv'))]
+    assert logged[0] == 'event'
+    assert len(logged) == 2002
+    assert logged[1:] == seen
+    if storage == 'both':
+        store = ColumnarStore(files.fileprefix+'_columns', mode='r')
+        assert [row[1] for row in store.rows('log')] == seen
+
+class FullDisk():
+    ## a file that can't be written to
+    def write(self,line):
+        raise OSError(28, 'No space left on device')
+    
+    def close(self):
+        pass
+
+def test_writer_failure_raised_in_caller(tmp_path,monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    files = DataFileCollection('data', 'test', ['trial'], {}, buffered=True)
+    files.writer.files[files.fileprefix+'_log.csv'] = FullDisk()
+    files.logEvent(0, 'lost')
+    ## the writing thread has stopped, so flush returns and raises what stopped it, once
+    with pytest.raises(OSError):
+        files.flush()
+    assert not files.writer.thread.is_alive()
+    ## then the writer counts as closed, and events are written straight to the files
+    files.logEvent(1, 'written')
+    files.close()
+    assert [row[1] for row in csv.reader(open(files.fileprefix+'_log.csv'))] == ['event', 'written']
@@ -0,0 +1,50 @@
+import csv, glob, os, subprocess, sys
+import pytest
+
+## both experiments end to end, offscreen on a virtual clock with scripted responses,
+## as in CI: no display, no GPU, no sound card and no psychopy needed
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+scripts = {'communication':('Experiment-TouchCommCues-ASD-communication.py', 60),
+            'pleasantness':('Experiment-TouchCommCues-ASD-pleasantness.py', 6)}
+
+def run_session(script,folder,seed):
+    ## the scripts save to ./<folder>/ and read ./sounds and ./text, so run them from the repo
+    subprocess.run([sys.executable, script, '--headless', '--simulate',
+                    '--seed', str(seed), '--participant', 'ci',
+                    '--folder', os.path.relpath(folder, repo)],
+                    cwd = repo, check = True, timeout = 600,
+                    stdout = subprocess.DEVNULL,
+                    env = dict(os.environ, SDL_AUDIODRIVER = 'dummy'))
+    (dataFilename,) = glob.glob(os.path.join(folder, '*_Pci_data.csv'))
+    fileprefix = dataFilename[:-len('_data.csv')]
+    data = list(csv.reader(open(fileprefix+'_data.csv')))
+    log = list(csv.reader(open(fileprefix+'_log.csv')))
+    return (data, log)
+
+@pytest.mark.parametrize('experiment', sorted(scripts))
+def test_headless_session(experiment,tmp_path):
+    (script,nTrials) = scripts[experiment]
+    (data,log) = run_session(script, str(tmp_path / 'a'), 7)
+
+    ## a data row for every trial, every cue equally often
+    assert data[0][0:2] == ['trial', 'cued']
+    assert [int(row[0]) for row in data[1:]] == list(range(1, nTrials+1))
+    cued = [row[1] for row in data[1:]]
+    assert len(set(cued.count(cue) for cue in set(cued))) == 1
+    assert all(row[2] != '' for row in data[1:])
+
+    ## the log runs from start to finish on one clock, with every trial's events
+    assert log[0] == ['time', 'event']
+    events = [row[1] for row in log[1:]]
+    times = [float(row[0]) for row in log[1:]]
+    assert events[0] == 'experiment started'
+    assert events[-1] == 'experiment finished'
+    assert times == sorted(times)
+    for event in ['countdown to touch', 'start touching', 'stop touching']:
+        assert events.count(event) == nTrials
+    assert events.count('{} of {} complete' .format(nTrials, nTrials)) == 1
+    assert [event for event in events if event.startswith('toucher cue ')] == ['toucher cue ' + cue for cue in cued]
+
+    ## the same seed gives the same session
+    assert run_session(script, str(tmp_path / 'b'), 7) == (data, log)
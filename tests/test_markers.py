@@ -0,0 +1,142 @@
+import json, socket, threading, time
+import numpy as np
+import pytest
+from touchcomm import MarkerStream
+
+## MarkerStream against a stand-in acquisition system on this machine
+
+class Receiver():
+    ## keeps (time received, marker) for every marker sent to address
+    def __init__(self,protocol,port=0):
+        self.protocol = protocol
+        self.received = []
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM if protocol == 'udp' else socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(('127.0.0.1', port))
+        if protocol == 'tcp':
+            self.socket.listen(1)
+        self.address = '{}://127.0.0.1:{}' .format(protocol, self.socket.getsockname()[1])
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        if self.protocol == 'udp':
+            while True:
+                data = self.socket.recv(65536)
+                if not data:
+                    break
+                self.received.append((time.perf_counter(), json.loads(data.decode('utf-8'))))
+            return
+        (connection,address) = self.socket.accept()
+        buffered = b''
+        while True:
+            data = connection.recv(65536)
+            if not data:
+                break
+            receivedAt = time.perf_counter()
+            lines = (buffered + data).split(b'\n')
+            buffered = lines.pop()
+            self.received += [(receivedAt, json.loads(line.decode('utf-8'))) for line in lines]
+        connection.close()
+
+    def wait(self,n,timeout=5.0):
+        deadline = time.perf_counter() + timeout
+        while len(self.received) < n and time.perf_counter() < deadline:
+            time.sleep(0.01)
+
+    def close(self):
+        if self.protocol == 'udp':
+            ## an empty datagram stops the receiving thread
+            self.socket.sendto(b'', self.socket.getsockname())
+        self.thread.join(1.0)
+        self.socket.close()
+
+def free_port():
+    ## a port with nothing listening on it, so connecting is refused
+    probe = socket.socket()
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    return port
+
+
+@pytest.mark.parametrize('protocol', ['udp', 'tcp'])
+def test_markers_in_order_without_loss(protocol):
+    nEvents = 500
+    receiver = Receiver(protocol)
+    markers = MarkerStream(receiver.address)
+    loggedAt = {}
+    for n in range(nEvents):
+        loggedAt[n+1] = time.perf_counter()
+        markers(n * 0.001, 'event {}' .format(n))
+        time.sleep(0.001)
+    markers.close()
+    receiver.wait(nEvents)
+    receiver.close()
+
+    received = [marker for (receivedAt,marker) in receiver.received]
+    assert [marker['seq'] for marker in received] == list(range(1, nEvents+1))
+    assert [marker['event'] for marker in received] == ['event {}' .format(n) for n in range(nEvents)]
+    assert (markers.nSent, markers.nFailed) == (nEvents, 0)
+
+    ## logged to received, on this machine
+    latency = np.array([receivedAt - loggedAt[marker['seq']] for (receivedAt,marker) in receiver.received])
+    assert np.median(latency) < 0.01
+    assert latency.max() < 0.5
+    assert len(markers.sendLatency) == nEvents
+
+def test_markers_from_several_threads_keep_unique_seq():
+    receiver = Receiver('tcp')
+    markers = MarkerStream(receiver.address)
+    def log(threadN):
+        for n in range(500):
+            markers(n, 'thread {}' .format(threadN))
+    threads = [threading.Thread(target=log, args=(threadN,)) for threadN in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    markers.close()
+    receiver.wait(2000)
+    receiver.close()
+    assert [marker['seq'] for (receivedAt,marker) in receiver.received] == list(range(1, 2001))
+
+def test_markers_back_off_then_reconnect():
+    port = free_port()
+    markers = MarkerStream('tcp://127.0.0.1:{}' .format(port), retryDelay=0.2, maxRetryDelay=0.4)
+    ## nothing listening: the first marker fails, and those logged while backing off are dropped
+    ## without trying to connect again
+    markers(0.0, 'lost 0')
+    deadline = time.perf_counter() + 2.0
+    while markers.nFailed < 1 and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    for n in range(1, 100):
+        markers(n * 0.001, 'lost {}' .format(n))
+    deadline = time.perf_counter() + 2.0
+    while markers.nFailed < 100 and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    assert (markers.nSent, markers.nFailed) == (0, 100)
+    assert markers.retryDelay == 0.4 # doubled after the failure
+
+    ## once the receiver is up and the back-off has passed, markers get through again
+    receiver = Receiver('tcp', port)
+    time.sleep(0.3)
+    for n in range(10):
+        markers(1 + n * 0.001, 'sent {}' .format(n))
+    receiver.wait(10)
+    markers.close()
+    receiver.close()
+    assert [marker['event'] for (receivedAt,marker) in receiver.received] == ['sent {}' .format(n) for n in range(10)]
+    assert [marker['seq'] for (receivedAt,marker) in receiver.received] == list(range(101, 111))
+    assert markers.retryDelay == 0.2 # reset by the successful send
+
+def test_markers_close_promptly_when_unreachable():
+    markers = MarkerStream('tcp://127.0.0.1:{}' .format(free_port()), retryDelay=10.0)
+    for n in range(1000):
+        markers(n * 0.001, 'event {}' .format(n))
+    startTime = time.perf_counter()
+    markers.close()
+    assert time.perf_counter() - startTime < 2.5
+    assert not markers.thread.is_alive()
+    assert markers.nSent == 0
@@ -0,0 +1,62 @@
+import time
+import numpy as np
+import pytest
+from touchcomm import SensorCapture, SyntheticSensor
+
+## SensorCapture with the synthetic source, timed on this machine's clock
+
+class Clock():
+    def __init__(self):
+        self.startTime = time.perf_counter()
+    
+    def getTime(self):
+        return time.perf_counter() - self.startTime
+
+class FailingSensor(SyntheticSensor):
+    ## stops working after the first read, like an unplugged device
+    def read(self):
+        if self.nRead > 0:
+            raise IOError('sensor unplugged')
+        return SyntheticSensor.read(self)
+
+def test_trials_run_up_to_end_without_gaps(tmp_path):
+    clock = Clock()
+    capture = SensorCapture(SyntheticSensor(clock), str(tmp_path / 'test'), clock)
+    capture.start()
+    trialData = []
+    for trial in range(1, 4):
+        capture.startTrial(trial)
+        time.sleep(0.2)
+        calledAt = clock.getTime()
+        filename = capture.endTrial()
+        ## waited only for the capture thread to catch up
+        assert clock.getTime() - calledAt < 0.1
+        trialData.append(np.load(filename, mmap_mode='r'))
+        assert trialData[-1]['time'][-1] > calledAt - 0.01
+    capture.close()
+    times = np.concatenate([data['time'] for data in trialData])
+    assert np.allclose(np.diff(times), 1.0/capture.source.rate)
+    assert capture.lost == 0
+
+def test_no_wait_on_virtual_time(tmp_path):
+    clock = Clock()
+    capture = SensorCapture(SyntheticSensor(clock), str(tmp_path / 'test'), clock, virtualTime=True)
+    ## nothing is captured before the thread starts, but endTrial doesn't wait for it
+    capture.startTrial(1)
+    calledAt = time.perf_counter()
+    data = np.load(capture.endTrial())
+    assert time.perf_counter() - calledAt < 0.1
+    assert len(data) == 0
+
+@pytest.mark.filterwarnings('ignore::pytest.PytestUnhandledThreadExceptionWarning')
+def test_no_wait_after_the_source_fails(tmp_path):
+    clock = Clock()
+    capture = SensorCapture(FailingSensor(clock), str(tmp_path / 'test'), clock)
+    capture.start()
+    capture.thread.join(1.0)
+    assert not capture.running
+    capture.startTrial(1)
+    time.sleep(0.05)
+    calledAt = time.perf_counter()
+    capture.endTrial()
+    assert time.perf_counter() - calledAt < 0.1
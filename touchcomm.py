@@ -1,93 +1,1712 @@
-from psychopy import visual, event, core
 import numpy as np
-import random, os, pygame, time, math
+import random, os, sys, pygame, time, math, threading, atexit, queue, collections, argparse
+import wave, json, hashlib, socket, http.server
+from sessionfiles import ColumnarStore, read_wav, write_wav
+try:
+    from psychopy import visual, event, core
+except ImportError: ## only needed for PsychoPyBackend, headless sessions run without it, e.g. in CI
+    visual = event = core = None
+try:
+    import pyglet
+except ImportError: ## no pyglet windows to wait on, input waits fall back to short sleeps
+    pyglet = None
+try:
+    import sounddevice
+except (ImportError, OSError): ## only needed for the sounddevice audio backend, OSError if PortAudio is missing
+    sounddevice = None
+
+class BufferedFileWriter():
+    ## appends lines to files from a background thread so the caller never waits on disk
+    def __init__(self,filenames,flushEvery,flushInterval,fsync):
+        self.flushEvery = flushEvery # flush after this many lines
+        self.flushInterval = flushInterval # or after this many seconds, whichever comes first
+        self.fsync = fsync
+        self.files = dict((name, open(name, 'a')) for name in filenames)
+        self.queue = queue.Queue()
+        self.closed = False
+        self.error = None # what stopped the writing thread, raised in the caller by the next write, flush or close
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def write(self,filename,line,echo=None):
+        self.raiseError()
+        self.queue.put((filename,line,echo))
+    
+    def flush(self):
+        ## blocks until everything queued so far is on disk, or the writing thread has stopped
+        self.raiseError()
+        done = threading.Event()
+        self.queue.put(done)
+        while not done.wait(0.1):
+            if not self.thread.is_alive():
+                break
+        self.raiseError()
+    
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+        self.raiseError()
+    
+    def raiseError(self):
+        ## once raised, the writer counts as closed, so DataFileCollection writes straight to the files
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            self.closed = True
+            raise error
+    
+    def _flushFiles(self):
+        for f in self.files.values():
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+    
+    def _run(self):
+        try:
+            self._writeQueued()
+        except Exception as error:
+            ## e.g. the disk is full: anything still queued is lost
+            self.error = error
+        finally:
+            for f in self.files.values():
+                try:
+                    f.close()
+                except Exception:
+                    pass
+    
+    def _writeQueued(self):
+        pending = 0
+        lastFlush = time.time()
+        while True:
+            timeout = max(0, lastFlush + self.flushInterval - time.time())
+            try:
+                item = self.queue.get(timeout=timeout if pending else None)
+            except queue.Empty:
+                item = False # flush interval elapsed
+            if item is None or isinstance(item, threading.Event):
+                self._flushFiles()
+                pending = 0
+                lastFlush = time.time()
+                if item is None:
+                    break
+                item.set()
+                continue
+            if item:
+                (filename,line,echo) = item
+                self.files[filename].write(line)
+                if echo is not None:
+                    print(echo)
+                pending += 1
+            if pending >= self.flushEvery or (pending and time.time() - lastFlush >= self.flushInterval):
+                self._flushFiles()
+                pending = 0
+                lastFlush = time.time()
 
 class DataFileCollection():
-    def __init__(self,foldername,filename,headers,dlgInput):
+    def __init__(self,foldername,filename,headers,dlgInput,buffered=False,flushEvery=20,flushInterval=0.5,fsync=True,
+                resumeRows=None,storage='csv'):
         self.folder = './'+foldername+'/'
         if not os.path.exists(self.folder):
-            os.makedirs(self.folder)
+            os.makedirs(self.folder, exist_ok=True)
         self.fileprefix = self.folder + filename
+        self.writer = None
+        ## events are logged from other threads too (sync pulses), so each is written to the files and the
+        ## store and passed to the listeners under one lock, in the same order everywhere, and not during close
+        self.lock = threading.RLock()
+        self.closed = False
+        self.listeners = [] # called with (time, event) for every logged event
+        self.timingListeners = [] # called with (time, event, scheduled, error bound) for every timed event
+        ## resuming a session (resumeRows = the trials already done, from its journal) carries on
+        ## the log and timing files, and rewrites the data file from the journal
+        resuming = resumeRows is not None
         
-        self.infoFile = open(self.fileprefix+'_info.csv', 'w') 
-        for k,v in dlgInput.items(): 
-            self.infoFile.write('"{}","{}"\n' .format(k, v))
-        self.infoFile.close()
+        if not resuming:
+            self.infoFile = open(self.fileprefix+'_info.csv', 'w') 
+            for k,v in dlgInput.items(): 
+                self.infoFile.write('"{}","{}"\n' .format(k, v))
+            self.infoFile.close()
         
-        self.dataFile = open(self.fileprefix+'_data.csv', 'w')
-        self.writeTrialData(headers)
-        self.dataFile.close()
+        ## storage is 'csv', 'columnar' (a ColumnarStore in fileprefix_columns, see export_csv) or 'both'
+        self.writeCSV = storage in ('csv','both')
+        self.store = None
+        if storage in ('columnar','both'):
+            self.store = ColumnarStore(self.fileprefix+'_columns')
+            self.store.createTable('data', headers)
+            self.store.createTable('log', ['time','event'])
+            self.store.createTable('timing', ['time','event','scheduled','error bound'])
+            self.store.truncate('data', 0)
+            for row in (resumeRows or []):
+                self.store.append('data', row)
+            self.store.flush()
+            atexit.register(self.close)
         
-        self.logFile = open(self.fileprefix+'_log.csv', 'w')
-        self.logFile.write('time,event\n')
-        self.logFile.close()
+        if self.writeCSV:
+            self.dataFile = open(self.fileprefix+'_data.csv', 'w')
+            for row in [headers] + (resumeRows or []):
+                self.dataFile.write(self._formatRow(row))
+            self.dataFile.close()
+            
+            if not (resuming and os.path.exists(self.fileprefix+'_log.csv')):
+                self.logFile = open(self.fileprefix+'_log.csv', 'w')
+                self.logFile.write('time,event\n')
+                self.logFile.close()
+            
+            ## when audio events were heard, when they were scheduled, and the error bound on the time heard
+            if not (resuming and os.path.exists(self.fileprefix+'_timing.csv')):
+                self.timingFile = open(self.fileprefix+'_timing.csv', 'w')
+                self.timingFile.write('time,event,scheduled,error bound\n')
+                self.timingFile.close()
+        
+        ## in buffered mode a background thread keeps the data and log files open
+        if buffered and self.writeCSV:
+            self.writer = BufferedFileWriter([self.fileprefix+'_data.csv', self.fileprefix+'_log.csv', self.fileprefix+'_timing.csv'],
+                                            flushEvery, flushInterval, fsync)
+            atexit.register(self.close)
+    
+    def _append(self,suffix,line,echo=None):
+        if not self.writeCSV:
+            if echo is not None:
+                print(echo)
+        elif self.writer is not None and not self.writer.closed:
+            self.writer.write(self.fileprefix+suffix, line, echo)
+        else:
+            outFile = open(self.fileprefix+suffix, 'a')
+            outFile.write(line)
+            outFile.close()
+            if echo is not None:
+                print(echo)
+    
+    def addListener(self,listener):
+        self.listeners.append(listener)
+    
+    def addTimingListener(self,listener):
+        self.timingListeners.append(listener)
+    
+    def _storeAppend(self,table,row):
+        if self.store is not None:
+            self.store.append(table, row)
+            if self.closed:
+                ## e.g. a sync pulse that landed after close, written straight through
+                self.store.close()
     
     def logEvent(self,time,event):
-        self.logFile = open(self.fileprefix+'_log.csv', 'a')
-        self.logFile.write('{},"{}"\n' .format(time,event))
-        self.logFile.close()
-        print('LOG: {} {}' .format(time, event))
+        with self.lock:
+            self._append('_log.csv', '{},"{}"\n' .format(time,event),
+                        echo = 'LOG: {} {}' .format(time, event))
+            self._storeAppend('log', [time, event])
+            for listener in self.listeners:
+                listener(time,event)
+    
+    def logTiming(self,time,event,scheduled,errorBound):
+        with self.lock:
+            self._append('_timing.csv', '{},"{}",{},{}\n' .format(time,event,scheduled,errorBound))
+            self._storeAppend('timing', [time, event, scheduled, errorBound])
+            for listener in self.timingListeners:
+                listener(time,event,scheduled,errorBound)
     
     def logAbort(self,time):
-        self.logEvent(time,'experiment aborted')
+        with self.lock:
+            self.logEvent(time,'experiment aborted')
+            self.close()
+    
+    def _formatRow(self,row):
+        lineFormatting = ','.join(['{}']*len(row))+'\n'
+        return lineFormatting.format(*row)
     
     def writeTrialData(self,trialData):
-        lineFormatting = ','.join(['{}']*len(trialData))+'\n'
-        self.dataFile = open(self.fileprefix+'_data.csv', 'a')
-        self.dataFile.write(lineFormatting.format(*trialData))
-        self.dataFile.close()
+        with self.lock:
+            self._append('_data.csv', self._formatRow(trialData))
+            self._storeAppend('data', trialData)
+            if self.store is not None:
+                self.store.flush()
+    
+    def flush(self):
+        with self.lock:
+            if self.writer is not None and not self.writer.closed:
+                self.writer.flush()
+            if self.store is not None:
+                self.store.flush()
+    
+    def close(self):
+        ## flush and close any open files, always call before quitting
+        ## anything logged after this is written straight to the files
+        with self.lock:
+            self.closed = True
+            try:
+                if self.writer is not None:
+                    self.writer.close()
+            finally:
+                ## the store is closed even if the writer failed
+                if self.store is not None:
+                    self.store.close()
+
+def get_rng_state():
+    ## state of the random and numpy.random generators, as JSON-able lists
+    (version,internal,gauss) = random.getstate()
+    (name,keys,pos,hasGauss,cached) = np.random.get_state()
+    return {'random':[version, list(internal), gauss],
+            'numpy':[name, keys.tolist(), pos, hasGauss, cached]}
+
+def set_rng_state(state):
+    (version,internal,gauss) = state['random']
+    random.setstate((version, tuple(internal), gauss))
+    (name,keys,pos,hasGauss,cached) = state['numpy']
+    np.random.set_state((name, np.array(keys, dtype=np.uint32), pos, hasGauss, cached))
+
+class SessionJournal():
+    ## write-ahead journal of a session, one JSON object per line, each on disk (fsync) before the session
+    ## moves on, so a crash loses at most the trial in progress; read_journal rebuilds the session from it
+    ## records: session (exptInfo, data headers, the trial sequence and random generator state), clock (experiment time at a
+    ## wall clock time), trial (data row, end time and random generator state after it) and finished
+    def __init__(self,filename):
+        self.filename = filename
+        ## drop a line left half-written by a crash, so new records start on a line of their own
+        if os.path.exists(filename):
+            text = open(filename, 'rb').read()
+            if text and not text.endswith(b'\n'):
+                with open(filename, 'r+b') as journalFile:
+                    journalFile.truncate(text.rfind(b'\n') + 1)
+        self.file = open(filename, 'a')
+    
+    def write(self,record):
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+    
+    def startSession(self,exptInfo,headers,sequence):
+        self.write({'type':'session', 'exptInfo':exptInfo, 'headers':headers, 'sequence':sequence,
+                    'rng':get_rng_state()})
+    
+    def logClock(self,clock):
+        self.write({'type':'clock', 'time':clock.getTime(), 'wall':time.time()})
+    
+    def logTrial(self,row,endTime):
+        self.write({'type':'trial', 'row':row, 'time':endTime, 'rng':get_rng_state()})
+    
+    def finish(self):
+        self.write({'type':'finished'})
+    
+    def close(self):
+        self.file.close()
+
+def read_journal(filename):
+    ## the state of a journaled session; a last line cut short by a crash is ignored
+    state = {'exptInfo':None, 'headers':None, 'sequence':None, 'rows':[], 'lastTrialTime':0.0,
+            'rng':None, 'clock':None, 'finished':False}
+    for line in open(filename):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            break
+        if record['type'] == 'session':
+            state.update(exptInfo = record['exptInfo'], headers = record['headers'], sequence = record['sequence'],
+                        rng = record['rng'])
+        elif record['type'] == 'clock':
+            state['clock'] = record
+        elif record['type'] == 'trial':
+            state['rows'].append(record['row'])
+            state['lastTrialTime'] = record['time']
+            state['rng'] = record['rng']
+        elif record['type'] == 'finished':
+            state['finished'] = True
+    if state['exptInfo'] is None:
+        raise ValueError('{} has no session record' .format(filename))
+    return state
+
+def resume_time(state):
+    ## experiment clock time to carry on from: the wall clock time since the session's clock was last
+    ## recorded, so times in the log stay on one clock across the crash, but never before the last trial ended
+    resumeTime = state['lastTrialTime']
+    if state['clock'] is not None:
+        resumeTime = max(resumeTime, state['clock']['time'] + time.time() - state['clock']['wall'])
+    return resumeTime
+
+class MarkerStream():
+    ## publishes logged events to an acquisition system (EEG, physiology) as they happen, one JSON object
+    ## per UDP datagram or per line over TCP: seq, time on the experiment clock, wall (host clock, once
+    ## syncClock has been called) and event. Sending is on a background thread, so logging never waits
+    ## on the network; the time from each event being logged to it being sent is kept in sendLatency
+    ## after a failed send it waits retryDelay seconds, doubling up to maxRetryDelay, before reconnecting,
+    ## dropping markers meanwhile, so an unreachable host costs one connection timeout, not one per marker
+    def __init__(self,address,retryDelay=0.5,maxRetryDelay=8.0):
+        (self.protocol,hostPort) = address.split('://')
+        (self.host,port) = hostPort.rsplit(':', 1)
+        self.port = int(port)
+        if self.protocol not in ('udp','tcp'):
+            raise ValueError('marker stream address should be udp://host:port or tcp://host:port, not {}' .format(address))
+        self.socket = None
+        self.clockOffset = None # host clock minus experiment clock
+        self.nSent = 0
+        self.nFailed = 0
+        self.seq = 0
+        self.lock = threading.Lock() # events are logged from the sync pulse thread too
+        self.minRetryDelay = retryDelay
+        self.maxRetryDelay = maxRetryDelay
+        self.retryDelay = retryDelay
+        self.retryTime = 0 # perf_counter time before which not to reconnect
+        self.sendLatency = [] # (seq, seconds from logged to sent)
+        self.queue = queue.Queue()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+    
+    def syncClock(self,clock):
+        ## from now on events are also stamped with the host's clock, for acquisition systems on other machines
+        self.clockOffset = time.time() - clock.getTime()
+    
+    def __call__(self,eventTime,event):
+        with self.lock:
+            self.seq += 1
+            self.queue.put((self.seq, eventTime, event, time.perf_counter()))
+    
+    def close(self,timeout=2.0):
+        ## send anything still queued if connected, dropping it if not, then stop,
+        ## waiting at most timeout seconds for a send in progress
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join(timeout)
+        if self.socket is not None and not self.thread.is_alive():
+            self.socket.close()
+    
+    def _connect(self):
+        if self.protocol == 'udp':
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.socket.connect((self.host, self.port))
+        else:
+            self.socket = socket.create_connection((self.host, self.port), timeout=1.0)
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            (seq,eventTime,event,loggedAt) = item
+            marker = {'seq':seq, 'time':eventTime, 'event':event}
+            if self.clockOffset is not None:
+                marker['wall'] = eventTime + self.clockOffset
+            message = (json.dumps(marker) + '\n').encode('utf-8')
+            if self.socket is None and (self.closed or time.perf_counter() < self.retryTime):
+                ## not connected, and backing off after a failure or closing: lost
+                self.nFailed += 1
+                continue
+            try:
+                if self.socket is None:
+                    self._connect()
+                if self.protocol == 'udp':
+                    self.socket.send(message)
+                else:
+                    self.socket.sendall(message)
+                self.nSent += 1
+                self.sendLatency.append((seq, time.perf_counter() - loggedAt))
+                self.retryDelay = self.minRetryDelay
+            except (OSError, socket.timeout):
+                ## lost, e.g. nothing listening; reconnect after a while
+                self.nFailed += 1
+                if self.socket is not None:
+                    self.socket.close()
+                self.socket = None
+                self.retryTime = time.perf_counter() + self.retryDelay
+                self.retryDelay = min(2*self.retryDelay, self.maxRetryDelay)
+    
+    def saveLatency(self,filename):
+        latencyFile = open(filename, 'w')
+        latencyFile.write('seq,latency\n')
+        for (seq,latency) in self.sendLatency:
+            latencyFile.write('{},{}\n' .format(seq, latency))
+        latencyFile.close()
+
+class CueStats():
+    ## running totals for one cue (or all cues), so every mean is O(1) to read
+    def __init__(self):
+        self.trials = 0
+        self.responses = 0
+        self.correct = 0
+        self.rtSum = 0.0
+        self.rtSumSq = 0.0
+        self.nRT = 0
+        self.ratingSum = 0.0
+        self.ratingSumSq = 0.0
+        self.nRatings = 0
+        self.touchSum = 0.0
+        self.nTouches = 0
+    
+    def accuracy(self):
+        return self.correct / float(self.responses) if self.responses else np.nan
+    
+    def meanRT(self):
+        return self.rtSum / self.nRT if self.nRT else np.nan
+    
+    def sdRT(self):
+        return math.sqrt(max(0.0, self.rtSumSq / self.nRT - self.meanRT()**2)) if self.nRT else np.nan
+    
+    def meanRating(self):
+        return self.ratingSum / self.nRatings if self.nRatings else np.nan
+    
+    def sdRating(self):
+        return math.sqrt(max(0.0, self.ratingSumSq / self.nRatings - self.meanRating()**2)) if self.nRatings else np.nan
+    
+    def meanTouchDuration(self):
+        return self.touchSum / self.nTouches if self.nTouches else np.nan
+
+class EventIndex():
+    ## typed, in-memory copy of the logged events, as a DataFileCollection listener, for queries during the
+    ## session: every event is parsed once into a type, trial and value in growing numpy arrays, indexed by
+    ## type and by trial, and the per-cue totals are updated as it arrives, so queries don't scan anything
+    
+    ## event types, and the start of the text of each
+    types = ['other', 'experiment started', 'experiment resumed', 'experiment finished', 'experiment aborted',
+            'cue', 'countdown', 'start touching', 'stop touching', 'buttons presented', 'response', 'rating',
+            'trial complete', 'sync pulse']
+    prefixes = [('toucher cue ', 'cue'), ('countdown to touch', 'countdown'),
+                ('start touching', 'start touching'), ('stop touching', 'stop touching'),
+                ('buttons presented', 'buttons presented'), ('receiver responded ', 'response'),
+                ('Pleasantness rating (-10,10) = ', 'rating'), ('sync pulse', 'sync pulse'),
+                ('experiment started', 'experiment started'), ('experiment resumed at trial ', 'experiment resumed'),
+                ('experiment finished', 'experiment finished'), ('experiment aborted', 'experiment aborted')]
+    
+    def __init__(self,capacity=4096):
+        self.typeN = dict((name, n) for (n,name) in enumerate(self.types))
+        self.times = np.zeros(capacity)
+        self.type = np.zeros(capacity, dtype=np.int16)
+        self.trialN = np.zeros(capacity, dtype=np.int32)
+        self.values = np.full(capacity, np.nan) # numeric value if the event has one
+        self.events = [] # the text of every event
+        self.labels = [] # cue or response label, or None
+        self.n = 0
+        self.byType = dict((name, []) for name in self.types) # event numbers of each type
+        self.byTrial = collections.OrderedDict() # trial -> event numbers
+        self.trial = 1 # the trial in progress
+        self.nTrials = None # from 'N of M complete'
+        self.completed = 0
+        self.stats = collections.defaultdict(CueStats) # per cue
+        self.total = CueStats()
+        self.trialCue = None
+        self.trialTimes = {} # event type -> time, for the trial in progress
+        self.lastTrial = {} # cue, response, correct, rt, rating, touch duration of the last completed trial
+        self.listeners = [] # called with (index, event number) after each event is indexed
+        self.lock = threading.Lock() # events can be logged from other threads
+        self.nUnparsed = 0 # events that looked like a known type but didn't parse
+    
+    def parse(self,event):
+        ## (type, label, value) of an event's text
+        for (prefix,eventType) in self.prefixes:
+            if event.startswith(prefix):
+                rest = event[len(prefix):]
+                if eventType == 'cue':
+                    return (eventType, rest, np.nan)
+                if eventType == 'response':
+                    (response,correctText) = rest.rsplit(' - ', 1)
+                    return (eventType, response, float(correctText == 'correct'))
+                if eventType == 'rating':
+                    ## no rating, e.g. None, is a rating event without a value
+                    try:
+                        return (eventType, None, float(rest))
+                    except ValueError:
+                        return (eventType, None, np.nan)
+                if eventType == 'experiment resumed':
+                    return (eventType, None, float(int(rest)))
+                return (eventType, None, np.nan)
+        if event.endswith(' complete') and ' of ' in event:
+            (done,total) = event[:-len(' complete')].split(' of ')
+            return ('trial complete', None, float(done)) if done.isdigit() and total.isdigit() else ('other', None, np.nan)
+        return ('other', None, np.nan)
+    
+    def __call__(self,eventTime,event):
+        ## called from logEvent, so it must never raise: events that don't parse are indexed as 'other'
+        try:
+            (eventType,label,value) = self.parse(event)
+        except (ValueError, TypeError, AttributeError):
+            (eventType,label,value) = ('other', None, np.nan)
+            self.nUnparsed += 1
+        with self.lock:
+            self._add(eventTime, event, eventType, label, value)
+            n = self.n - 1
+        for listener in self.listeners:
+            listener(self, n)
+    
+    def _add(self,eventTime,event,eventType,label,value):
+        if self.n == len(self.times):
+            ## amortised O(1) growth
+            for name in ('times', 'type', 'trialN', 'values'):
+                array = getattr(self, name)
+                grown = np.resize(array, 2*len(array))
+                grown[len(array):] = 0 if name != 'values' else np.nan
+                setattr(self, name, grown)
+        n = self.n
+        if eventType == 'experiment resumed':
+            self.trial = int(value)
+        self.times[n] = eventTime
+        self.type[n] = self.typeN[eventType]
+        self.trialN[n] = self.trial
+        self.values[n] = value
+        self.events.append(event)
+        self.labels.append(label)
+        self.byType[eventType].append(n)
+        self.byTrial.setdefault(self.trial, []).append(n)
+        self.n = n + 1
+        
+        ## per-trial timings, and per-cue totals when the trial completes
+        if eventType == 'cue':
+            self.trialCue = label
+            self.trialTimes = {}
+        self.trialTimes[eventType] = eventTime
+        if eventType == 'response':
+            self.trialTimes['response label'] = label
+            self.trialTimes['correct'] = value
+        elif eventType == 'rating':
+            self.trialTimes['rating value'] = value
+        elif eventType == 'trial complete':
+            self._completeTrial(int(value), event)
+    
+    def _completeTrial(self,trial,event):
+        times = self.trialTimes
+        result = {'trial':trial, 'cue':self.trialCue, 'response':times.get('response label'),
+                'correct':times.get('correct', np.nan), 'rating':times.get('rating value', np.nan),
+                'rt':np.nan, 'touch duration':np.nan}
+        if 'response' in times and 'buttons presented' in times:
+            result['rt'] = times['response'] - times['buttons presented']
+        elif 'rating' in times and 'stop touching' in times:
+            result['rt'] = times['rating'] - times['stop touching']
+        if 'start touching' in times and 'stop touching' in times:
+            result['touch duration'] = times['stop touching'] - times['start touching']
+        for stats in (self.stats[self.trialCue], self.total):
+            stats.trials += 1
+            if not np.isnan(result['correct']):
+                stats.responses += 1
+                stats.correct += int(result['correct'])
+            if not np.isnan(result['rt']):
+                stats.nRT += 1
+                stats.rtSum += result['rt']
+                stats.rtSumSq += result['rt']**2
+            if not np.isnan(result['rating']):
+                stats.nRatings += 1
+                stats.ratingSum += result['rating']
+                stats.ratingSumSq += result['rating']**2
+            if not np.isnan(result['touch duration']):
+                stats.nTouches += 1
+                stats.touchSum += result['touch duration']
+        self.lastTrial = result
+        self.completed += 1
+        self.nTrials = int(event[:-len(' complete')].split(' of ')[1])
+        self.trial = trial + 1
+        self.trialTimes = {}
+    
+    ## queries, all O(1)
+    def count(self,eventType):
+        return len(self.byType[eventType])
+    
+    def last(self,eventType):
+        ## (time, text) of the latest event of a type, or None
+        if not self.byType[eventType]:
+            return None
+        n = self.byType[eventType][-1]
+        return (float(self.times[n]), self.events[n])
+    
+    def trialEvents(self,trial):
+        ## (time, type, text) of each event of a trial
+        return [(float(self.times[n]), self.types[self.type[n]], self.events[n]) for n in self.byTrial.get(trial, [])]
+    
+    def accuracy(self,cue=None):
+        return (self.total if cue is None else self.stats[cue]).accuracy()
+    
+    def meanRT(self,cue=None):
+        return (self.total if cue is None else self.stats[cue]).meanRT()
+    
+    def meanRating(self,cue=None):
+        return (self.total if cue is None else self.stats[cue]).meanRating()
+    
+    def lastTouchDuration(self):
+        return self.lastTrial.get('touch duration', np.nan)
+    
+    def arrays(self):
+        ## views of the typed columns of every event so far
+        return {'time':self.times[0:self.n], 'type':self.type[0:self.n], 'trial':self.trialN[0:self.n], 'value':self.values[0:self.n]}
+
+dashboardPage = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Touch Comm session</title>
+<style>body{font-family:sans-serif;margin:1em} td,th{padding:2px 10px;text-align:right} th:first-child,td:first-child{text-align:left}
+.alert{color:#b00}</style></head>
+<body><h2 id="progress"></h2><p id="last"></p>
+<table><thead><tr><th>cue</th><th>trials</th><th>accuracy</th><th>RT mean (s)</th><th>RT sd</th><th>rating mean</th><th>rating sd</th><th>touch (s)</th></tr></thead>
+<tbody id="cues"></tbody></table><h3>Alerts</h3><ul id="alerts"></ul>
+<script>
+function fmt(x,d){return x===null?'':x.toFixed(d)}
+function update(){fetch('state.json').then(r=>r.json()).then(s=>{
+ document.getElementById('progress').textContent='Trial '+s.trial+' of '+(s.nTrials||'?')+' ('+s.completed+' complete)';
+ document.getElementById('last').textContent=s.last?s.last[0].toFixed(2)+' s: '+s.last[1]:'';
+ document.getElementById('cues').innerHTML=s.cues.map(c=>'<tr><td>'+c.cue+'</td><td>'+c.trials+'</td><td>'+
+  (c.accuracy===null?'':Math.round(100*c.accuracy)+'%')+'</td><td>'+fmt(c.rt,2)+'</td><td>'+fmt(c.rtSD,2)+'</td><td>'+
+  fmt(c.rating,1)+'</td><td>'+fmt(c.ratingSD,1)+'</td><td>'+fmt(c.touch,2)+'</td></tr>').join('');
+ document.getElementById('alerts').innerHTML=s.alerts.slice().reverse().map(a=>'<li class="alert">'+a[0].toFixed(2)+' s: '+a[1]+'</li>').join('');
+}).catch(()=>{})}
+update();setInterval(update,500);
+</script></body></html>
+"""
+
+class DashboardHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.startswith('/state.json'):
+            body = json.dumps(self.server.dashboard.state).encode('utf-8')
+            contentType = 'application/json'
+        elif self.path in ('/', '/index.html'):
+            body = dashboardPage.encode('utf-8')
+            contentType = 'text/html; charset=utf-8'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self,format,*args):
+        pass ## keep the console for the session log
+
+class Dashboard():
+    ## live view of the session for the experimenter, a web page at http://host:port served from a background
+    ## thread: trial N of nTrials, per-cue accuracy, RT, rating and touch duration, the last event, and alerts
+    ## for dropped frames and audio events off their schedule. It listens to an EventIndex and to the timing
+    ## events of a DataFileCollection, and only rebuilds the state the page reads when something changes,
+    ## a few dozen numbers per trial, so it never holds up the render loop; the page polls it twice a second
+    def __init__(self,eventIndex,port,nTrials=None,host='127.0.0.1',maxTimingError=0.005,maxErrorBound=0.01):
+        self.eventIndex = eventIndex
+        self.nTrials = nTrials
+        self.maxTimingError = maxTimingError # seconds an audio event can be off its schedule before an alert
+        self.maxErrorBound = maxErrorBound # seconds of uncertainty in when it was heard before an alert
+        self.alerts = collections.deque(maxlen=50) # (time, text)
+        self.telemetry = None
+        self.nFrameSummaries = 0
+        self.cues = []
+        self.state = {}
+        self.lock = threading.Lock() # events and timing can come from other threads
+        eventIndex.listeners.append(self.onEvent)
+        self.update()
+        self.server = http.server.ThreadingHTTPServer((host, port), DashboardHandler)
+        self.server.daemon_threads = True
+        self.server.dashboard = self
+        self.address = 'http://{}:{}/' .format(host, self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+    
+    def watchFrames(self,telemetry):
+        ## alert on dropped frames in each trial's FrameTelemetry summary
+        self.telemetry = telemetry
+        self.nFrameSummaries = len(telemetry.summaries)
+    
+    def onTiming(self,eventTime,event,scheduled,errorBound):
+        ## DataFileCollection timing listener
+        if abs(eventTime - scheduled) > self.maxTimingError:
+            self.alert(eventTime, '{} {:.1f} ms {}' .format(event, abs(eventTime - scheduled)*1e3,
+                                                            'late' if eventTime > scheduled else 'early'))
+        elif errorBound > self.maxErrorBound:
+            self.alert(eventTime, '{} heard within +/- {:.1f} ms' .format(event, errorBound*1e3))
+    
+    def alert(self,eventTime,text):
+        with self.lock:
+            self.alerts.append((eventTime, text))
+        self.update()
+    
+    def onEvent(self,index,n):
+        ## EventIndex listener: the per-cue table only changes when a trial completes
+        eventType = index.types[index.type[n]]
+        if eventType == 'trial complete':
+            if self.telemetry is not None:
+                for summary in self.telemetry.summaries[self.nFrameSummaries:]:
+                    if summary['dropped']:
+                        self.alert(float(index.times[n]), '{} dropped {} frames in trial {}' .format(
+                            summary['window'], summary['dropped'], summary['trial']))
+                self.nFrameSummaries = len(self.telemetry.summaries)
+            self.cues = [self.cueRow(cue, index.stats[cue]) for cue in sorted(index.stats)] + [self.cueRow('all', index.total)]
+        elif eventType == 'experiment aborted':
+            self.alert(float(index.times[n]), 'experiment aborted')
+        self.update()
+    
+    def cueRow(self,cue,stats):
+        ## NaN isn't JSON, so missing values are None
+        def number(value):
+            return None if np.isnan(value) else float(value)
+        return {'cue':cue, 'trials':stats.trials, 'accuracy':number(stats.accuracy()),
+                'rt':number(stats.meanRT()), 'rtSD':number(stats.sdRT()),
+                'rating':number(stats.meanRating()), 'ratingSD':number(stats.sdRating()),
+                'touch':number(stats.meanTouchDuration())}
+    
+    def update(self):
+        ## a new dict each time, so the server thread always reads a whole one
+        index = self.eventIndex
+        last = None
+        if index.n:
+            last = (float(index.times[index.n-1]), index.events[index.n-1])
+        with self.lock:
+            self.state = {'trial':index.trial, 'completed':index.completed, 'nTrials':self.nTrials or index.nTrials,
+                        'last':last, 'cues':self.cues, 'alerts':list(self.alerts)}
+    
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+class PygameAudio():
+    ## sounds through pygame's SDL mixer, with a fixed sample rate and buffer size
+    def __init__(self,frequency=44100,bufferSize=512,channels=2):
+        self.frequency = frequency
+        self.bufferSize = bufferSize # samples per mixer buffer, smaller is lower latency but may crackle
+        self.channels = channels
+        self.nReserved = 0
+    
+    def init(self):
+        pygame.mixer.pre_init(self.frequency, -16, self.channels, self.bufferSize)
+        pygame.mixer.init()
+    
+    def loadSound(self,filename):
+        return pygame.mixer.Sound(filename)
+    
+    def soundSize(self,sound):
+        ## bytes of decoded audio
+        (frequency,format,channels) = pygame.mixer.get_init() or (self.frequency,-16,self.channels)
+        return int(sound.get_length() * frequency * channels * abs(format) / 8)
+    
+    def latency(self):
+        ## (latency, uncertainty) from Sound.play() to the sound being heard: a new sound is mixed into
+        ## the next buffer, which is played out after the buffer already queued for the device
+        (frequency,format,channels) = pygame.mixer.get_init() or (self.frequency,-16,self.channels)
+        bufferTime = self.bufferSize / float(frequency)
+        return (1.5*bufferTime, 0.5*bufferTime)
+    
+    def reserveChannel(self,sound):
+        ## sound that always plays on a mixer channel of its own, which cues can never take
+        self.nReserved += 1
+        pygame.mixer.set_reserved(self.nReserved)
+        return ChannelSound(pygame.mixer.Channel(self.nReserved-1), sound)
+    
+    def close(self):
+        pygame.mixer.quit()
+
+class ChannelSound():
+    ## same interface as pygame.mixer.Sound, always played on the same channel
+    def __init__(self,channel,sound):
+        self.channel = channel
+        self.sound = sound
+    
+    def get_length(self):
+        return self.sound.get_length()
+    
+    def play(self):
+        self.channel.play(self.sound)
+        return self.channel
+
+class SoundDeviceAudio():
+    ## lower latency sounds through PortAudio (the optional sounddevice package): sounds are mixed in
+    ## small blocks on PortAudio's callback thread, and PortAudio reports the latency of the device
+    def __init__(self,frequency=48000,bufferSize=128,channels=2,device=None):
+        self.frequency = frequency
+        self.bufferSize = bufferSize
+        self.channels = channels
+        self.device = device
+        self.lock = threading.Lock()
+        self.playing = []
+        self.stream = None
+    
+    def init(self):
+        if sounddevice is None:
+            raise ImportError('the sounddevice audio backend needs the sounddevice package')
+        self.stream = sounddevice.OutputStream(samplerate = self.frequency,
+                                                blocksize = self.bufferSize,
+                                                channels = self.channels,
+                                                dtype = 'float32',
+                                                latency = 'low',
+                                                device = self.device,
+                                                callback = self.mix)
+        self.stream.start()
+    
+    def mix(self,outdata,frames,timeInfo,status):
+        outdata.fill(0)
+        with self.lock:
+            for channel in list(self.playing):
+                block = channel.read(frames)
+                outdata[0:len(block)] += block
+                if not channel.busy:
+                    self.playing.remove(channel)
+    
+    def loadSound(self,filename):
+        (samples,frameRate) = read_wav(filename)
+        if frameRate != self.frequency:
+            ## resample linearly to the stream's rate
+            nFrames = int(round(len(samples) * self.frequency / float(frameRate)))
+            t = np.arange(nFrames) * frameRate / float(self.frequency)
+            samples = np.column_stack([np.interp(t, np.arange(len(samples)), samples[:,c]) for c in range(samples.shape[1])])
+        if samples.shape[1] != self.channels:
+            samples = np.repeat(samples.mean(axis=1, keepdims=True), self.channels, axis=1)
+        return StreamSound(self, np.ascontiguousarray(samples, dtype=np.float32))
+    
+    def soundSize(self,sound):
+        return int(sound.get_length() * self.frequency * self.channels * 4)
+    
+    def latency(self):
+        ## a sound starts at the next block, then takes the device's output latency to be heard
+        blockTime = self.bufferSize / float(self.frequency)
+        return (self.stream.latency + 0.5*blockTime, 0.5*blockTime)
+    
+    def reserveChannel(self,sound):
+        ## every sound is mixed in separately, there are no channels to run out of
+        return sound
+    
+    def close(self):
+        if self.stream is not None:
+            self.stream.stop()
+            self.stream.close()
+            self.stream = None
+
+class StreamSound():
+    ## same interface as pygame.mixer.Sound, for SoundDeviceAudio
+    def __init__(self,audio,samples):
+        self.audio = audio
+        self.samples = samples
+    
+    def get_length(self):
+        return len(self.samples) / float(self.audio.frequency)
+    
+    def play(self):
+        channel = StreamChannel(self.samples)
+        with self.audio.lock:
+            self.audio.playing.append(channel)
+        return channel
+
+class StreamChannel():
+    def __init__(self,samples):
+        self.samples = samples
+        self.position = 0
+        self.busy = True
+    
+    def read(self,frames):
+        block = self.samples[self.position:self.position+frames]
+        self.position += frames
+        if self.position >= len(self.samples):
+            self.busy = False
+        return block
+    
+    def get_busy(self):
+        return self.busy
+    
+    def stop(self):
+        self.busy = False
+
+audioBackends = {'pygame':PygameAudio, 'sounddevice':SoundDeviceAudio}
+
+class PsychoPyBackend():
+    ## real windows, stimuli and input through psychopy
+    frameDuration = 1.0/60 # longest wait for input when there is nothing to draw
+    ## windows can only be flipped off the main thread where their OpenGL context can move between threads:
+    ## Cocoa requires the main thread on macOS, and on Windows it isn't safe
+    flipThreads = sys.platform.startswith('linux')
+    
+    def __init__(self,audio=None):
+        self.audio = audio if audio is not None else PygameAudio()
+    
+    def makeWindow(self,fullscr,screen,size):
+        return visual.Window(fullscr = fullscr, 
+                            allowGUI = True, 
+                            screen = screen,
+                            size = size,
+                            units = 'norm')
+    
+    def makeText(self,win,**kwargs):
+        return visual.TextStim(win,**kwargs)
+    
+    def makeRect(self,win,**kwargs):
+        return visual.Rect(win,**kwargs)
+    
+    def makeRatingScale(self,win,**kwargs):
+        return visual.RatingScale(win,**kwargs)
+    
+    def makeMouse(self,win):
+        return event.Mouse(True,None,win)
+    
+    def getKeys(self,keyList,clock):
+        return event.getKeys(keyList, timeStamped=clock)
+    
+    def waitKeys(self,keyList,clock):
+        ## sleep until a key arrives rather than polling for one
+        keys = self.getKeys(keyList, clock)
+        while not keys:
+            self.waitEvents(0.1)
+            keys = self.getKeys(keyList, clock)
+        return keys
+    
+    def waitEvents(self,timeout):
+        ## block until the OS has input for a window or timeout seconds pass, and dispatch it
+        ## straight away, so that keys and clicks are timestamped when they arrive
+        timeout = max(timeout, 0)
+        if pyglet is None:
+            time.sleep(min(timeout, 0.001))
+            return
+        pyglet.app.platform_event_loop.step(timeout)
+        for win in list(pyglet.app.windows):
+            win.dispatch_events()
+    
+    def clearEvents(self):
+        event.clearEvents()
+    
+    def Clock(self):
+        return core.Clock()
+    
+    def CountdownTimer(self,start=0):
+        return core.CountdownTimer(start)
+    
+    def loadSound(self,filename):
+        return self.audio.loadSound(filename)
+    
+    def wait(self,secs):
+        core.wait(secs)
+    
+    def waitUntil(self,clock,t):
+        ## sleep, then spin for the last 2 ms, until clock reads t
+        if t > clock.getTime():
+            core.wait(t - clock.getTime(), hogCPUperiod=0.002)
+    
+    def audioLatency(self):
+        return self.audio.latency()
+    
+    def reserveChannel(self,sound):
+        return self.audio.reserveChannel(sound)
+    
+    def idle(self):
+        ## nothing to draw, sleep until there is input or for a frame at most
+        self.waitEvents(self.frameDuration)
+    
+    def discard(self,stim):
+        pass
+    
+    def makeCurrent(self,win):
+        ## bind the window's OpenGL context to the calling thread (pyglet windows)
+        if hasattr(win.winHandle, 'switch_to'):
+            win.winHandle.switch_to()
+    
+    def releaseCurrent(self,win):
+        ## unbind the context again, so that psychopy can rebind it on the main thread
+        context = getattr(win.winHandle, 'context', None)
+        if context is not None and hasattr(context, 'detach'):
+            context.detach()
+        if getattr(visual, 'globalVars', None) is not None:
+            visual.globalVars.currWindow = None
+    
+    def quit(self):
+        core.quit()
+
+class VirtualClock():
+    ## same interface as core.Clock, but reads time from a HeadlessBackend, virtual or real
+    def __init__(self,backend):
+        self.backend = backend
+        self.timeAtLastReset = backend.time()
+    
+    def getTime(self):
+        return self.backend.time() - self.timeAtLastReset
+    
+    def reset(self,newT=0.0):
+        self.timeAtLastReset = self.backend.time() + newT
+    
+    def add(self,t):
+        self.timeAtLastReset += t
+
+class VirtualCountdownTimer(VirtualClock):
+    ## same interface as core.CountdownTimer
+    def __init__(self,backend,start=0):
+        VirtualClock.__init__(self,backend)
+        self.timeAtLastReset += start
+    
+    def getTime(self):
+        return self.timeAtLastReset - self.backend.time()
+    
+    def reset(self,t=0.0):
+        self.timeAtLastReset = self.backend.time() + t
+
+class VirtualChannel():
+    def __init__(self,backend,endTime):
+        self.backend = backend
+        self.endTime = endTime
+    
+    def get_busy(self):
+        return self.backend.time() < self.endTime
+    
+    def stop(self):
+        self.endTime = self.backend.time()
+
+class VirtualSound():
+    ## same interface as pygame.mixer.Sound, "plays" for the length of the file in virtual time
+    def __init__(self,backend,filename):
+        self.backend = backend
+        wavFile = wave.open(filename, 'rb')
+        self.length = wavFile.getnframes() / float(wavFile.getframerate())
+        wavFile.close()
+    
+    def get_length(self):
+        return self.length
+    
+    def play(self):
+        return VirtualChannel(self.backend, self.backend.time() + self.length)
+
+class ScriptedInput():
+    ## keys, button clicks and VAS ratings to feed a HeadlessBackend, in order
+    ## when a script runs out, chooseButton(labels) and rate() are used if given
+    def __init__(self,keys=(),clicks=(),ratings=(),chooseButton=None,rate=None,
+                defaultKey='space',responseDelay=0.5):
+        self.keys = collections.deque(keys)
+        self.clicks = collections.deque(clicks) # button labels
+        self.ratings = collections.deque(ratings)
+        self.chooseButton = chooseButton
+        self.rate = rate
+        self.defaultKey = defaultKey # answers waitKeys when no key is scripted
+        self.responseDelay = responseDelay # seconds before a click or rating
+    
+    def nextKey(self,keyList,wait):
+        if self.keys and (keyList is None or self.keys[0] in keyList):
+            return self.keys.popleft()
+        if wait:
+            return self.defaultKey
+        return None
+    
+    def nextClick(self,labels):
+        if self.clicks:
+            return self.clicks.popleft()
+        if self.chooseButton is not None:
+            return self.chooseButton(labels)
+        return None
+    
+    def nextRating(self):
+        if self.ratings:
+            return self.ratings.popleft()
+        if self.rate is not None:
+            return self.rate()
+        return None
+
+class HeadlessStim():
+    ## stands in for TextStim, Rect and RatingScale without drawing anything
+    def __init__(self,win,**kwargs):
+        self.win = win
+        self.text = ''
+        self.pos = (0,0)
+        self.width = self.height = 0
+        self.opacity = 1
+        self.autoDraw = False
+        self.__dict__.update(kwargs)
+        win.stims.append(self)
+    
+    def draw(self):
+        pass
+    
+    def contains(self,mouse):
+        (x,y) = mouse.getPos()
+        return abs(x - self.pos[0]) <= self.width/2 and abs(y - self.pos[1]) <= self.height/2
+
+class HeadlessRect(HeadlessStim):
+    pass
+
+class HeadlessRatingScale(HeadlessStim):
+    def reset(self):
+        self.noResponse = True
+        self.rating = None
+        self.resetTime = self.win.backend.time()
+    
+    def draw(self):
+        ## respond once the scripted delay has passed
+        if not self.noResponse:
+            return
+        input = self.win.backend.input
+        if self.win.backend.time() - self.resetTime >= input.responseDelay:
+            rating = input.nextRating()
+            if rating is not None:
+                self.rating = rating
+                self.rt = self.win.backend.time() - self.resetTime
+                self.noResponse = False
+    
+    def getRating(self):
+        return self.rating
+    
+    def getRT(self):
+        return self.rt
+
+class HeadlessWindow():
+    def __init__(self,backend,size,vsyncPhase=0.0):
+        self.backend = backend
+        self.size = size
+        self.stims = []
+        self.nFlips = 0
+        self.lastFrame = backend.time() + vsyncPhase
+    
+    def flip(self):
+        ## wait for this window's next vsync
+        self.nFlips += 1
+        self.lastFrame = self.backend.waitVsync(self.lastFrame)
+        return self.lastFrame
+    
+    def buttonLabels(self):
+        ## (label, position) of text drawn on top of a visible button
+        rects = [stim.pos for stim in self.stims 
+                if stim.autoDraw and isinstance(stim, HeadlessRect)]
+        return [(stim.text, stim.pos) for stim in self.stims 
+                if stim.autoDraw and type(stim) is HeadlessStim and tuple(stim.pos) in rects]
+    
+    def close(self):
+        self.stims = []
+
+class HeadlessMouse():
+    ## clicks the button whose label the scripted input chooses
+    def __init__(self,win):
+        self.win = win
+        self.pos = (-10,-10) # off screen
+        self.clickReset()
+    
+    def clickReset(self):
+        self.resetTime = self.win.backend.time()
+        self.pressed = False
+        self.pressTime = 0
+        self.target = None
+    
+    def getPos(self):
+        if self.target is None and self.win.backend.time() - self.resetTime >= self.win.backend.input.responseDelay:
+            buttons = dict(self.win.buttonLabels())
+            if buttons:
+                self.target = self.win.backend.input.nextClick(sorted(buttons))
+                if self.target is not None:
+                    self.pos = tuple(buttons[self.target])
+                    self.pressed = True
+                    self.pressTime = self.win.backend.time() - self.resetTime
+        return self.pos
+    
+    def getPressed(self,getTime=False):
+        if getTime:
+            return ([int(self.pressed),0,0], [self.pressTime,0,0])
+        return [int(self.pressed),0,0]
+
+class HeadlessBackend():
+    ## offscreen windows and scripted input, for running sessions without a display
+    ## with virtualTime, clocks, sounds and frames run on a simulated clock as fast as possible
+    ## screenPhases gives the vsync phase of each screen in seconds, to simulate unsynchronised monitors
+    flipThreads = True
+    
+    def __init__(self,input=None,frameRate=60.0,virtualTime=False,screenPhases=None,audio=None):
+        self.audio = audio if audio is not None else PygameAudio()
+        self.input = input if input is not None else ScriptedInput()
+        self.frameDuration = 1.0/frameRate
+        self.virtualTime = virtualTime
+        self.screenPhases = screenPhases if screenPhases is not None else {}
+        self.now = 0.0 # virtual time
+        self.lock = threading.Lock()
+        self.postedKeys = collections.deque() # (key, time) pressed by other threads
+        self.inputReady = threading.Event()
+        self.lastFrame = self.time()
+    
+    def time(self):
+        if self.virtualTime:
+            return self.now
+        return time.perf_counter()
+    
+    def waitFrame(self):
+        if self.virtualTime:
+            self.now += self.frameDuration
+            return
+        nextFrame = self.lastFrame + self.frameDuration
+        now = time.perf_counter()
+        if nextFrame > now:
+            time.sleep(nextFrame - now)
+        self.lastFrame = max(nextFrame, now)
+    
+    def waitVsync(self,lastFrame):
+        ## time of the first vsync at least a frame after lastFrame
+        nextFrame = lastFrame + self.frameDuration
+        now = self.time()
+        if now - nextFrame > 1e-9:
+            nextFrame += math.ceil((now - nextFrame) / self.frameDuration) * self.frameDuration
+        if self.virtualTime:
+            with self.lock:
+                self.now = max(self.now, nextFrame)
+        elif nextFrame > now:
+            time.sleep(nextFrame - now)
+        return nextFrame
+    
+    def idle(self):
+        ## nothing to draw, but let time pass
+        self.waitFrame()
+    
+    def postKey(self,key):
+        ## a key press from another thread, standing in for the OS event queue
+        self.postedKeys.append((key, self.time()))
+        self.inputReady.set()
+    
+    def waitEvents(self,timeout):
+        ## block until a key is posted or timeout seconds pass
+        timeout = max(timeout, 0)
+        if self.virtualTime:
+            self.now += min(timeout, self.frameDuration)
+            return
+        self.inputReady.wait(timeout)
+        self.inputReady.clear()
+    
+    def wait(self,secs):
+        if self.virtualTime:
+            self.now += secs
+        else:
+            time.sleep(secs)
+    
+    def waitUntil(self,clock,t):
+        if t > clock.getTime():
+            self.wait(t - clock.getTime())
+    
+    def audioLatency(self):
+        ## virtual sounds start as soon as they are played
+        if self.virtualTime:
+            return (0.0, 0.0)
+        return self.audio.latency()
+    
+    def reserveChannel(self,sound):
+        if self.virtualTime:
+            return sound
+        return self.audio.reserveChannel(sound)
+    
+    def Clock(self):
+        return VirtualClock(self)
+    
+    def CountdownTimer(self,start=0):
+        return VirtualCountdownTimer(self,start)
+    
+    def loadSound(self,filename):
+        if self.virtualTime:
+            return VirtualSound(self,filename)
+        return self.audio.loadSound(filename)
+    
+    def discard(self,stim):
+        stim.win.stims.remove(stim)
+    
+    def makeCurrent(self,win):
+        pass
+    
+    def releaseCurrent(self,win):
+        pass
+    
+    def quit(self):
+        sys.exit(0)
+    
+    def makeWindow(self,fullscr,screen,size):
+        return HeadlessWindow(self, size, self.screenPhases.get(screen, 0.0))
+    
+    def makeText(self,win,**kwargs):
+        return HeadlessStim(win,**kwargs)
+    
+    def makeRect(self,win,**kwargs):
+        return HeadlessRect(win,**kwargs)
+    
+    def makeRatingScale(self,win,**kwargs):
+        scale = HeadlessRatingScale(win,**kwargs)
+        scale.reset()
+        return scale
+    
+    def makeMouse(self,win):
+        return HeadlessMouse(win)
+    
+    def getKeys(self,keyList,clock):
+        ## posted keys keep the time they were pressed, not the time they were read
+        posted = []
+        while self.postedKeys:
+            (key,t) = self.postedKeys.popleft()
+            if key in keyList:
+                posted += [(key, clock.getTime() - (self.time() - t))]
+        if posted:
+            return posted
+        key = self.input.nextKey(keyList, wait=False)
+        if key is None:
+            return []
+        return [(key, clock.getTime())]
+    
+    def waitKeys(self,keyList,clock):
+        self.waitFrame()
+        return [(self.input.nextKey(keyList, wait=True), clock.getTime())]
+    
+    def clearEvents(self):
+        self.postedKeys.clear()
+
+defaultBackend = PsychoPyBackend()
+
+class FlipRecord():
+    ## flip times of one window, in a preallocated array
+    def __init__(self,capacity):
+        self.times = np.zeros(capacity)
+        self.n = 0
+        self.overflow = 0
+    
+    def record(self,t):
+        if self.n < len(self.times):
+            self.times[self.n] = t
+            self.n += 1
+        else:
+            self.overflow += 1
+    
+    def gap(self):
+        ## the window deliberately stopped flipping, e.g. waiting for a key
+        self.record(np.nan)
+    
+    def idle(self):
+        ## the window had nothing to draw this frame, so the interval to its next flip isn't a frame interval
+        if 0 < self.n < len(self.times) and not np.isnan(self.times[self.n-1]):
+            self.times[self.n] = np.nan
+            self.n += 1
+    
+    def reset(self):
+        self.n = 0
+        self.overflow = 0
+
+class TrajectoryRecord():
+    ## mouse position, hovered button and VAS marker value at every poll of one response,
+    ## in preallocated columns so that recording a sample allocates nothing
+    dtype = np.dtype([('time','<f8'), ('x','<f4'), ('y','<f4'), ('hover','<i1'), ('value','<f4')])
+    
+    def __init__(self,capacity):
+        self.samples = np.zeros(capacity, dtype=self.dtype)
+        ## views onto the columns of samples
+        self.time = self.samples['time']
+        self.x = self.samples['x']
+        self.y = self.samples['y']
+        self.hover = self.samples['hover']
+        self.value = self.samples['value']
+        self.labels = [] # button labels in hover order, set by showButtons
+        self.n = 0
+        self.overflow = 0
+    
+    def record(self,t,x,y,hover=-1,value=np.nan):
+        if self.n < len(self.samples):
+            n = self.n
+            self.time[n] = t
+            self.x[n] = x
+            self.y[n] = y
+            self.hover[n] = hover
+            self.value[n] = value
+            self.n = n + 1
+        else:
+            self.overflow += 1
+    
+    def reset(self):
+        self.n = 0
+        self.overflow = 0
+
+class ResponseTrajectories():
+    ## opt-in record of the mouse during each response, saved per trial as
+    ## fileprefix_trajectory_trialNNN.npz holding the samples and the button labels
+    def __init__(self,fileprefix,capacity=7200):
+        self.fileprefix = fileprefix
+        self.capacity = capacity # samples per window per trial, 2 minutes at 60 Hz
+        self.records = collections.OrderedDict()
+        self.trial = 0
+        self.overflow = 0
+    
+    def attach(self,interface,name):
+        self.records[name] = interface.trajectoryRecord = TrajectoryRecord(self.capacity)
+    
+    def startTrial(self,trial):
+        self.trial = trial
+        for record in self.records.values():
+            record.reset()
+    
+    def endTrial(self):
+        ## returns the file name
+        filename = '{}_trajectory_trial{:03d}.npz' .format(self.fileprefix, self.trial)
+        arrays = {}
+        for (name,record) in self.records.items():
+            arrays[name] = record.samples[0:record.n]
+            arrays[name+'_labels'] = np.array(record.labels, dtype=str)
+            self.overflow += record.overflow
+        np.savez(filename, **arrays)
+        return filename
+
+class FrameTelemetry():
+    ## opt-in record of every flip per window, summarised per trial into filename
+    ## resuming a session carries on the file of the interrupted run
+    def __init__(self,filename,frameRate=60.0,capacity=8192,maxGap=0.25,resuming=False):
+        self.filename = filename
+        self.framePeriod = 1.0/frameRate
+        self.capacity = capacity # flips per window per trial
+        self.maxGap = maxGap # longer intervals are pauses, not dropped frames
+        self.records = collections.OrderedDict()
+        self.trial = 0
+        self.binEdges = np.array([0, 0.5, 1.5, 2.5, 3.5, np.inf]) # in frames
+        self.summaries = []
+        if resuming and os.path.exists(self.filename):
+            return
+        telemetryFile = open(self.filename, 'w')
+        telemetryFile.write('trial,window,flips,mean interval (ms),median interval (ms),p99 interval (ms),max interval (ms),'
+                            'dropped frames,pauses,intervals <0.5 frames,0.5-1.5 frames,1.5-2.5 frames,2.5-3.5 frames,>3.5 frames\n')
+        telemetryFile.close()
+    
+    def attach(self,interface,name):
+        self.records[name] = interface.flipRecord = FlipRecord(self.capacity)
+    
+    def startTrial(self,trial):
+        self.trial = trial
+        for record in self.records.values():
+            record.reset()
+    
+    def summarise(self,record):
+        times = record.times[0:record.n]
+        intervals = np.diff(times)
+        intervals = intervals[np.isfinite(intervals)]
+        pauses = intervals > self.maxGap
+        intervals = intervals[~pauses]
+        frames = intervals / self.framePeriod
+        histogram = np.histogram(frames, self.binEdges)[0]
+        late = frames >= 1.5
+        summary = {'flips':record.n - np.count_nonzero(np.isnan(times)) + record.overflow,
+                    'dropped':int(np.sum(np.round(frames[late]) - 1)),
+                    'pauses':int(np.count_nonzero(pauses)),
+                    'histogram':histogram}
+        if len(intervals):
+            ms = intervals*1e3
+            summary.update({'mean':ms.mean(), 'median':np.median(ms), 'p99':np.percentile(ms,99), 'max':ms.max()})
+        else:
+            summary.update({'mean':np.nan, 'median':np.nan, 'p99':np.nan, 'max':np.nan})
+        return summary
+    
+    def endTrial(self):
+        telemetryFile = open(self.filename, 'a')
+        for (name,record) in self.records.items():
+            summary = self.summarise(record)
+            summary.update({'trial':self.trial, 'window':name})
+            self.summaries.append(summary)
+            telemetryFile.write('{},{},{},{:.3f},{:.3f},{:.3f},{:.3f},{},{},{}\n' .format(
+                self.trial, name, summary['flips'], summary['mean'], summary['median'], summary['p99'], summary['max'],
+                summary['dropped'], summary['pauses'], ','.join(str(n) for n in summary['histogram'])))
+        telemetryFile.close()
+
+class TextCache():
+    ## pre-rendered text stimuli for one window, one per slot and string,
+    ## evicting the least recently used ones that aren't being drawn beyond maxItems
+    def __init__(self,backend,win,maxItems=256):
+        self.backend = backend
+        self.win = win
+        self.maxItems = maxItems
+        self.stims = collections.OrderedDict()
+    
+    def get(self,slot,text,style):
+        key = (slot, text)
+        if key in self.stims:
+            self.stims.move_to_end(key)
+            return self.stims[key]
+        stim = self.backend.makeText(self.win, text = text, **style)
+        self.stims[key] = stim
+        if len(self.stims) > self.maxItems:
+            for (oldKey,oldStim) in list(self.stims.items()):
+                if len(self.stims) <= self.maxItems:
+                    break
+                if not oldStim.autoDraw and oldStim is not stim:
+                    del self.stims[oldKey]
+                    self.backend.discard(oldStim)
+        return stim
+    
+    def preload(self,slot,texts,style):
+        for text in texts:
+            self.get(slot, text, style)
+
+class FlipWorker():
+    ## flips one window on its own thread, so that windows on screens with different
+    ## vsync phases don't block each other or the main loop
+    def __init__(self,interface):
+        self.interface = interface
+        self.requested = threading.Event()
+        self.done = threading.Event()
+        self.flipTime = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def start(self):
+        self.done.clear()
+        self.requested.set()
+    
+    def join(self):
+        self.done.wait()
+        return self.flipTime
+    
+    def _run(self):
+        win = self.interface.win
+        backend = self.interface.backend
+        while True:
+            self.requested.wait()
+            self.requested.clear()
+            backend.makeCurrent(win)
+            self.flipTime = win.flip()
+            backend.releaseCurrent(win)
+            self.done.set()
 
 class DisplayInterface:
-    def __init__(self,fullscr,screen,size,message):
+    def __init__(self,fullscr,screen,size,message,backend=None,deferred=False,cacheText=False,maxCachedText=256):
         self.textColour = [-1,-1,-1]
+        self.backend = backend if backend is not None else defaultBackend
+        self.flipRecord = None # set by FrameTelemetry.attach
+        self.trajectoryRecord = None # set by ResponseTrajectories.attach
+        ## in deferred mode changes only mark the window dirty, and present() flips once per frame
+        self.deferred = deferred
+        self.dirty = False
+        self.nFlips = 0
+        self.nFlipsAtLastFrame = 0 # for present_frame
+        self.flipWorker = None # set by startFlipThread
+        self.flipPending = False
+        self.flipTime = None
         
-        self.win = visual.Window(fullscr = fullscr, 
-                                    allowGUI = True, 
-                                    screen = screen,
-                                    size = size)
+        self.win = self.backend.makeWindow(fullscr, screen, size)
+        ## with cacheText, every message is a pre-rendered stimulus and changing message swaps stimulus
+        self.textCache = TextCache(self.backend, self.win, maxCachedText) if cacheText else None
         
-        self.message = visual.TextStim(self.win,
-                                        text = message,
-                                        height = 0.12,
-                                        color = self.textColour,
-                                        units = 'norm',
-                                        pos = (0,-0))
+        self.messageStyle = {'height':0.12,
+                            'color':self.textColour,
+                            'units':'norm',
+                            'pos':(0,-0)}
+        self.message = self.makeText('message', message, self.messageStyle)
         
-        self.timerDisplay = visual.TextStim(self.win,
-                                        text = '',
-                                        height = 0.12,
-                                        color = self.textColour,
-                                        units = 'norm',
-                                        pos = (0.8,-0.8))
+        self.timerStyle = {'height':0.12,
+                            'color':self.textColour,
+                            'units':'norm',
+                            'pos':(0.8,-0.8)}
+        self.timerDisplay = self.makeText('timer', '', self.timerStyle)
+    def flip(self):
+        self.startFlip()
+        return self.finishFlip()
+    
+    def startFlip(self):
+        self.finishFlip()
+        self.dirty = False
+        self.nFlips += 1
+        if self.flipWorker is not None:
+            self.flipWorker.start()
+            self.flipPending = True
+        else:
+            self.recordFlip(self.win.flip())
+    
+    def finishFlip(self):
+        ## wait for a flip in progress on the flip thread, before touching the window again
+        if self.flipPending:
+            self.flipPending = False
+            self.recordFlip(self.flipWorker.join())
+        return self.flipTime
+    
+    def recordFlip(self,flipTime):
+        self.flipTime = flipTime
+        if self.flipRecord is not None and flipTime is not None:
+            self.flipRecord.record(flipTime)
+    
+    def startFlipThread(self):
+        ## from now on, flip this window on its own thread (see present_frame), if the backend allows it;
+        ## returns False, and flips stay on the main thread, if not
+        if not self.backend.flipThreads:
+            return False
+        self.flipWorker = FlipWorker(self)
+        return True
+    
+    def requestFlip(self,changed=True):
+        if not self.deferred:
+            self.flip()
+        elif changed:
+            self.dirty = True
+    
+    def present(self):
+        ## flip if anything changed since the last flip
+        if self.dirty:
+            self.flip()
+            return True
+        return False
+    
+    def makeText(self,slot,text,style):
+        if self.textCache is not None:
+            return self.textCache.get(slot, text, style)
+        return self.backend.makeText(self.win, text = text, **style)
+    
+    def swapText(self,slot,stim,text,style):
+        ## returns the stimulus showing text in place of stim, and whether anything changed:
+        ## the pre-rendered one if there is a text cache, otherwise stim with its text changed
+        if self.textCache is None:
+            return (stim, self.setText(stim, text))
+        self.finishFlip()
+        newStim = self.textCache.get(slot, text, style)
+        if newStim is stim:
+            return (stim, False)
+        newStim.pos = stim.pos
+        newStim.autoDraw = stim.autoDraw
+        stim.autoDraw = False
+        return (newStim, True)
+    
+    def preloadMessages(self,messages):
+        if self.textCache is not None:
+            self.textCache.preload('message', messages, self.messageStyle)
+    
+    def preloadTimer(self,values):
+        if self.textCache is not None:
+            self.textCache.preload('timer', [str(value) for value in values], self.timerStyle)
+    
+    def setText(self,stim,text):
+        ## only re-layout text when the displayed string changes
+        self.finishFlip()
+        if stim.text == text:
+            return False
+        stim.text = text
+        return True
+    
+    def setAutoDraw(self,stim,autoDraw):
+        self.finishFlip()
+        if stim.autoDraw == autoDraw:
+            return False
+        stim.autoDraw = autoDraw
+        return True
+    
     def updateMessage(self,message):
-        self.message.text = message
-        self.win.flip()
+        (self.message,changed) = self.swapText('message', self.message, message, self.messageStyle)
+        self.requestFlip(changed)
     
     def startScreen(self,message):
-        self.message.text = message
+        self.finishFlip()
+        (self.message,changed) = self.swapText('message', self.message, message, self.messageStyle)
         self.message.autoDraw = True
-        event.clearEvents()
-        self.win.flip()
+        self.backend.clearEvents()
+        self.flip()
     
     def updateTimerDisplay(self,timer):
-        self.timerDisplay.text = str(int(math.ceil(timer)))
-        self.timerDisplay.autoDraw = True
-        self.win.flip()
+        (self.timerDisplay,changed) = self.swapText('timer', self.timerDisplay, str(int(math.ceil(timer))), self.timerStyle)
+        changed = self.setAutoDraw(self.timerDisplay, True) or changed
+        self.requestFlip(changed)
     
     def hideTimerDisplay(self):
-        self.timerDisplay.text = ''
-        self.timerDisplay.autoDraw = False
-        self.win.flip()
+        (self.timerDisplay,changed) = self.swapText('timer', self.timerDisplay, '', self.timerStyle)
+        changed = self.setAutoDraw(self.timerDisplay, False) or changed
+        self.requestFlip(changed)
+    
+    def getKeys(self,keyList,clock):
+        return self.backend.getKeys(keyList, clock)
+    
+    def waitKeys(self,keyList,clock):
+        if self.flipRecord is not None:
+            self.flipRecord.gap()
+        return self.backend.waitKeys(keyList, clock)
+    
+    def clearEvents(self):
+        self.backend.clearEvents()
 
 class VASInterface(DisplayInterface):
-    def __init__(self,fullscr,screen,size,message,question,minLabel,maxLabel,acceptPreText,acceptText):
-        DisplayInterface.__init__(self,fullscr,screen,size,message)
+    def __init__(self,fullscr,screen,size,message,question,minLabel,maxLabel,acceptPreText,acceptText,backend=None,deferred=False,cacheText=False):
+        DisplayInterface.__init__(self,fullscr,screen,size,message,backend,deferred,cacheText)
         
-        self.mouse = event.Mouse(True,None,self.win)
+        self.mouse = self.backend.makeMouse(self.win)
         
-        barMarker = visual.TextStim(self.win, text='|', units='norm')
+        barMarker = self.backend.makeText(self.win, text='|', units='norm')
         
-        self.VAS = visual.RatingScale(self.win, low=-10, high=10, precision=10, 
+        self.VAS = self.backend.makeRatingScale(self.win, low=-10, high=10, precision=10, 
             showValue=False, marker=barMarker, scale = question,
             tickHeight=1, stretch=1.5, size = 0.8, 
             labels=[minLabel, maxLabel],
@@ -95,32 +1714,38 @@ class VASInterface(DisplayInterface):
             acceptPreText = acceptPreText, acceptText = acceptText)
     
     def getVASrating(self,clock):
-        event.clearEvents()
+        self.finishFlip()
+        self.backend.clearEvents()
         self.VAS.reset()
         resetTime = clock.getTime()
         aborted = False
+        trajectory = self.trajectoryRecord
         while self.VAS.noResponse and not aborted:
             self.VAS.draw()
-            self.win.flip()
-            for (key,t) in event.getKeys(['escape'], timeStamped=clock):
+            self.flip()
+            if trajectory is not None:
+                (x,y) = self.mouse.getPos()
+                rating = self.VAS.getRating()
+                trajectory.record(clock.getTime(), x, y, -1, np.nan if rating is None else rating)
+            for (key,t) in self.backend.getKeys(['escape'], clock):
                 response = -99
                 rTime = t
                 aborted = True
         if not aborted:
             response = self.VAS.getRating()
             rTime = self.VAS.getRT() + resetTime
-        self.win.flip()
+        self.flip()
         return(response,rTime)
 
 class ButtonInterface(DisplayInterface):
-    def __init__(self,fullscr,screen,size,message,nCol,nRow,buttonLabels):
-        DisplayInterface.__init__(self,fullscr,screen,size,message)
+    def __init__(self,fullscr,screen,size,message,nCol,nRow,buttonLabels,backend=None,deferred=False,cacheText=False):
+        DisplayInterface.__init__(self,fullscr,screen,size,message,backend,deferred,cacheText)
         self.nButtons = len(buttonLabels)
         self.outlineColour = [-1,-1,-1]
         self.buttonWidth = 0.6
         self.buttonHeight = 0.2
         self.buttonColour = [0,.25,.9]
-        self.mouse = event.Mouse(True,None,self.win)
+        self.mouse = self.backend.makeMouse(self.win)
         
         ##evenly space the buttons from each other and edges
         xpos = np.linspace(-1,1,nCol+2)[1:nCol+1]
@@ -132,68 +1757,99 @@ class ButtonInterface(DisplayInterface):
         if self.nButtons % 2 == 1: # if number of buttons is odd
             self.buttonPosition = self.buttonPosition[0:self.nButtons]
             self.buttonPosition[self.nButtons-1] = (0,y) # put the last one in the middle
+        ## centre and half-size of each button, for hit-testing
+        self.buttonRects = np.array([(x, y, self.buttonWidth/2, self.buttonHeight/2)
+                                    for (x,y) in self.buttonPosition[0:self.nButtons]])
             
+        self.buttonTextStyle = {'height':self.buttonHeight/3,
+                                'wrapWidth':self.buttonWidth,
+                                'color':self.textColour,
+                                'units':'norm'}
         self.buttons = []
         self.buttonText = []
         for n in range(self.nButtons):
-            self.buttons += [visual.Rect(self.win,
+            self.buttons += [self.backend.makeRect(self.win,
                                     width = self.buttonWidth,
                                     height= self.buttonHeight,
                                     fillColor = self.buttonColour,
                                     lineColor = self.outlineColour,
                                     units = 'norm',
                                     pos = self.buttonPosition[n])]
-            self.buttonText += [visual.TextStim(self.win,
-                                    text=buttonLabels[n],
-                                    height=self.buttonHeight/3,
-                                    wrapWidth = self.buttonWidth,
-                                    color = self.textColour,
-                                    units = 'norm',
-                                    pos = self.buttonPosition[n])]
+            self.buttonText += [self.makeText('label', buttonLabels[n], self.buttonTextStyle)]
+            self.buttonText[n].pos = self.buttonPosition[n]
+    
+    def preloadLabels(self,labels):
+        if self.textCache is not None:
+            self.textCache.preload('label', labels, self.buttonTextStyle)
     
     def showButtons(self,buttonLabels):
+        self.finishFlip()
         self.mouse.clickReset()
         for n in range(self.nButtons):
-            self.buttonText[n].text = buttonLabels[n]
+            self.buttonText[n].autoDraw = False
+        for n in range(self.nButtons):
+            ## a cached label can move to another button, so only show labels once all are swapped
+            (self.buttonText[n],changed) = self.swapText('label', self.buttonText[n], buttonLabels[n], self.buttonTextStyle)
+            self.buttonText[n].pos = self.buttonPosition[n]
+        for n in range(self.nButtons):
             self.buttons[n].opacity = 1
             self.buttons[n].autoDraw = True
             self.buttonText[n].autoDraw = True
-        self.win.flip()
+        if self.trajectoryRecord is not None:
+            self.trajectoryRecord.labels = list(buttonLabels)
+        self.requestFlip()
     
     def hideButtons(self):
+        self.finishFlip()
         for n in range(self.nButtons):
             self.buttonText[n].autoDraw = False
             self.buttons[n].autoDraw = False
-        self.win.flip()
+        self.requestFlip()
     
     def getButtonClick(self,clock):
-        event.clearEvents()
+        self.finishFlip()
+        self.backend.clearEvents()
         self.mouse.clickReset()
         mouseResetTime = clock.getTime()
-        clicked = False
-        aborted = False
-        while not clicked and not aborted:
-            for n, button in enumerate(self.buttons):
-                if self.mouse.isPressedIn(button, buttons=[0]):
-                    mbutton, tList = self.mouse.getPressed(getTime=True)
-                    t = tList[0] + mouseResetTime
-                    clicked = True
-                    response = n
-                    break
-                ## is the mouse inside the shape (hovering over it)?
-                if button.contains(self.mouse):
-                    button.opacity = 0.3
-                else:
-                    button.opacity = 1
-                self.win.flip()
-                time.sleep(0.001)
-            for (key,t) in event.getKeys(['escape'], timeStamped=clock):
+        hovered = -1
+        trajectory = self.trajectoryRecord
+        while True:
+            ## hit-test the mouse against all buttons at once
+            (x,y) = self.mouse.getPos()
+            inside = np.flatnonzero((np.abs(x - self.buttonRects[:,0]) <= self.buttonRects[:,2]) &
+                                    (np.abs(y - self.buttonRects[:,1]) <= self.buttonRects[:,3]))
+            target = inside[0] if len(inside) else -1
+            if trajectory is not None:
+                trajectory.record(clock.getTime(), x, y, target)
+            mbutton, tList = self.mouse.getPressed(getTime=True)
+            if mbutton[0] and target >= 0:
+                ## time of the button press event, not of this poll
+                t = tList[0] + mouseResetTime
+                response = target
+                break
+            keys = self.backend.getKeys(['escape'], clock)
+            if keys:
+                (key,t) = keys[0]
                 response = -2
-                aborted = True
+                break
+            ## only change the highlight, and flip, when the hovered button changes,
+            ## otherwise sleep until the mouse or keyboard does something
+            if target != hovered:
+                if hovered >= 0:
+                    self.buttons[hovered].opacity = 1
+                if target >= 0:
+                    self.buttons[target].opacity = 0.3
+                hovered = target
+                self.flip()
+            else:
+                self.backend.waitEvents(self.backend.frameDuration)
+        if hovered >= 0:
+            self.buttons[hovered].opacity = 1
         return (response,t)
     
     def getSelection(self,timeout,clock):
-        event.clearEvents()
+        self.finishFlip()
+        self.backend.clearEvents()
         confirmed = False
         aborted = False
         fwd = ['a','down']
@@ -202,10 +1858,10 @@ class ButtonInterface(DisplayInterface):
         quit = ['escape']
         buttonSelected = -1
         response = -1
-        countDown = core.CountdownTimer()
+        countDown = self.backend.CountdownTimer()
         countDown.add(timeout)
         while not aborted and not confirmed and countDown.getTime() > 0:
-            for (key,t) in event.getKeys(fwd+bwd+conf+quit, timeStamped=clock):
+            for (key,t) in self.backend.getKeys(fwd+bwd+conf+quit, clock):
                 if key in fwd:
                     self.buttons[buttonSelected].opacity = 1
                     buttonSelected = (buttonSelected+1) % self.nButtons
@@ -225,110 +1881,736 @@ class ButtonInterface(DisplayInterface):
                     self.buttons[buttonSelected].opacity = 1
                     response = -2
                     aborted = True
-                self.win.flip()
+                self.flip()
+            if not aborted and not confirmed:
+                ## sleep until the next key press or the end of the timeout
+                self.backend.waitEvents(countDown.getTime())
         if countDown.getTime() <= 0: t = clock.getTime()
         self.buttons[buttonSelected].opacity = 1
-        self.win.flip()
+        self.flip()
         return (response,t)
 
 
-def present_stimulus(stimInfo,exptInfo,displayText,receiver,toucher,saveFiles,exptClock,isiCountdown,goStopSound):
-    silentLead = 0.064 # silence at the beginning of the audio file
-    countDownDuration = 3.0 # duration of countdown in the audio file
-    stopDuration = 0.434 # silence at the end of the audio file
-    stimulusDuration = 10.0 # duration of the stimulus in the audio file
+def present_frame(*interfaces):
+    ## end of a frame: at most one flip per window, and if no window flipped, still wait for the next frame
+    ## windows with a flip thread flip in the background; each waits for its own flip when next changed
+    ## windows left unflipped mark their frame record idle, so skipped frames aren't counted as dropped
+    for interface in interfaces:
+        if interface.dirty:
+            interface.startFlip()
+        elif interface.nFlips == interface.nFlipsAtLastFrame and interface.flipRecord is not None:
+            interface.finishFlip()
+            interface.flipRecord.idle()
+    if all(interface.nFlips == interface.nFlipsAtLastFrame for interface in interfaces):
+        interfaces[0].backend.idle()
+    for interface in interfaces:
+        interface.nFlipsAtLastFrame = interface.nFlips
+
+
+def analyse_sound(filename,threshold=0.01,window=0.001,minGap=0.1):
+    ## find the duration, leading/trailing silence and onsets of each sound in a WAV file
+    (samples,frameRate) = read_wav(filename)
+    nFrames = len(samples)
+    duration = nFrames / float(frameRate)
+    
+    ## peak envelope over short windows, all channels
+    windowFrames = max(1, int(round(window * frameRate)))
+    nWindows = int(math.ceil(nFrames / float(windowFrames)))
+    peak = np.zeros(nWindows * windowFrames, dtype=np.float32)
+    peak[0:nFrames] = np.abs(samples).max(axis=1)
+    envelope = peak.reshape(nWindows, windowFrames).max(axis=1)
+    
+    ## sound onsets/offsets, merging sounds separated by less than minGap
+    active = np.flatnonzero(envelope > threshold)
+    if len(active) == 0:
+        return {'duration':duration, 'leadingSilence':duration, 'trailingSilence':duration,
+                'onsets':[], 'offsets':[]}
+    windowDuration = windowFrames / float(frameRate)
+    breaks = np.flatnonzero(np.diff(active) * windowDuration >= minGap)
+    onsets = active[np.concatenate(([0], breaks + 1))] * windowDuration
+    offsets = np.minimum((active[np.concatenate((breaks, [len(active)-1]))] + 1) * windowDuration, duration)
+    return {'duration':duration,
+            'leadingSilence':float(onsets[0]),
+            'trailingSilence':float(duration - offsets[-1]),
+            'onsets':[float(t) for t in onsets],
+            'offsets':[float(t) for t in offsets]}
+
+def go_stop_timing(soundInfo):
+    ## the go signal is the sound before the longest silence (the touch period), stop is the last sound
+    onsets = np.array(soundInfo['onsets'])
+    offsets = np.array(soundInfo['offsets'])
+    if len(onsets) < 2:
+        raise ValueError('go/stop audio needs at least a go and a stop sound')
+    goN = int(np.argmax(onsets[1:] - offsets[:-1]))
+    return {'silentLead':soundInfo['leadingSilence'], # silence at the beginning of the audio file
+            'countDownDuration':float(onsets[goN] - soundInfo['leadingSilence']), # duration of countdown in the audio file
+            'stimulusDuration':float(onsets[-1] - onsets[goN]), # duration of the stimulus in the audio file
+            'stopDuration':float(soundInfo['duration'] - onsets[-1]), # duration of the stop signal to the end of the file
+            'onsetError':0.001} # onsets are found to within analyse_sound's 1 ms window
+
+## the go/stop signal as measured in go-stop.wav (see go_stop_parameters): countdown beeps a second apart,
+## a low go tone, warning beeps a second apart counting down to the stop tone at the end of the touch period
+goStopParameters = {'frameRate':44100,
+                    'channels':2,
+                    'silentLead':0.06413, # seconds of silence before the first beep
+                    'countDownBeeps':3,
+                    'countDownDuration':3.00018, # first beep to go
+                    'warningBeeps':3, # beeps in the last seconds of the touch period
+                    'stopDelay':1.00481, # last warning beep to stop
+                    'beepInterval':1.0,
+                    'beepDuration':0.0152,
+                    'beepFrequency':1047.7,
+                    'beepLevel':0.77,
+                    'goDuration':0.2997,
+                    'goFrequency':132.7,
+                    'goLevel':0.361,
+                    'stimulusDuration':10.06857, # go to stop
+                    'stopDuration':0.4143,
+                    'stopFrequency':584.8,
+                    'stopLevel':0.525,
+                    'trailingSilence':0.01642,
+                    'ramp':0.002} # raised cosine onset and offset of each tone, no clicks
+
+def go_stop_onsets(p):
+    ## frame offsets of the countdown beeps, go, warning beeps and stop in the audio p describes, and its length
+    def frame(t):
+        return int(round(t * p['frameRate']))
+    countDown = [frame(p['silentLead'] + beepN * p['beepInterval']) for beepN in range(p['countDownBeeps'])]
+    goStart = frame(p['silentLead'] + p['countDownDuration'])
+    stopStart = goStart + frame(p['stimulusDuration'])
+    warnings = [stopStart - frame(p['stopDelay'] + beepN * p['beepInterval']) for beepN in reversed(range(p['warningBeeps']))]
+    warnings = [beepStart for beepStart in warnings if beepStart >= goStart + frame(p['goDuration'])]
+    nFrames = stopStart + frame(p['stopDuration'] + p['trailingSilence'])
+    return (countDown, goStart, warnings, stopStart, nFrames)
+
+def go_stop_parameters(soundInfo,tolerance=0.001):
+    ## goStopParameters timing measured from recorded go/stop audio (analyse_sound), e.g. to synthesise it
+    ## for another touch duration; checks the synthesised onsets match the recording's to within tolerance
+    onsets = np.array(soundInfo['onsets'])
+    offsets = np.array(soundInfo['offsets'])
+    timing = go_stop_timing(soundInfo)
+    goN = int(np.argmax(onsets[1:] - offsets[:-1]))
+    countDown = onsets[0:goN]
+    warnings = onsets[goN+1:-1]
+    beeps = np.concatenate((countDown, warnings))
+    intervals = np.concatenate((np.diff(countDown), np.diff(warnings)))
+    p = {'silentLead':timing['silentLead'],
+        'countDownBeeps':len(countDown),
+        'countDownDuration':timing['countDownDuration'],
+        'warningBeeps':len(warnings),
+        'beepInterval':float(np.median(intervals)) if len(intervals) else goStopParameters['beepInterval'],
+        'goDuration':float(offsets[goN] - onsets[goN]),
+        'stimulusDuration':timing['stimulusDuration'],
+        'stopDuration':float(offsets[-1] - onsets[-1]),
+        'trailingSilence':soundInfo['trailingSilence']}
+    if len(beeps):
+        p['beepDuration'] = float(np.mean(offsets[np.searchsorted(onsets, beeps)] - beeps))
+    if len(warnings):
+        p['stopDelay'] = float(onsets[-1] - warnings[-1])
+    p = dict((key, round(value, 5)) for (key,value) in p.items())
+    (countDownFrames,goStart,warningFrames,stopStart,nFrames) = go_stop_onsets(dict(goStopParameters, **p))
+    synthesised = np.array(countDownFrames + [goStart] + warningFrames + [stopStart]) / float(goStopParameters['frameRate'])
+    if len(synthesised) != len(onsets) or np.abs(synthesised - onsets).max() > tolerance:
+        raise ValueError('synthesised go/stop onsets {} do not match the recorded ones {}' .format(synthesised, onsets))
+    return p
+
+def synthesise_go_stop(**parameters):
+    ## the go/stop audio from goStopParameters, with its timing as go_stop_timing gives it, exact to the sample
+    p = dict(goStopParameters, **parameters)
+    frameRate = p['frameRate']
+    def frame(t):
+        return int(round(t * frameRate))
+    (countDown,goStart,warnings,stopStart,nFrames) = go_stop_onsets(p)
+    mono = np.zeros(nFrames, dtype=np.float32)
+    def add_tone(start,duration,frequency,level):
+        length = frame(duration)
+        tone = level * np.sin(2*np.pi*frequency * np.arange(length) / float(frameRate))
+        rampLength = min(frame(p['ramp']), length//2)
+        ramp = 0.5 - 0.5*np.cos(np.pi * np.arange(rampLength) / float(max(rampLength, 1)))
+        tone[0:rampLength] *= ramp
+        tone[length-rampLength:length] *= ramp[::-1]
+        mono[start:start+length] += tone
+    for beepStart in countDown + warnings:
+        add_tone(beepStart, p['beepDuration'], p['beepFrequency'], p['beepLevel'])
+    add_tone(goStart, p['goDuration'], p['goFrequency'], p['goLevel'])
+    add_tone(stopStart, p['stopDuration'], p['stopFrequency'], p['stopLevel'])
+    timing = {'silentLead':countDown[0] / float(frameRate) if countDown else p['silentLead'],
+            'countDownDuration':(goStart - frame(p['silentLead'])) / float(frameRate),
+            'stimulusDuration':(stopStart - goStart) / float(frameRate),
+            'stopDuration':(nFrames - stopStart) / float(frameRate),
+            'onsets':[t / float(frameRate) for t in countDown + [goStart] + warnings + [stopStart]],
+            'onsetError':0.0}
+    return (np.repeat(mono[:,None], p['channels'], axis=1), timing)
+
+def render_go_stop(folder='./sounds/rendered',**parameters):
+    ## synthesise_go_stop's audio as a WAV file, rendered once and cached by its parameters
+    ## returns the filename and the timing, so nothing is measured or synthesised at trial time
+    p = dict(goStopParameters, **parameters)
+    key = hashlib.sha1(json.dumps(p, sort_keys=True).encode()).hexdigest()[0:16]
+    filename = os.path.join(folder, 'go-stop-{}.wav' .format(key))
+    timingFilename = filename[:-len('.wav')] + '.json'
+    if os.path.exists(filename):
+        try:
+            return (filename, json.load(open(timingFilename))['timing'])
+        except (IOError, ValueError, KeyError):
+            pass
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    (samples,timing) = synthesise_go_stop(**p)
+    ## written alongside then renamed, so an interrupted render is never mistaken for a cached one
+    write_wav(filename + '.tmp', samples, p['frameRate'])
+    timingFile = open(timingFilename + '.tmp', 'w')
+    json.dump({'parameters':p, 'timing':timing}, timingFile, indent=1, sort_keys=True)
+    timingFile.close()
+    os.replace(timingFilename + '.tmp', timingFilename)
+    os.replace(filename + '.tmp', filename)
+    return (filename, timing)
+
+class SoundIndex():
+    ## caches analyse_sound results in a sidecar file, keyed by file hash and modification time
+    def __init__(self,indexFilename='./sounds/index.json'):
+        self.indexFilename = indexFilename
+        self.changed = False
+        try:
+            self.index = json.load(open(indexFilename))
+        except (IOError, ValueError):
+            self.index = {}
+    
+    def get(self,filename):
+        stat = os.stat(filename)
+        entry = self.index.get(filename)
+        if entry is None or entry['mtime'] != stat.st_mtime or entry['size'] != stat.st_size:
+            fileHash = hashlib.sha1(open(filename, 'rb').read()).hexdigest()
+            if entry is None or entry['sha1'] != fileHash:
+                entry = {'sha1':fileHash, 'info':analyse_sound(filename)}
+            entry['mtime'] = stat.st_mtime
+            entry['size'] = stat.st_size
+            self.index[filename] = entry
+            self.changed = True
+        return entry['info']
+    
+    def save(self):
+        if not self.changed:
+            return
+        tempFilename = self.indexFilename + '.tmp'
+        indexFile = open(tempFilename, 'w')
+        json.dump(self.index, indexFile, indent=1, sort_keys=True)
+        indexFile.close()
+        os.replace(tempFilename, self.indexFilename)
+        self.changed = False
+
+
+def sleep_until(clock,t,spin=0.002):
+    ## sleep, then spin for the last 2 ms, until clock reads t, without handling window events,
+    ## so it can wait on threads other than the main one
+    remaining = t - clock.getTime()
+    if remaining > spin:
+        time.sleep(remaining - spin)
+    while clock.getTime() < t:
+        pass
+
+def play_at(sound,backend,clock,onset,waitUntil=None):
+    ## start sound so that it is heard at onset on clock, as closely as the mixer allows
+    ## returns the channel, the time it will be heard and the error bound on that time
+    ## waitUntil defaults to the backend's, which handles window events and is for the main thread only
+    (latency,uncertainty) = backend.audioLatency()
+    (waitUntil or backend.waitUntil)(clock, onset - latency)
+    playTime = clock.getTime()
+    channel = sound.play()
+    callTime = clock.getTime() - playTime
+    return (channel, playTime + latency, uncertainty + callTime)
+
+class AudioCueBank():
+    ## decodes sounds once and keeps them ready to play, within a memory budget
+    def __init__(self,filenames=(),memoryBudget=64*1024*1024,pinned=(),backend=None):
+        self.backend = backend if backend is not None else defaultBackend
+        self.memoryBudget = memoryBudget # bytes of decoded audio to keep
+        self.pinned = set(pinned) # never evicted, e.g. the go/stop signal
+        self.sounds = collections.OrderedDict() # least recently used first
+        self.sizes = {}
+        self.memoryUsed = 0
+        self.cueLatency = [] # (cue, seconds from cue requested to play() returned)
+        for filename in list(pinned) + list(filenames):
+            self.load(filename)
+    
+    def load(self,filename):
+        if filename in self.sounds:
+            self.sounds.move_to_end(filename)
+            return self.sounds[filename]
+        sound = self.backend.loadSound(filename)
+        size = self.backend.audio.soundSize(sound)
+        self.evict(size)
+        self.sounds[filename] = sound
+        self.sizes[filename] = size
+        self.memoryUsed += size
+        return sound
+    
+    def evict(self,size):
+        ## drop least recently used sounds until there is room for size more bytes
+        for filename in list(self.sounds):
+            if self.memoryUsed + size <= self.memoryBudget:
+                break
+            if filename not in self.pinned:
+                del self.sounds[filename]
+                self.memoryUsed -= self.sizes.pop(filename)
+    
+    def get(self,filename):
+        return self.load(filename)
+    
+    def play(self,filename):
+        requestTime = time.perf_counter()
+        channel = self.get(filename).play()
+        self.cueLatency.append((filename, time.perf_counter() - requestTime))
+        return channel
+    
+    def playAt(self,filename,clock,onset,sound=None):
+        ## scheduled play, see play_at; cueLatency is the lookup plus the time from when play() was due,
+        ## onset less the mixer latency, to play() returning, leaving out the wait for the onset
+        ## sound, if it has already been got from the bank, is played without looking it up again
+        requestTime = time.perf_counter()
+        if sound is None:
+            sound = self.get(filename)
+        lookupTime = time.perf_counter() - requestTime
+        (channel,heardTime,errorBound) = play_at(sound, self.backend, clock, onset)
+        playedTime = clock.getTime()
+        (latency,uncertainty) = self.backend.audioLatency()
+        self.cueLatency.append((filename, lookupTime + playedTime - (onset - latency)))
+        return (channel, heardTime, errorBound)
+    
+    def saveLatency(self,filename):
+        latencyFile = open(filename, 'w')
+        latencyFile.write('cue,latency\n')
+        for (cue,latency) in self.cueLatency:
+            latencyFile.write('"{}",{}\n' .format(cue, latency))
+        latencyFile.close()
+
+
+class SyncPulses():
+    ## sync pulses (sounds/sync.wav) on an audio channel of their own, for lining physiology and video
+    ## recordings up with the log afterwards (see analysis.py align): one at the start of the session,
+    ## one at the start of each trial, and one whenever there hasn't been one for interval seconds
+    ## pulses are played on a background thread, so asking for one never holds up the display,
+    ## and each is started after the last has finished, so that none are cut short
+    def __init__(self,backend,saveFiles,clock,filename='./sounds/sync.wav',interval=30.0):
+        self.backend = backend
+        self.saveFiles = saveFiles
+        self.clock = clock
+        self.interval = interval
+        self.sound = backend.reserveChannel(backend.loadSound(filename))
+        self.length = self.sound.get_length()
+        self.nPulses = 0
+        self.lastPulse = None # time the last pulse was heard
+        self.requests = collections.deque() # labels of pulses asked for
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+    
+    def start(self):
+        ## with virtual time there is no background thread, pulses are played when asked for
+        self.running = True
+        if not getattr(self.backend, 'virtualTime', False):
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+    
+    def pulse(self,label):
+        if self.thread is None:
+            self._play(label)
+            return
+        with self.condition:
+            self.requests.append(label)
+            self.condition.notify()
+    
+    def update(self):
+        ## play an interval pulse if one is due, for when there is no background thread
+        if self.thread is None and self.lastPulse is not None and self.clock.getTime() >= self.lastPulse + self.interval:
+            self._play('interval')
+    
+    def _play(self,label):
+        (latency,uncertainty) = self.backend.audioLatency()
+        onset = self.clock.getTime() + latency
+        if self.lastPulse is not None:
+            onset = max(onset, self.lastPulse + self.length)
+        ## the pulse thread waits without the backend, which would handle window events off the main thread
+        waitUntil = sleep_until if self.thread is not None else None
+        (channel,heardTime,errorBound) = play_at(self.sound, self.backend, self.clock, onset, waitUntil)
+        self.nPulses += 1
+        self.lastPulse = heardTime
+        event = 'sync pulse {} {}' .format(self.nPulses, label)
+        self.saveFiles.logEvent(heardTime, event)
+        self.saveFiles.logTiming(heardTime, event, onset, errorBound)
+    
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.requests:
+                    if self.lastPulse is None:
+                        self.condition.wait()
+                        continue
+                    (latency,uncertainty) = self.backend.audioLatency()
+                    timeout = self.lastPulse + self.interval - latency - self.clock.getTime()
+                    if timeout <= 0:
+                        self.requests.append('interval')
+                    else:
+                        self.condition.wait(timeout)
+                if not self.requests:
+                    return
+                label = self.requests.popleft()
+            self._play(label)
+    
+    def close(self):
+        ## stop the background thread, once any pulses asked for have been played
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+class SyntheticSensor():
+    ## stand-in for a touch sensor or motion tracker, for trying out SensorCapture without hardware:
+    ## rate samples a second of nChannels slowly varying "pressures", timestamped on clock
+    ## a sensor source has rate, nChannels, read() -> (times, values) of any new samples, and close()
+    def __init__(self,clock,rate=1000.0,nChannels=3,seed=0):
+        self.clock = clock
+        self.rate = rate
+        self.nChannels = nChannels
+        self.rng = np.random.RandomState(seed)
+        self.startTime = clock.getTime()
+        self.nRead = 0
+        self.phase = self.rng.uniform(0, 2*np.pi, nChannels)
+    
+    def read(self):
+        ## everything sampled since the last read, after waiting for at least one new sample
+        time.sleep(1.0/self.rate)
+        nDue = int((self.clock.getTime() - self.startTime) * self.rate)
+        n = np.arange(self.nRead, nDue)
+        self.nRead = nDue
+        times = self.startTime + n / self.rate
+        values = (np.sin(2*np.pi*0.5*times[:,np.newaxis] + self.phase) +
+                    0.05*self.rng.randn(len(n), self.nChannels)).astype(np.float32)
+        return (times, values)
+    
+    def close(self):
+        pass
+
+sensorSources = {'synthetic':SyntheticSensor}
+
+class SensorCapture():
+    ## continuous data from a sensor source, read on a background thread into a ring buffer, and written
+    ## out trial by trial as memory-mappable .npy files of (time, values) with times on the experiment clock,
+    ## each trial's file running up to the time endTrial was called
+    ## the capture thread stores samples, and endTrial copies the trial's samples out, under one lock,
+    ## so the copy is a consistent snapshot of times and values; the trial files are written outside it
+    ## with virtualTime the clock runs ahead of the sensor, so endTrial takes what has been captured without waiting
+    def __init__(self,source,fileprefix,clock,capacity=120.0,virtualTime=False):
+        self.source = source
+        self.fileprefix = fileprefix
+        self.clock = clock
+        self.size = int(capacity * source.rate) # seconds of samples the ring buffer holds
+        self.times = np.zeros(self.size)
+        self.values = np.zeros((self.size, source.nChannels), dtype=np.float32)
+        self.dtype = np.dtype([('time','<f8'), ('values','<f4',(source.nChannels,))])
+        self.written = 0 # samples ever written to the ring buffer
+        self.lost = 0 # samples overwritten before they were saved
+        self.trial = None
+        self.trialStart = 0
+        self.lock = threading.Lock()
+        self.captured = threading.Condition(self.lock) # notified by the capture thread after storing samples
+        self.virtualTime = virtualTime
+        self.running = False
+        self.thread = None
+    
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def _run(self):
+        try:
+            while self.running:
+                (times,values) = self.source.read()
+                for start in range(0, len(times), self.size):
+                    with self.captured:
+                        self._store(times[start:start+self.size], values[start:start+self.size])
+                        self.captured.notify_all()
+        finally:
+            ## if the source fails, endTrial stops waiting for samples that won't come
+            with self.captured:
+                self.running = False
+                self.captured.notify_all()
+    
+    def _store(self,times,values):
+        n = len(times)
+        head = self.written % self.size
+        first = min(n, self.size - head)
+        self.times[head:head+first] = times[0:first]
+        self.values[head:head+first] = values[0:first]
+        self.times[0:n-first] = times[first:n]
+        self.values[0:n-first] = values[first:n]
+        self.written += n
+    
+    def startTrial(self,trial):
+        ## samples since the end of the last trial go in with this one, so none are left out
+        self.trial = trial
+    
+    def endTrial(self):
+        ## save everything captured up to now that hasn't been saved, returns the file name
+        endTime = self.clock.getTime()
+        with self.captured:
+            ## give the capture thread up to a second to catch up with now
+            if not self.virtualTime:
+                self.captured.wait_for(lambda: not self.running or (
+                    self.written > 0 and self.times[(self.written-1) % self.size] >= endTime), 1.0)
+            end = self.written
+            start = max(self.trialStart, end - self.size)
+            ringIndex = np.arange(start, end) % self.size
+            times = self.times[ringIndex]
+            values = self.values[ringIndex]
+        n = int(np.searchsorted(times, endTime))
+        filename = '{}_sensor_trial{:03d}.npy' .format(self.fileprefix, self.trial)
+        trialData = np.lib.format.open_memmap(filename, mode='w+', dtype=self.dtype, shape=(n,))
+        trialData['time'] = times[0:n]
+        trialData['values'] = values[0:n]
+        trialData.flush()
+        del trialData
+        ## anything the capture thread overwrote before it was copied is lost
+        self.lost += start - self.trialStart
+        self.trialStart = start + n
+        return filename
+    
+    def close(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.source.close()
+
+
+def longest_run(sequences):
+    ## longest run of one value in each row of a 2D array
+    sequences = np.atleast_2d(sequences)
+    n = sequences.shape[1]
+    change = np.ones(sequences.shape, dtype=bool)
+    change[:,1:] = sequences[:,1:] != sequences[:,:-1]
+    lastChange = np.maximum.accumulate(np.where(change, np.arange(n), 0), axis=1)
+    return (np.arange(n) - lastChange + 1).max(axis=1)
+
+class TrialSequence():
+    ## seeded trial order and button orders for a session, each picked from nCandidates random candidates
+    ## generated at once: the trial order is nReps shuffled blocks of items with no item more than maxRun
+    ## times in a row; the button orders are rows of random Latin squares, so every button label is shown
+    ## in every position equally often, from the candidate where each cued item's own button moves round
+    ## the positions most evenly. items must all be in buttonItems. order and buttonOrders, e.g. from
+    ## record() in a session journal, are checked and used instead of generating new ones
+    def __init__(self,items,nReps,seed,maxRun=1,buttonItems=None,nCandidates=2000,order=None,buttonOrders=None):
+        self.items = list(items)
+        self.nReps = nReps
+        self.seed = seed
+        self.maxRun = maxRun
+        self.buttonItems = None if buttonItems is None else list(buttonItems)
+        self.nTrials = len(self.items) * nReps
+        rng = np.random.RandomState(seed)
+        if order is None:
+            order = [self.items[i] for i in self.makeOrder(rng, nCandidates)]
+        if self.buttonItems is not None and buttonOrders is None:
+            buttonOrders = [[self.buttonItems[i] for i in row] for row in self.makeButtonOrders(rng, nCandidates, order)]
+        self.order = list(order)
+        self.buttonOrders = None if buttonOrders is None else [list(row) for row in buttonOrders]
+        self.check()
+    
+    def makeOrder(self,rng,nCandidates):
+        nItems = len(self.items)
+        for attempt in range(100):
+            ## argsort of random numbers shuffles every block of every candidate
+            candidates = rng.rand(nCandidates, self.nReps, nItems).argsort(axis=2).reshape(nCandidates, self.nTrials)
+            valid = np.flatnonzero(longest_run(candidates) <= self.maxRun)
+            if len(valid):
+                return candidates[valid[0]]
+        raise ValueError('no order of {} x {} trials has at most {} of a cue in a row' .format(nItems, self.nReps, self.maxRun))
+    
+    def makeButtonOrders(self,rng,nCandidates,order):
+        k = len(self.buttonItems)
+        nSquares = -(-self.nTrials // k)
+        shape = (nCandidates, nSquares, k)
+        ## a cyclic Latin square with its rows, columns and labels shuffled is a random Latin square
+        (rows,columns,labels) = [rng.rand(*shape).argsort(axis=2) for i in range(3)]
+        cyclic = (rows[:,:,:,np.newaxis] + columns[:,:,np.newaxis,:]) % k
+        squares = np.take_along_axis(labels[:,:,np.newaxis,:], cyclic, axis=3).reshape(nCandidates, nSquares*k, k)
+        ## shuffle the rows of all the squares into trial order
+        shuffle = rng.rand(nCandidates, nSquares*k).argsort(axis=1)[:,0:self.nTrials]
+        candidates = np.take_along_axis(squares, shuffle[:,:,np.newaxis], axis=1)
+        ## how often each cued item's button is in each position, for every candidate
+        cued = np.array([self.buttonItems.index(item) for item in order])
+        positions = np.argmax(candidates == cued[np.newaxis,:,np.newaxis], axis=2)
+        bins = (np.arange(nCandidates)[:,np.newaxis] * k + cued[np.newaxis,:]) * k + positions
+        counts = np.bincount(bins.ravel(), minlength=nCandidates*k*k).reshape(nCandidates, k, k)
+        return candidates[np.argmin((counts**2).sum(axis=(1,2)))]
+    
+    def check(self):
+        if sorted(self.order) != sorted(self.items * self.nReps):
+            raise ValueError('trial order does not have each item {} times' .format(self.nReps))
+        orderN = np.array([self.items.index(item) for item in self.order])
+        if longest_run(orderN)[0] > self.maxRun:
+            raise ValueError('trial order has more than {} of a cue in a row' .format(self.maxRun))
+        if self.buttonOrders is not None:
+            if len(self.buttonOrders) != self.nTrials or any(sorted(row) != sorted(self.buttonItems) for row in self.buttonOrders):
+                raise ValueError('button orders are not one permutation of the buttons per trial')
+    
+    def record(self):
+        ## everything needed to rebuild this sequence, as a JSON-able dict
+        return {'items':self.items, 'nReps':self.nReps, 'seed':self.seed, 'maxRun':self.maxRun,
+                'buttonItems':self.buttonItems, 'order':self.order, 'buttonOrders':self.buttonOrders}
+
+def get_session_options(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--headless', action='store_true', 
+                        help='run offscreen with a scripted participant, no dialog')
+    parser.add_argument('--simulate', action='store_true', 
+                        help='run headless on a virtual clock, as fast as possible')
+    parser.add_argument('--seed', type=int, help='seed for the trial order and scripted responses')
+    parser.add_argument('--participant', help='participant code')
+    parser.add_argument('--folder', help='folder for saving data')
+    parser.add_argument('--frame-timing', action='store_true', help='record frame timing telemetry')
+    parser.add_argument('--trajectories', action='store_true', help='record the mouse during responses')
+    parser.add_argument('--resume', metavar='JOURNAL', help='carry on an interrupted session from its _journal.jsonl')
+    parser.add_argument('--storage', choices=['csv','columnar','both'], help='how to save data and log files')
+    parser.add_argument('--dashboard', type=int, metavar='PORT', help='serve a live view of the session on this port')
+    parser.add_argument('--go-stop', metavar='WAV', help='recorded go/stop signal')
+    parser.add_argument('--touch-duration', type=float, help='synthesise the go/stop signal with this many seconds from go to stop')
+    parser.add_argument('--concurrent-flips', action='store_true', help='flip each screen on its own thread (Linux only)')
+    parser.add_argument('--sync-pulses', action='store_true', help='play sync pulses for aligning external recordings')
+    parser.add_argument('--markers', help='stream logged events to udp://host:port or tcp://host:port')
+    parser.add_argument('--sensor', choices=sorted(sensorSources), help='capture continuous sensor data during trials')
+    parser.add_argument('--audio', choices=sorted(audioBackends), help='audio backend')
+    parser.add_argument('--audio-buffer', type=int, help='audio buffer size in samples')
+    parser.add_argument('--sample-rate', type=int, help='audio sample rate in Hz')
+    options = parser.parse_args(argv)
+    options.headless = options.headless or options.simulate
+    return options
+
+
+def present_stimulus(stimInfo,exptInfo,displayText,receiver,toucher,saveFiles,exptClock,isiCountdown,goStopSound,cueBank,goStopTiming):
+    # timing of the go/stop signal, from render_go_stop or measured from the audio file once per session
+    silentLead = goStopTiming['silentLead']
+    countDownDuration = goStopTiming['countDownDuration']
+    stimulusDuration = goStopTiming['stimulusDuration']
     
     # display messages
     toucher.updateMessage(stimInfo['toucherCueText'])
     receiver.updateMessage(displayText['waitMessage'])
     
-    # get the audio cue file for this trial
-    thisCueSound = pygame.mixer.Sound(stimInfo['cueSound'])
+    # the audio cue for this trial, preloaded in the cue bank (or loaded now if it was evicted, not at its onset)
+    cueSound = cueBank.get(stimInfo['cueSound'])
     thisSoundDuration = stimInfo['cueSoundDuration']
         
     startLogNeeded = stopLogNeeded = True
     
+    ## sounds are started ahead of time by the mixer latency, so that they are heard on schedule
+    (audioLatency,audioUncertainty) = toucher.backend.audioLatency()
+    frameDuration = toucher.backend.frameDuration
+    envelopeError = goStopTiming.get('onsetError', 0.001) # measured onsets are within 1 ms, synthesised ones exact
+    leadTime = thisSoundDuration + silentLead + countDownDuration
+    
     # wait for experimenter to press to continue
     if exptInfo['Press to continue']:
         # toucher display message, prompt to continue
         toucher.updateMessage(stimInfo['toucherCueText'] + '\n' + displayText['continueMessage'])
-        for (key,keyTime) in event.waitKeys(keyList=['space','escape'], timeStamped=exptClock):
+        present_frame(toucher, receiver)
+        for (key,keyTime) in toucher.waitKeys(['space','escape'], exptClock):
             if key in ['escape']:
                 saveFiles.logAbort(keyTime)
-                core.quit()
+                toucher.backend.quit()
         # toucher display message, remove prompt to continue
         toucher.updateMessage(stimInfo['toucherCueText'])
-        isiCountdown.reset(thisSoundDuration + silentLead + countDownDuration)
+        isiCountdown.reset(leadTime + audioLatency)
     
-    # wait for inter-stimulus interval duration
-    while isiCountdown.getTime() > thisSoundDuration + silentLead + countDownDuration:
+    # wait for inter-stimulus interval duration, until the cue is due within a frame
+    while isiCountdown.getTime() > leadTime + audioLatency + frameDuration:
         toucher.updateTimerDisplay(isiCountdown.getTime())
-        for (key,keyTime) in event.getKeys(['escape'], timeStamped=exptClock):
+        for (key,keyTime) in toucher.getKeys(['escape'], exptClock):
             saveFiles.logAbort(keyTime)
-            core.quit()
+            toucher.backend.quit()
+        present_frame(toucher, receiver)
     
-    # audio cue for toucher
-    soundCh = thisCueSound.play()
-    saveFiles.logEvent(exptClock.getTime(),'toucher cue {}' .format(stimInfo['stim']))
+    # audio cue for toucher, heard when the countdown reaches the cue, go/stop countdown and silence
+    cueScheduled = exptClock.getTime() + isiCountdown.getTime() - leadTime
+    (soundCh,cueTime,cueError) = cueBank.playAt(stimInfo['cueSound'], exptClock, cueScheduled, cueSound)
+    saveFiles.logEvent(cueTime,'toucher cue {}' .format(stimInfo['stim']))
+    saveFiles.logTiming(cueTime,'toucher cue {}' .format(stimInfo['stim']),cueScheduled,cueError)
+    ## the go/stop signal follows straight on from the cue
+    goStopScheduled = cueTime + thisSoundDuration
+    isiCountdown.reset(goStopScheduled + silentLead + countDownDuration - exptClock.getTime())
     ## display messages
     toucher.updateMessage(stimInfo['toucherCueText'] + '.\n'+ displayText['touchMessage'])
     receiver.updateMessage(displayText['fixationMessage'])
-    while soundCh.get_busy():
+    while exptClock.getTime() < goStopScheduled - audioLatency - frameDuration:
         toucher.updateTimerDisplay(isiCountdown.getTime())
-        for (key,keyTime) in event.getKeys(['escape'], timeStamped=exptClock):
+        for (key,keyTime) in toucher.getKeys(['escape'], exptClock):
             soundCh.stop()
             saveFiles.logAbort(keyTime)
-            core.quit()
+            toucher.backend.quit()
+        present_frame(toucher, receiver)
     
     # signal the stimulus
-    soundCh = goStopSound.play()
-    saveFiles.logEvent(exptClock.getTime() + silentLead,'countdown to touch')
+    (soundCh,goStopTime,goStopError) = play_at(goStopSound, toucher.backend, exptClock, goStopScheduled)
+    ## times of the countdown, go and stop signals from when the go/stop audio is heard
+    eventError = goStopError + envelopeError
+    countDownTime = goStopTime + silentLead
+    stimStartTime = countDownTime + countDownDuration
+    stimStopTime = stimStartTime + stimulusDuration
+    isiCountdown.reset(stimStartTime - exptClock.getTime())
+    saveFiles.logEvent(countDownTime,'countdown to touch')
+    saveFiles.logTiming(countDownTime,'countdown to touch',goStopScheduled + silentLead,eventError)
     while soundCh.get_busy():
         # check if the experiment is aborted
-        for (key,keyTime) in event.getKeys(['escape'], timeStamped=exptClock):
+        for (key,keyTime) in toucher.getKeys(['escape'], exptClock):
             soundCh.stop()
             saveFiles.logAbort(keyTime)
-            core.quit()
+            toucher.backend.quit()
         # start of the stimulus, audio 'go' signal
         if isiCountdown.getTime() < 0:
             toucher.hideTimerDisplay()
-            stimStartTime = None
             if startLogNeeded:
-                if stimStartTime == None:
-                    stimStartTime = exptClock.getTime()
                 saveFiles.logEvent(stimStartTime,'start touching')
+                saveFiles.logTiming(stimStartTime,'start touching',goStopScheduled + silentLead + countDownDuration,eventError)
                 startLogNeeded = False
             # end of the stimulus, audio 'stop' signal
             if isiCountdown.getTime() < -stimulusDuration:
-                stimStopTime = None
                 if stopLogNeeded:
-                    if stimStopTime == None:
-                        stimStopTime = exptClock.getTime()
-                    isiCountdown.reset(exptInfo['Inter-stimulus interval (sec)'])
+                    ## the inter-stimulus interval runs from the stop signal
+                    isiCountdown.reset(exptInfo['Inter-stimulus interval (sec)'] + stimStopTime - exptClock.getTime())
                     saveFiles.logEvent(stimStopTime,'stop touching')
+                    saveFiles.logTiming(stimStopTime,'stop touching',goStopScheduled + silentLead + countDownDuration + stimulusDuration,eventError)
                     stopLogNeeded = False
         # keep updating the timer display before the stimulus starts, during audio countdown
         elif stopLogNeeded: 
             toucher.updateTimerDisplay(isiCountdown.getTime())
+        present_frame(toucher, receiver)
     
 
-def get_button_response(stimLabels,receiverCueText,stimInfo,displayText,receiver,toucher,saveFiles,exptClock):
+def get_button_response(stimLabels,receiverCueText,stimInfo,displayText,receiver,toucher,saveFiles,exptClock,buttonOrder=None):
     # wait for participant
     toucher.updateMessage(displayText['waitMessage'])
     
     # present cue buttons for receiver to make a choice
     receiver.updateMessage('')
     
-    ## randomise button positions
-    randomStimLabels =  random.sample(stimLabels,len(stimLabels)) + ['other']
+    ## button positions from the session's TrialSequence, or randomised
+    if buttonOrder is None:
+        buttonOrder = random.sample(stimLabels,len(stimLabels))
+    randomStimLabels = list(buttonOrder) + ['other']
     receiver.showButtons([receiverCueText[i] for i in randomStimLabels])
+    present_frame(toucher, receiver)
     saveFiles.logEvent(exptClock.getTime(),'buttons presented')
     
      # get response from receiver
     (responseN,rTime) = receiver.getButtonClick(exptClock)
     if responseN == -2:
         saveFiles.logAbort(rTime)
-        core.quit()
+        receiver.backend.quit()
     elif responseN == -1:
         response = 'timeout'
     else:
@@ -338,6 +2620,7 @@ def get_button_response(stimLabels,receiverCueText,stimInfo,displayText,receiver
     
     # stop drawing buttons for receiver
     receiver.hideButtons()
+    present_frame(toucher, receiver)
     return(response)
 
 def get_vas_response(toucher,receiver,displayText,exptClock,saveFiles):
@@ -346,10 +2629,11 @@ def get_vas_response(toucher,receiver,displayText,exptClock,saveFiles):
     
     # show VAS to participant and get rating
     receiver.updateMessage('') ## hide message
+    present_frame(toucher, receiver)
     (rating,rTime) = receiver.getVASrating(exptClock)
     if rating == -99:
         saveFiles.logAbort(rTime)
-        core.quit()
+        receiver.backend.quit()
     saveFiles.logEvent(rTime,'Pleasantness rating (-10,10) = {}' .format(rating))
     
     return(rating)